@@ -0,0 +1,48 @@
+"""
+Offline batch search over the catalog, for evaluation runs and bulk recommendation jobs:
+
+    python batch_search.py jobs.ndjson -o results.ndjson
+
+Every input line is a job {"id": ..., "image_path": ..., "text": ..., "category": ..., "k": ...}, every output line
+its {"id": ..., "results": [...]} (with the similarity of each product) or {"id": ..., "error": ...}, in input order.
+Jobs are read, encoded with TransAgg.combine_features and answered BATCH_JOB_CHUNK at a time, and the gallery is
+scored exactly in fixed-size row chunks straight from the memory-mapped embedding store, so memory stays bounded
+whatever the number of jobs and the size of the catalog. The same stream is served by POST /batch-search.
+"""
+import argparse
+import sys
+
+import ecommerce_app as core
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run NDJSON visual search jobs against the catalog')
+    parser.add_argument('input', help="NDJSON file of jobs, '-' for stdin")
+    parser.add_argument('-o', '--output', default='-', help="NDJSON file of results, '-' for stdout")
+    parser.add_argument('--chunk-size', type=int, default=core.BATCH_JOB_CHUNK, help='jobs per model call')
+    args = parser.parse_args()
+
+    # the search is exact and the store is not watched, the indexes are only opened to get the live rows
+    core.ANN_BACKEND = 'brute_force'
+    core.INDEX_RELOAD_INTERVAL_S = 0
+    core.load_model()
+    core.open_indexes()
+
+    jobs = sys.stdin if args.input == '-' else open(args.input)
+    results = sys.stdout if args.output == '-' else open(args.output, 'w')
+    try:
+        for chunk in core.run_batch_job(jobs, args.chunk_size):
+            results.write(chunk)
+            results.flush()
+    finally:
+        if jobs is not sys.stdin:
+            jobs.close()
+        if results is not sys.stdout:
+            results.close()
+        core.shard_search.close()
+        if core.search_batcher is not None:
+            core.search_batcher.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+import time
+import threading
+import dataclasses
+from collections import OrderedDict
+import numpy as np
+import torch
+
+
+def value_nbytes(value) -> int:
+    """
+    Memory footprint of a cached value: tensors, arrays and bytes are counted by their buffer size, containers
+    recursively, anything else as 0
+    """
+    if isinstance(value, torch.Tensor):
+        return value.element_size() * value.nelement()
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, (tuple, list)):
+        return sum(value_nbytes(v) for v in value)
+    if isinstance(value, dict):
+        return sum(value_nbytes(v) for v in value.values())
+    if dataclasses.is_dataclass(value):
+        return sum(value_nbytes(getattr(value, f.name)) for f in dataclasses.fields(value))
+    return 0
+
+
+class LRUCache:
+    """
+    Thread-safe least-recently-used mapping bounded by the total byte size of its values, whose entries optionally
+    expire a fixed time after they were put
+    """
+
+    def __init__(self, max_bytes: int, size_fn: callable = value_nbytes, ttl: float = None):
+        """
+        :param max_bytes: capacity of the cache
+        :param size_fn: function returning the size in bytes of a value
+        :param ttl: lifetime of an entry in seconds, None for no expiry
+        """
+        self.max_bytes = max_bytes
+        self.size_fn = size_fn
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (value, nbytes, expiry time)
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        entry = self._entries.get(key)
+        return entry is not None and (entry[2] is None or entry[2] > time.monotonic())
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] is not None and entry[2] <= time.monotonic():
+                self.nbytes -= self._entries.pop(key)[1]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, evict: bool = True) -> bool:
+        """
+        :param key: hashable key
+        :param value: value to cache
+        :param evict: whether older entries may be evicted to make room, otherwise the value is only cached if it fits
+        :return: True if the value was cached
+        """
+        nbytes = self.size_fn(value)
+        if nbytes > self.max_bytes:
+            return False
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            if not evict and self.nbytes + nbytes > self.max_bytes:
+                return False
+            while self.nbytes + nbytes > self.max_bytes:
+                _, (_, evicted_nbytes, _) = self._entries.popitem(last=False)
+                self.nbytes -= evicted_nbytes
+                self.evictions += 1
+            self._entries[key] = (value, nbytes, None if self.ttl is None else time.monotonic() + self.ttl)
+            self.nbytes += nbytes
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'bytes': self.nbytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
@@ -3,21 +3,20 @@ import multiprocessing
 from typing import List, Tuple
 import numpy as np
 import torch
-import torch.nn.functional as F
 from torch.utils.data import DataLoader
 from tqdm import tqdm
 from config import Config
 from model.model import TransAgg
-from utils import get_preprocess, extract_index_features
+from utils import get_preprocess, extract_index_features, index_rows, names_to_ids, StreamingTopK, rank_group_members
 from data.cirr_dataset import CIRRDataset
 
 
-def generate_cirr_test_submissions(file_name, model, preprocess, device):
+def generate_cirr_test_submissions(file_name, model, preprocess, device, memory_budget=512 * 1024 ** 2):
     classic_test_dataset = CIRRDataset('test1', 'classic', preprocess)
     index_features, index_names, _ = extract_index_features(classic_test_dataset, model, return_local=False)
     relative_test_dataset = CIRRDataset('test1', 'relative', preprocess)
     pairid_to_predictions, pairid_to_group_predictions = generate_cirr_test_dicts(relative_test_dataset,index_features, 
-                                                                                  index_names, model, device)
+                                                                                  index_names, model, device, memory_budget)
 
     submission = {
         'version': 'rc2',
@@ -39,37 +38,30 @@ def generate_cirr_test_submissions(file_name, model, preprocess, device):
         json.dump(group_submission, file, sort_keys=True)
 
 
-def generate_cirr_test_dicts(relative_test_dataset, index_features, index_names, model, device):
+def generate_cirr_test_dicts(relative_test_dataset, index_features, index_names, model, device, memory_budget=512 * 1024 ** 2):
     # Generate predictions
     predicted_features, reference_names, group_members, pairs_id = \
         generate_cirr_test_predictions(relative_test_dataset, model, device)
 
     print(f"Compute CIRR prediction dicts")
 
-    # Normalize the index features
-    index_features = F.normalize(index_features, dim=-1).float()
-
-    # Compute the distances and sort the results
-    distances = 1 - predicted_features @ index_features.T
-    sorted_indices = torch.argsort(distances, dim=-1).cpu()
-    sorted_index_names = np.array(index_names)[sorted_indices]
-
-    # Delete the reference image from the results
-    reference_mask = torch.tensor(
-        sorted_index_names != np.repeat(np.array(reference_names), len(index_names)).reshape(len(sorted_index_names),
-                                                                                             -1))
-    sorted_index_names = sorted_index_names[reference_mask].reshape(sorted_index_names.shape[0],
-                                                                    sorted_index_names.shape[1] - 1)
-    # Compute the subset predictions
-    group_members = np.array(group_members)
-    group_mask = (sorted_index_names[..., None] == group_members[:, None, :]).sum(-1).astype(bool)
-    sorted_group_names = sorted_index_names[group_mask].reshape(sorted_index_names.shape[0], -1)
+    # Rank the 50 nearest images without the reference image, in blocks of scores bounded by memory_budget
+    rows = index_rows(index_names)
+    reference_ids = names_to_ids(rows, reference_names)
+    scorer = StreamingTopK(index_features, 50, memory_budget)
+    scorer.add(predicted_features, exclude_ids=reference_ids)
+    top_ids = scorer.topk_ids()
+
+    # Compute the subset predictions by ranking the group members only
+    group_ids = names_to_ids(rows, np.array(group_members).ravel().tolist()).view(len(reference_names), -1)
+    group_top_ids = rank_group_members(scorer.distances(predicted_features, group_ids), group_ids, exclude_ids=reference_ids)
 
     # Generate prediction dicts
-    pairid_to_predictions = {str(int(pair_id)): prediction[:50].tolist() for (pair_id, prediction) in
-                             zip(pairs_id, sorted_index_names)}
-    pairid_to_group_predictions = {str(int(pair_id)): prediction[:3].tolist() for (pair_id, prediction) in
-                                   zip(pairs_id, sorted_group_names)}
+    index_names = np.array(index_names)
+    pairid_to_predictions = {str(int(pair_id)): index_names[prediction[prediction >= 0].numpy()].tolist() for (pair_id, prediction) in
+                             zip(pairs_id, top_ids)}
+    pairid_to_group_predictions = {str(int(pair_id)): index_names[prediction[prediction >= 0][:3].numpy()].tolist()
+                                   for (pair_id, prediction) in zip(pairs_id, group_top_ids)}
 
     return pairid_to_predictions, pairid_to_group_predictions
 
@@ -122,7 +114,7 @@ def main():
 
     model.eval()
 
-    generate_cirr_test_submissions(cfg.submission_name, model, preprocess, device=device)
+    generate_cirr_test_submissions(cfg.submission_name, model, preprocess, device=device, memory_budget=cfg.eval_memory_budget)
 
 
 if __name__ == '__main__':
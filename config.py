@@ -20,6 +20,9 @@ class Config:
     num_epochs: int = 20
     save_best: bool = True 
     use_amp: bool = True 
+    text_cache_bytes: int = 0 # > 0 caches caption features while evaluating, see TransAgg.enable_text_cache
+    eval_memory_budget: int = 512 * 1024 ** 2 # bytes of one block of query x gallery scores, see utils.StreamingTopK
+    feature_cache_dir: str = 'feature_cache' # on-disk cache of the val gallery features of a frozen image encoder, None to disable, see feature_cache.py
     validation_frequency: int = 1
     comment: str = "fiq_test_template"
     dataset: str='fiq' # ['fiq', 'cirr']
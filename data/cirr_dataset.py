@@ -46,6 +46,7 @@ class CIRRDataset(Dataset):
         # get a mapping from image name to relative path
         with open(f'{self.cirr_path_prefix}/CIRR/cirr/image_splits/split.rc2.{split}.json') as f:
             self.name_to_relpath = json.load(f)
+        self.image_names = list(self.name_to_relpath.keys())
 
         print(f"CIRR {split} dataset in {mode} mode initialized")
 
@@ -77,9 +78,8 @@ class CIRRDataset(Dataset):
                     return pair_id, reference_name, rel_caption, group_members, reference_image 
 
             elif self.mode == 'classic':
-                image_name = list(self.name_to_relpath.keys())[index]
-                image_path = f"{self.cirr_path_prefix}/NLVR2/images/" + self.name_to_relpath[image_name][2:]
-                im = PIL.Image.open(image_path).convert("RGB")
+                image_name = self.image_names[index]
+                im = PIL.Image.open(self.image_path(image_name)).convert("RGB")
                 image = self.preprocess(im)
                 return image_name, image
 
@@ -89,6 +89,9 @@ class CIRRDataset(Dataset):
         except Exception as e:
             print(f"Exception: {e}")
 
+    def image_path(self, image_name: str) -> str:
+        return f"{self.cirr_path_prefix}/NLVR2/images/" + self.name_to_relpath[image_name][2:]
+
     def __len__(self):
         if self.mode == 'relative':
             return len(self.triplets)
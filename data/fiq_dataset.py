@@ -85,8 +85,7 @@ class FashionIQDataset(Dataset):
 
             elif self.mode == 'classic':
                 image_name = self.image_names[index]
-                image_path = f'{self.fiq_path_prefix}/Fashion-IQ/fashion-iq/images/{image_name}.jpg'
-                image = self.preprocess(PIL.Image.open(image_path))
+                image = self.preprocess(PIL.Image.open(self.image_path(image_name)))
                 return image_name, image
 
             else:
@@ -94,6 +93,9 @@ class FashionIQDataset(Dataset):
         except Exception as e:
             print(f"Exception: {e}")
 
+    def image_path(self, image_name: str) -> str:
+        return f'{self.fiq_path_prefix}/Fashion-IQ/fashion-iq/images/{image_name}.jpg'
+
     def __len__(self):
         if self.mode == 'relative':
             return len(self.triplets)
@@ -1,30 +1,155 @@
 import os
+import io
 import json
+import numpy as np
 import torch
 from PIL import Image
 from tqdm import tqdm
-from flask import Flask, request, jsonify, render_template_string, url_for, send_from_directory
-import random
+from flask import Flask, Response, request, jsonify, render_template_string, send_from_directory, stream_with_context
+from urllib.parse import quote
+import hashlib
+import hmac
+import threading
+import time
+import contextlib
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.formparser import FormDataParser
+from werkzeug.http import parse_options_header
+from werkzeug.utils import safe_join
 
 # --- Local Project Imports ---
 from config import Config
-from model.model import TransAgg
-from utils import get_preprocess, collate_fn
+from model.model import TransAgg, ReferenceState
+from utils import get_preprocess
 import model.clip as clip
+from cache import LRUCache
+from metrics import StageMetrics
+from search.embedding_store import EmbeddingStore, FingerprintMismatch, model_fingerprint, fingerprint_id
+from search.ann_index import BruteForceIndex, build_index, chunked_topk, measure_recall, recall_report
+from search.batching import MicroBatcher
+from search.row_blocks import RowBlocks
+from search.sharding import ShardedSearch
+from search.thumbnails import ThumbnailStore
+from search.quantization import QUANTIZERS
 
 # --- 1. CONFIGURATION ---
 TRAINED_MODEL_PATH = "D:/Documents 2.0/5th semester/computer vision/Vision Project/epoch_10_laion_combined.pth"
 FASHION_IQ_BASE_PATH = "D:/Documents 2.0/5th semester/computer vision/Vision Project/fig"
 # --- EDIT: Added new, empty categories ---
 CATALOG_CATEGORIES = ['shirt', 'dress', 'household', 'toys']
+PRODUCT_IMAGE_DIR = os.path.join(FASHION_IQ_BASE_PATH, 'Fashion-IQ', 'fashion-iq', 'images')
+NUM_INITIAL_PRODUCTS = 50
+# Gallery embeddings are persisted here and only re-encoded for new or modified images
+EMBEDDING_STORE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'embedding_store')
+# Gallery encoding: the categories are indexed concurrently, their images decoded by GALLERY_DECODE_THREADS shared
+# threads and encoded by a single consumer in batches of up to GALLERY_BATCH_SIZE that mix the categories
+GALLERY_DECODE_THREADS = 8
+GALLERY_BATCH_SIZE = 64
+GALLERY_BATCH_WAIT_MS = 20.0
+# Nearest-neighbour backend, one of search.ann_index.INDEX_BACKENDS. The recall/latency knob is nprobe for
+# 'ivf'/'faiss_ivf' and ef_search for 'hnsw'/'faiss_hnsw'; 'brute_force' is exact. 'sq8' (1 byte per dimension) and
+# 'pq' (num_subspaces bytes per product) keep only compressed codes in memory, rerank re-scores that many candidates
+# against the float embeddings, e.g. ANN_BACKEND = 'pq'; ANN_PARAMS = {'num_subspaces': 32, 'rerank': 100}
+ANN_BACKEND = 'ivf'
+ANN_PARAMS = {'nprobe': 8}
+# Default number of results per page. A search only asks the ANN index for its first page; the first request of a next
+# page (/visual-search-page?cursor=...) ranks the SEARCH_CANDIDATES best products once and the following pages are
+# slices of them, so k can go up to SEARCH_CANDIDATES. Only that deeper query pays for the depth: 'ivf' probes
+# partitions beyond nprobe until they hold that many, 'hnsw' explores max(ef_search, SEARCH_CANDIDATES) nodes
+SEARCH_TOP_K = 20
+SEARCH_CANDIDATES = 500
+# Category value of "search all departments" queries, which fan out to every category shard in parallel
+ALL_CATEGORIES = 'all'
+SHARD_SEARCH_THREADS = 8
+# Offline batch search (/batch-search and batch_search.py): jobs per model call and streamed chunk, largest k, gallery
+# rows scored at once by the exact search and reference decoding threads
+BATCH_JOB_CHUNK = 64
+BATCH_JOB_MAX_K = 1000
+BATCH_JOB_SCORE_ROWS = 65536
+BATCH_JOB_DECODE_THREADS = 8
+# Uploaded reference images (/visual-search-upload): largest request body, largest image in pixels, accepted formats
+UPLOAD_MAX_BYTES = 10 * 1024 ** 2
+UPLOAD_MAX_PIXELS = 40_000_000
+UPLOAD_FORMATS = ('JPEG', 'PNG', 'WEBP')
+# Concurrent /visual-search requests are coalesced into one model and index call
+BATCH_MAX_SIZE = 16
+BATCH_MAX_WAIT_MS = 5.0
+# Startup warm-up: synthetic batches of each size run through the model and the search of every category, in rounds of
+# WARMUP_ROUND_CALLS, until the p99 latency of a round is within WARMUP_TOLERANCE of the previous round's (at most
+# WARMUP_MAX_ROUNDS rounds); /readyz reports ready only afterwards. An empty WARMUP_BATCH_SIZES skips the warm-up
+WARMUP_BATCH_SIZES = (1, BATCH_MAX_SIZE)
+WARMUP_ROUND_CALLS = 8
+WARMUP_MAX_ROUNDS = 5
+WARMUP_TOLERANCE = 0.2
+# Ranked candidates (product records) of recent queries, keyed on a hash of (reference, normalized text, category)
+# and the version of the searched indexes. They serve repeated queries and the next pages of a search; entries expire
+# after RESULT_CACHE_TTL_S, bounding how long a result cursor stays valid, so popular queries still get fresh product data
+RESULT_CACHE_BYTES = 128 * 1024 ** 2
+RESULT_CACHE_TTL_S = 300.0
+# ReferenceState (global and patch features) of reference images, filled by the gallery pass and by searches
+REFERENCE_CACHE_BYTES = 256 * 1024 ** 2
+# ModificationState of modifier texts, keyed on the normalized text
+TEXT_CACHE_BYTES = 64 * 1024 ** 2
+# Resized product images served to the product grid, generated at indexing time
+THUMBNAIL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'thumbnails')
+THUMBNAIL_SIZE = 320
+THUMBNAIL_CACHE_BYTES = 64 * 1024 ** 2
+# How often a running server checks the embedding store for a newer generation, 0 disables reloading
+INDEX_RELOAD_INTERVAL_S = 5.0
+# A category is compacted into a new generation once this fraction of its rows is tombstoned or it has this many appended segments
+COMPACT_DELETED_RATIO = 0.2
+COMPACT_MAX_SEGMENTS = 16
+# Shared secret expected in the X-Admin-Token header of the catalog admin endpoints, which are disabled when unset
+ADMIN_TOKEN = os.environ.get('STYLENSTAY_ADMIN_TOKEN')
+
+# Per-stage latency histograms exported on /metrics along with cache, queue and index gauges; when disabled the
+# stage timers are no-ops and /metrics only reports the gauges
+METRICS_ENABLED = True
 
 # --- Global Variables ---
 app = Flask(__name__)
 model = None
 preprocess = None
 device = None
-index_features = {}
-index_paths = {}
+image_size = None
+store = None
+category_indexes = {}
+search_batcher = None
+index_watcher = None
+index_update_locks = {category: threading.Lock() for category in CATALOG_CATEGORIES}
+reference_cache = LRUCache(REFERENCE_CACHE_BYTES)
+result_cache = LRUCache(RESULT_CACHE_BYTES, ttl=RESULT_CACHE_TTL_S)
+metrics = StageMetrics('stylenstay', enabled=METRICS_ENABLED)
+shard_search = ShardedSearch(SHARD_SEARCH_THREADS, metrics)
+decode_pool = ThreadPoolExecutor(BATCH_JOB_DECODE_THREADS, thread_name_prefix='decode')
+thumbnails = ThumbnailStore(THUMBNAIL_DIR, PRODUCT_IMAGE_DIR, size=THUMBNAIL_SIZE, cache_bytes=THUMBNAIL_CACHE_BYTES)
+model_key = None
+# p99 latencies reached by the warm-up, per batch size for the model and per category for the search
+warmup_report = {'model': {}, 'search': {}}
+warmup_done = False
+
+# Everything a search needs for one category shard. paths and products are RowBlocks over the memory-mapped store
+# segments, shared by every process serving the store. New revisions of the generation are applied in place under
+# lock, a new generation swaps the whole entry.
+class CategoryIndex(namedtuple('CategoryIndex', ['generation', 'revision', 'num_segments', 'paths', 'features', 'products', 'index', 'lock'])):
+    def search(self, queries, k):
+        with self.lock: return self.index.search(queries, k)
+
+    def exact_search(self, queries, k):
+        # the scan runs outside the lock on the rows present when it started, rows are only ever appended
+        with self.lock: features, deleted = RowBlocks(self.features.blocks), self.index.deleted.copy()
+        return chunked_topk(queries, features, k, BATCH_JOB_SCORE_ROWS, deleted)
+
+    def gather(self, rows):
+        with self.lock: return self.products[rows]
+
+# reference_state is the cached ReferenceState of the reference, image the preprocessed image on a cache miss
+SearchQuery = namedtuple('SearchQuery', ['reference_key', 'reference_state', 'image', 'text', 'category', 'k'])
+# Result cache entry of a search. query keeps the query features while only the first page is ranked, it is None once
+# the SEARCH_CANDIDATES deep ranking was run or when there is nothing more to find
+SearchCandidates = namedtuple('SearchCandidates', ['records', 'categories', 'query', 'category'])
 
 # --- HTML & Frontend Template ---
 HTML_TEMPLATE = """
@@ -90,6 +215,10 @@ HTML_TEMPLATE = """
                      <div id="category-selector" class="flex justify-center space-x-2"></div>
                 </div>
                 <div class="flex items-center gap-x-6">
+                    <label class="text-gray-600 hover:text-indigo-600 cursor-pointer" title="Search with your own photo">
+                        <i data-lucide="camera"></i>
+                        <input type="file" id="upload-input" accept="image/jpeg,image/png,image/webp" class="hidden">
+                    </label>
                     <a href="#" class="text-gray-600 hover:text-indigo-600 relative">
                         <i data-lucide="heart"></i>
                         <span id="wishlist-counter" class="absolute -top-2 -right-2 bg-red-500 text-white text-xs rounded-full h-5 w-5 flex items-center justify-center">0</span>
@@ -129,16 +258,19 @@ HTML_TEMPLATE = """
 
             <div id="product-gallery" class="grid grid-cols-2 sm:grid-cols-3 md:grid-cols-4 lg:grid-cols-5 gap-6"></div>
             <div id="gallery-loader" class="mx-auto loader mt-8"></div>
+            <button id="load-more-btn" class="hidden mx-auto mt-8 block bg-white border border-gray-300 text-gray-700 font-semibold py-2 px-6 rounded-full hover:bg-gray-100 transition">Load more</button>
         </main>
     </div>
 
 <script>
     let currentReferenceImage = null;
+    let currentUpload = null;
     let allProducts = [];
+    let nextCursor = null;
     const modal=document.getElementById('search-modal'),modalImage=document.getElementById('modal-image'),textInput=document.getElementById('text-input'),searchBtn=document.getElementById('search-btn'),modalLoader=document.getElementById('modal-loader'),modalError=document.getElementById('modal-error'),productGallery=document.getElementById('product-gallery'),galleryLoader=document.getElementById('gallery-loader'),categorySelector=document.getElementById('category-selector'),wishlistCounter=document.getElementById('wishlist-counter'),cartCounter=document.getElementById('cart-counter'),sortSelect=document.getElementById('sort-select');
 
     function getSelectedCategory(){return document.querySelector('input[name="category"]:checked')?.value||null}
-    function openModal(a){currentReferenceImage=a;modalImage.src=a;modal.classList.remove('hidden');textInput.value='';modalError.classList.add('hidden')}
+    function openModal(a,f=null){currentReferenceImage=a;currentUpload=f;modalImage.src=a;modal.classList.remove('hidden');textInput.value='';modalError.classList.add('hidden')}
     function closeModal(){modal.classList.add('hidden')}
 
     async function performSearch(){
@@ -146,7 +278,15 @@ HTML_TEMPLATE = """
         if(!a){modalError.textContent='Please enter a modification.';modalError.classList.remove('hidden');return}
         if(!b){modalError.textContent='Please select a category.';modalError.classList.remove('hidden');return}
         modalLoader.classList.remove('hidden');searchBtn.disabled=!0;modalError.classList.add('hidden');
-        try{const c=await fetch('/visual-search',{method:'POST',headers:{'Content-Type':'application/json'},body:JSON.stringify({image_path:currentReferenceImage,text:a,category:b})}),d=await c.json();d.error?(modalError.textContent=d.error,modalError.classList.remove('hidden')):d.results&&(allProducts=d.results,displayResults(allProducts),closeModal())}catch(c){modalError.textContent='A network error occurred.';modalError.classList.remove('hidden')}finally{modalLoader.classList.add('hidden');searchBtn.disabled=!1}
+        let f;if(currentUpload){f=new FormData();f.append('image',currentUpload);f.append('text',a);f.append('category',b)}
+        try{const c=await (currentUpload?fetch('/visual-search-upload',{method:'POST',body:f}):fetch('/visual-search',{method:'POST',headers:{'Content-Type':'application/json'},body:JSON.stringify({image_path:currentReferenceImage,text:a,category:b})})),d=await c.json();d.error?(modalError.textContent=d.error,modalError.classList.remove('hidden')):d.results&&(allProducts=d.results,setNextCursor(d.next_cursor),displayResults(allProducts),closeModal())}catch(c){modalError.textContent='A network error occurred.';modalError.classList.remove('hidden')}finally{modalLoader.classList.add('hidden');searchBtn.disabled=!1}
+    }
+
+    const loadMoreBtn=document.getElementById('load-more-btn');
+    function setNextCursor(a){nextCursor=a||null;loadMoreBtn.classList.toggle('hidden',!nextCursor)}
+    async function loadMore(){
+        if(!nextCursor)return;loadMoreBtn.disabled=!0;
+        try{const a=await fetch(`/visual-search-page?cursor=${encodeURIComponent(nextCursor)}`),b=await a.json();b.error?setNextCursor(null):(allProducts=allProducts.concat(b.results),b.results.forEach(c=>productGallery.appendChild(createProductCard(c))),setNextCursor(b.next_cursor))}finally{loadMoreBtn.disabled=!1}
     }
 
     function displayResults(a){productGallery.innerHTML='';a.forEach(b=>productGallery.appendChild(createProductCard(b)));document.documentElement.scrollTop=0}
@@ -165,7 +305,7 @@ HTML_TEMPLATE = """
 
         card.innerHTML = `
             <div class="relative aspect-square overflow-hidden">
-                <img src="${product.path}" class="w-full h-full object-cover product-image transition-transform duration-300">
+                <img src="${product.thumbnail}" loading="lazy" class="w-full h-full object-cover product-image transition-transform duration-300">
                 ${badgeHTML}
                 <button class="absolute top-2 right-2 text-gray-300 hover:text-red-500 wishlist-btn" onclick="toggleWishlist(this, event)">
                     <i data-lucide="heart" class="w-6 h-6"></i>
@@ -175,6 +315,7 @@ HTML_TEMPLATE = """
                 </div>
             </div>
             <div class="p-4 flex flex-col flex-grow">
+                <p class="text-xs text-indigo-500 uppercase tracking-wide">${product.category}</p>
                 <h3 class="font-semibold text-sm text-gray-700 truncate">${product.name}</h3>
                 <div class="flex items-center mt-2">
                     <div class="flex">${starHTML}</div>
@@ -207,6 +348,7 @@ HTML_TEMPLATE = """
     async function loadInitialProducts(category) {
         galleryLoader.classList.remove('hidden');
         productGallery.innerHTML = '';
+        setNextCursor(null);
         try {
             const response = await fetch(`/get-initial-products?category=${category}`);
             const data = await response.json();
@@ -226,6 +368,12 @@ HTML_TEMPLATE = """
     
     sortSelect.addEventListener('change', (e) => sortProducts(e.target.value));
     searchBtn.addEventListener('click', performSearch);
+    loadMoreBtn.addEventListener('click', loadMore);
+    document.getElementById('upload-input').addEventListener('change', (e) => {
+        const file = e.target.files[0];
+        if (file) openModal(URL.createObjectURL(file), file);
+        e.target.value = '';
+    });
     
     window.addEventListener('DOMContentLoaded', async () => {
         lucide.createIcons();
@@ -282,50 +430,138 @@ HTML_TEMPLATE = """
 """
 
 # --- Backend Logic ---
+# Framework independent, shared by the Flask routes below and the ASGI front end in ecommerce_asgi.py
 
-class GalleryDataset(torch.utils.data.Dataset):
-    def __init__(self, paths, preprocess_fn):
-        self.paths = paths
-        self.preprocess_fn = preprocess_fn
-    def __len__(self): return len(self.paths)
-    def __getitem__(self, idx):
-        try:
-            image = Image.open(self.paths[idx]).convert("RGB")
-            return self.preprocess_fn(image)
-        except Exception: return None
-
-def generate_product_details(image_path):
-    """Generates random mock data for a product."""
-    original_price = random.uniform(25.0, 150.0)
-    discount = random.uniform(0.1, 0.4) if random.random() > 0.5 else 0
-    price = original_price * (1 - discount)
-    
-    badge_type = 'none'
-    badge_text = ''
-    if discount > 0:
-        badge_type = 'sale'
-        badge_text = f"{int(discount * 100)}% OFF"
-    elif random.random() > 0.8:
-        badge_type = 'new'
-        badge_text = 'New'
-    elif random.random() > 0.7:
-        badge_type = 'trending'
-        badge_text = 'Trending'
+class SearchRequestError(ValueError):
+    """Invalid search request, reported to the client as a 400"""
 
-    return {
-        'path': url_for('serve_product_image', filename=os.path.basename(image_path)),
-        'name': os.path.basename(image_path).replace('.jpg', '').replace('_', ' ').title(),
+class UploadTooLargeError(SearchRequestError):
+    """Upload above UPLOAD_MAX_BYTES or UPLOAD_MAX_PIXELS, reported to the client as a 413"""
+
+class CursorExpiredError(SearchRequestError):
+    """Result page of a search no longer in the result cache, reported to the client as a 410"""
+
+class AdminAuthError(PermissionError):
+    """Missing or wrong admin token, reported to the client as a 403"""
+
+def product_image_url(image_path):
+    return '/products/' + quote(os.path.basename(image_path))
+
+def thumbnail_url(product_url):
+    return '/thumbs/' + product_url[len('/products/'):]
+
+# Mock catalog data, one fixed-size record per gallery row stored next to the embeddings. Strings are UTF-8, the image
+# file name fits whole in NAME_MAX (255) bytes and the display name is cut on a character boundary
+PRODUCT_DTYPE = np.dtype([('name', 'S64'), ('file', 'S255'), ('price', 'f4'), ('original_price', 'f4'), ('rating', 'f4'),
+                          ('reviews', 'i4'), ('sold', 'i4'), ('badge', 'u1'), ('discount_pct', 'u1')])
+BADGE_TYPES = ['none', 'sale', 'new', 'trending']
+BADGE_TEXTS = ['', '', 'New', 'Trending'] # sale badges show the discount
+
+def uniform_draws(keys, num_draws):
+    """splitmix64 streams seeded by keys, returns (len(keys), num_draws) floats in [0, 1)"""
+    state = np.asarray(keys, dtype=np.uint64)
+    draws = np.empty((len(state), num_draws))
+    for j in range(num_draws):
+        state = state + np.uint64(0x9E3779B97F4A7C15)
+        z = (state ^ (state >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        draws[:, j] = (z ^ (z >> np.uint64(31))) >> np.uint64(11)
+    return draws / float(1 << 53)
+
+def fixed_width(texts, size):
+    """UTF-8 encodings of texts cut to at most size bytes, never inside a multi-byte character"""
+    return [text.encode()[:size].decode('utf-8', 'ignore').encode() for text in texts]
+
+def build_product_table(image_paths):
+    """Generates mock data for products, seeded by the file name so a product looks the same everywhere."""
+    names = [os.path.basename(str(path)) for path in image_paths]
+    keys = [int.from_bytes(hashlib.blake2b(name.encode(), digest_size=8).digest(), 'little') for name in names]
+    u = uniform_draws(keys, 8)
+    table = np.zeros(len(names), dtype=PRODUCT_DTYPE)
+    table['name'] = fixed_width([name.replace('.jpg', '').replace('_', ' ').title() for name in names], PRODUCT_DTYPE['name'].itemsize)
+    table['file'] = fixed_width(names, PRODUCT_DTYPE['file'].itemsize)
+    table['original_price'] = 25.0 + 125.0 * u[:, 0]
+    discount = np.where(u[:, 1] > 0.5, 0.1 + 0.3 * u[:, 2], 0.0)
+    table['price'] = table['original_price'] * (1 - discount)
+    table['discount_pct'] = (discount * 100).astype(np.uint8)
+    table['badge'] = np.where(discount > 0, 1, np.where(u[:, 3] > 0.8, 2, np.where(u[:, 4] > 0.7, 3, 0)))
+    table['rating'] = np.round((3.5 + 1.5 * u[:, 5]) * 2) / 2 # Round to nearest 0.5
+    table['reviews'] = 10 + (491 * u[:, 6]).astype(np.int32)
+    table['sold'] = 100 + (9901 * u[:, 7]).astype(np.int32)
+    return table
+
+def render_products(records, categories, scores=None):
+    """Product cards of records gathered from the product tables of categories, with their similarity if given"""
+    columns = [records[field].tolist() for field in PRODUCT_DTYPE.names] + [np.asarray(categories).tolist()]
+    cards = [{
+        'category': category,
+        'path': product_image_url(file.decode('utf-8', 'replace')),
+        'thumbnail': thumbnail_url(product_image_url(file.decode('utf-8', 'replace'))),
+        'name': name.decode('utf-8', 'replace'),
         'price': price,
         'originalPrice': original_price,
-        'rating': round(random.uniform(3.5, 5.0) * 2) / 2, # Round to nearest 0.5
-        'reviews': random.randint(10, 500),
-        'sold': random.randint(100, 10000),
-        'badge': { 'type': badge_type, 'text': badge_text }
-    }
+        'rating': rating,
+        'reviews': reviews,
+        'sold': sold,
+        'badge': {'type': BADGE_TYPES[badge], 'text': f"{discount_pct}% OFF" if badge == 1 else BADGE_TEXTS[badge]}
+    } for name, file, price, original_price, rating, reviews, sold, badge, discount_pct, category in zip(*columns)]
+    if scores is not None:
+        for card, score in zip(cards, np.asarray(scores).tolist()): card['score'] = score
+    return cards
 
-def load_model_and_index():
-    """Loads model and pre-computes indexes for multiple categories"""
-    global model, preprocess, device, index_features, index_paths
+def load_gallery_image(path):
+    """Decoded and preprocessed gallery image, None if it cannot be read"""
+    try: return preprocess(Image.open(path).convert("RGB"))
+    except Exception: return None
+
+def encode_gallery_batch(images):
+    """Gallery encoder batch: (features, ReferenceState row) of each preprocessed image"""
+    with torch.no_grad():
+        reference_state = model.encode_reference(torch.stack(images).to(device))
+    return list(zip(reference_state.features.float().cpu().numpy(), reference_state.unbind()))
+
+@contextlib.contextmanager
+def gallery_pipeline():
+    """Decode threads and single batched encoder shared by the categories encoded concurrently. They only live for the
+    duration of an update, threads do not survive the fork of the pre-forked workers"""
+    with ThreadPoolExecutor(GALLERY_DECODE_THREADS, thread_name_prefix='gallery-decode') as decoder, \
+            contextlib.closing(MicroBatcher(encode_gallery_batch, GALLERY_BATCH_SIZE, GALLERY_BATCH_WAIT_MS, name='gallery-encoder')) as encoder:
+        yield decoder, encoder
+
+def encode_gallery_images(paths, desc="Indexing", pipeline=None, position=0):
+    """Encodes gallery images, returns (features, ok) where ok masks the images that could be decoded. Up to
+    GALLERY_BATCH_SIZE images are decoded ahead and as many wait for the encoder, which bounds the memory held"""
+    if pipeline is None:
+        with gallery_pipeline() as pipeline: return encode_gallery_images(paths, desc, pipeline, position)
+    decoder, encoder = pipeline
+    features = np.empty((len(paths), model.feature_dim), dtype=np.float32)
+    ok = np.zeros(len(paths), dtype=bool)
+    decoding, encoding = deque(), deque()
+
+    def finish_encode():
+        i, future = encoding.popleft()
+        features[i], row = future.result()
+        ok[i] = True
+        reference_cache.put((paths[i], model_key), row, evict=False)
+
+    def finish_decode():
+        i, future = decoding.popleft()
+        image = future.result()
+        if image is not None: encoding.append((i, encoder.submit(image)))
+        while len(encoding) > GALLERY_BATCH_SIZE or (encoding and encoding[0][1].done()): finish_encode()
+        progress.update(1)
+
+    with tqdm(total=len(paths), desc=desc, position=position) as progress:
+        for i, path in enumerate(paths):
+            decoding.append((i, decoder.submit(load_gallery_image, path)))
+            if len(decoding) > GALLERY_BATCH_SIZE: finish_decode()
+        while decoding: finish_decode()
+        while encoding: finish_encode()
+    return features[ok], ok
+
+def load_model():
+    """Loads the trained model, its preprocess pipeline and opens the embedding store"""
+    global model, preprocess, device, image_size, model_key, store
     print("--- Initializing E-commerce Visual Search ---")
     cfg = Config(); cfg.model_name = "clip-Vit-B/32"; cfg.encoder = "text"; device = cfg.device
     print(f"Using device: {device}")
@@ -333,83 +569,606 @@ def load_model_and_index():
     if not os.path.exists(TRAINED_MODEL_PATH): raise FileNotFoundError(f"Trained model not found at: {TRAINED_MODEL_PATH}")
     print(f"Loading trained weights from: {TRAINED_MODEL_PATH}")
     model.load_state_dict(torch.load(TRAINED_MODEL_PATH, map_location=device), strict=False)
-    model.eval(); print("Model loaded successfully.")
-    input_dim = model.pretrained_model.visual.input_resolution
+    model.eval(); model.enable_text_cache(TEXT_CACHE_BYTES); model.enable_metrics(metrics); print("Model loaded successfully.")
+    # CUDA kernels run asynchronously, a stage is only over once the device is done with it
+    if str(device).startswith('cuda'): metrics.sync_fn = torch.cuda.synchronize
+    input_dim = image_size = model.pretrained_model.visual.input_resolution
     preprocess = get_preprocess(cfg, model, input_dim)
-    
-    for category in CATALOG_CATEGORIES:
-        print(f"\n--- Building index for category: '{category}' ---")
-        gallery_path = os.path.join(FASHION_IQ_BASE_PATH, 'Fashion-IQ', 'fashion-iq', 'images')
-        split_file = os.path.join(FASHION_IQ_BASE_PATH, 'Fashion-IQ', 'fashion-iq', 'image_splits', f'split.{category}.val.json')
-        if not os.path.exists(split_file): print(f"Warning: Split file for '{category}' not found. Skipping."); continue
+    fingerprint = model_fingerprint(cfg, TRAINED_MODEL_PATH, input_dim)
+    model_key = fingerprint_id(fingerprint)
+    store = EmbeddingStore(EMBEDDING_STORE_DIR, fingerprint, metadata_fn=build_product_table)
+
+def category_image_paths(category):
+    """Catalog split of the category with the images added or removed through the admin endpoints"""
+    split_file = os.path.join(FASHION_IQ_BASE_PATH, 'Fashion-IQ', 'fashion-iq', 'image_splits', f'split.{category}.val.json')
+    overrides = store.overrides(category)
+    if not os.path.exists(split_file) and not overrides['added']: return None
+    category_image_names = []
+    if os.path.exists(split_file):
         with open(split_file, 'r') as f: category_image_names = json.load(f)
-        all_image_paths = [os.path.join(gallery_path, name + ".jpg") for name in category_image_names]
-        valid_image_paths = [p for p in all_image_paths if os.path.exists(p)]
-        if not valid_image_paths: print(f"Warning: No valid images found for '{category}'."); continue
-        dataset = GalleryDataset(valid_image_paths, preprocess)
-        dataloader = torch.utils.data.DataLoader(dataset, batch_size=64, num_workers=0, collate_fn=collate_fn)
-        features_list = []
+    removed = set(overrides['removed'])
+    paths = [os.path.join(PRODUCT_IMAGE_DIR, name + ".jpg") for name in category_image_names] + overrides['added']
+    return [path for path in dict.fromkeys(paths) if path not in removed]
+
+def update_category_store(category, pipeline, position=0):
+    """Encodes the new or modified gallery images of a category into the embedding store"""
+    print(f"\n--- Building index for category: '{category}' ---")
+    all_image_paths = category_image_paths(category)
+    if all_image_paths is None: print(f"Warning: Split file for '{category}' not found. Skipping."); return
+    snapshot = store.update(category, all_image_paths, lambda paths: encode_gallery_images(paths, f"Indexing {category}", pipeline, position))
+    if snapshot is None: print(f"Warning: No valid images found for '{category}'."); return
+    # the stored images are those that exist and decode, their stats were checked by the update
+    live = snapshot.live_rows()
+    print(f"Generated {thumbnails.generate(snapshot.paths[live], snapshot.stats[live])} thumbnails for '{category}'.")
+
+def update_store():
+    """Encodes the new or modified gallery images of every category into the embedding store, the categories
+    concurrently so that the decode threads of one keep the encoder busy while another scans its files"""
+    with gallery_pipeline() as pipeline, ThreadPoolExecutor(len(CATALOG_CATEGORIES), thread_name_prefix='index') as executor:
+        list(executor.map(update_category_store, CATALOG_CATEGORIES, [pipeline] * len(CATALOG_CATEGORIES), range(len(CATALOG_CATEGORIES))))
+
+def open_index(category, snapshot):
+    """Builds the search index of a store generation, then applies its later revisions"""
+    base = snapshot.segments[0]
+    index = build_index(ANN_BACKEND, base.features, **ANN_PARAMS)
+    if ANN_BACKEND != 'brute_force':
+        sample = base.features[np.random.default_rng(0).choice(len(base.features), min(100, len(base.features)), replace=False)]
+        # first pages are served at SEARCH_TOP_K, the next ones from the SEARCH_CANDIDATES deep ranking
+        exact_index = BruteForceIndex(base.features)
+        recalls = {k: measure_recall(index, exact_index, sample, k) for k in (SEARCH_TOP_K, SEARCH_CANDIDATES)}
+        print(f"'{category}' {ANN_BACKEND} index vs brute force: " + ', '.join(f'recall@{k} {recall:.3f}' for k, recall in recalls.items()))
+        # the next pages of a search are its SEARCH_CANDIDATES best hits, the index has to return that many
+        depth = int((index.search(sample[:10], SEARCH_CANDIDATES)[1] >= 0).sum(axis=1).min())
+        if depth < min(SEARCH_CANDIDATES, len(base.features)): print(f"Warning: '{category}' {ANN_BACKEND} index returns only {depth} of the {SEARCH_CANDIDATES} search candidates, later result pages will be empty")
+        if ANN_BACKEND in QUANTIZERS:
+            # compressed codes against the float gallery they replace: recall, memory and latency on the same queries
+            report = recall_report(base.features, sample, SEARCH_TOP_K, {'float32': ('brute_force', {}), ANN_BACKEND: (ANN_BACKEND, ANN_PARAMS)})
+            for name, row in report.items(): print(f"'{category}' {name}: recall@{SEARCH_TOP_K} {row['recall']:.3f}, {row['bytes_per_vector']} bytes per product, {row['search_ms']:.2f} ms per query")
+    category_index = CategoryIndex(snapshot.generation, 0, 1, RowBlocks([base.paths]), RowBlocks([base.features]),
+                                   RowBlocks([base.metadata]), index, threading.Lock())
+    category_indexes[category] = apply_revision(category_index, snapshot)
+    print(f"'{category}' index loaded with {len(snapshot)} items (store generation {snapshot.generation}).")
+
+def apply_revision(category_index, snapshot):
+    """Adds the segments appended and removes the rows tombstoned since category_index was last updated"""
+    with category_index.lock:
+        for segment in snapshot.segments[category_index.num_segments:]:
+            category_index.index.add(segment.features)
+            category_index.paths.append(segment.paths)
+            category_index.features.append(segment.features)
+            category_index.products.append(segment.metadata)
+        removed = np.flatnonzero(snapshot.deleted & ~category_index.index.deleted)
+        if len(removed): category_index.index.remove(removed)
+    return category_index._replace(revision=snapshot.revision, num_segments=len(snapshot.segments))
+
+def refresh_index(category):
+    """Brings the index of a category up to date with the live store revision"""
+    with index_update_locks[category]:
+        try:
+            snapshot = store.load(category)
+        except FingerprintMismatch as e:
+            print(f"Warning: ignoring embedding store for '{category}': {e}"); return
+        if snapshot is None: return
+        current = category_indexes.get(category)
+        if current is None or current.generation != snapshot.generation: open_index(category, snapshot)
+        elif current.revision != snapshot.revision: category_indexes[category] = apply_revision(current, snapshot)
+
+def open_indexes():
+    """Opens every category from the store and starts the search scheduler and the store watcher"""
+    global search_batcher, index_watcher
+    # the indexes of the categories are built concurrently, index training releases the GIL in numpy
+    with ThreadPoolExecutor(len(CATALOG_CATEGORIES), thread_name_prefix='index') as executor:
+        list(executor.map(refresh_index, CATALOG_CATEGORIES))
+    if search_batcher is None:
+        search_batcher = MicroBatcher(search_batch, max_batch_size=BATCH_MAX_SIZE, max_wait_ms=BATCH_MAX_WAIT_MS)
+    if index_watcher is None and INDEX_RELOAD_INTERVAL_S > 0:
+        index_watcher = threading.Thread(target=watch_store, name='index-watcher', daemon=True)
+        index_watcher.start()
+
+def watch_store():
+    """Applies store changes made by other processes: new generations, appended or removed products"""
+    while True:
+        time.sleep(INDEX_RELOAD_INTERVAL_S)
+        for category in CATALOG_CATEGORIES:
+            try:
+                head = store.head(category)
+                current = category_indexes.get(category)
+                if head is not None and (current is None or (current.generation, current.revision) != head):
+                    print(f"Store revision {head} of '{category}' published, reloading.")
+                    refresh_index(category)
+            except Exception as e: print(f"Error reloading '{category}': {e}")
+
+def measure_until_stable(fn):
+    """Calls fn in rounds until the p99 latency of a round is within WARMUP_TOLERANCE of the previous round's,
+    returns {'p99_ms', 'rounds', 'stable'} of the last round"""
+    previous = None
+    for rounds in range(1, WARMUP_MAX_ROUNDS + 1):
+        latencies = []
+        for _ in range(WARMUP_ROUND_CALLS):
+            start = time.perf_counter(); fn(); latencies.append(time.perf_counter() - start)
+        p99 = float(np.percentile(latencies, 99))
+        stable = previous is not None and abs(p99 - previous) <= WARMUP_TOLERANCE * previous
+        if stable: break
+        previous = p99
+    return {'p99_ms': round(p99 * 1000, 3), 'rounds': rounds, 'stable': stable}
+
+def warm_up():
+    """Runs synthetic batches through combine_features and through the search of every category, so that kernel
+    selection, allocator growth and the page faults of the memory-mapped gallery are paid before the first request"""
+    global warmup_done
+    # the synthetic queries neither fill the text cache, which would skip the text encoder after the first call, nor
+    # the stage histograms
+    text_cache, model.text_cache = model.text_cache, None
+    metrics_enabled, metrics.enabled = metrics.enabled, False
+    try:
         with torch.no_grad():
-            for batch_images in tqdm(dataloader, desc=f"Indexing {category}"):
-                batch_images = batch_images.to(device)
-                encoded_output = model.pretrained_model.encode_image(batch_images)
-                features = encoded_output[0] if isinstance(encoded_output, tuple) else encoded_output
-                features_list.append(features.cpu())
-        if not features_list: continue
-        index_features[category] = torch.cat(features_list, dim=0).to(device)
-        index_paths[category] = valid_image_paths
-        print(f"'{category}' index created with {len(valid_image_paths)} items.")
+            for batch_size in WARMUP_BATCH_SIZES:
+                images = torch.randn(batch_size, 3, image_size, image_size, device=device)
+                texts = ['is darker with longer sleeves'] * batch_size
+                warmup_report['model'][batch_size] = measure_until_stable(lambda: model.combine_features(images, texts).cpu())
+                print(f"Warm-up of the model with batches of {batch_size}: {warmup_report['model'][batch_size]}")
+        rng = np.random.default_rng(0)
+        for category in list(category_indexes) + [ALL_CATEGORIES] if category_indexes else []:
+            report = {}
+            for batch_size in WARMUP_BATCH_SIZES:
+                queries = rng.standard_normal((batch_size, model.feature_dim)).astype(np.float32)
+                queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+                report[batch_size] = measure_until_stable(lambda: search_shards(queries, [category] * batch_size, [SEARCH_TOP_K] * batch_size))
+            warmup_report['search'][category] = report
+            print(f"Warm-up of the '{category}' search: {report}")
+    finally:
+        model.text_cache = text_cache
+        metrics.enabled = metrics_enabled
+    warmup_done = True
+
+def get_readiness():
+    """Returns (ready, report) of /readyz. The service is ready once the indexes are open and warmed up; a category is
+    'loading' until startup is over, then 'warming' until its search is warmed up, 'ready' or 'unavailable'"""
+    categories = {}
+    for category in CATALOG_CATEGORIES:
+        entry = category_indexes.get(category)
+        if entry is None: status = 'unavailable' if warmup_done else 'loading'
+        elif not warmup_done and category not in warmup_report['search']: status = 'warming'
+        else: status = 'ready'
+        categories[category] = {'status': status, 'items': len(entry.index) if entry is not None else 0}
+    ready = warmup_done and bool(category_indexes) and search_batcher is not None
+    return ready, {'ready': ready, 'model_loaded': model is not None, 'categories': categories, 'warmup': warmup_report}
+
+def load_model_and_index():
+    """Loads model and pre-computes indexes for multiple categories"""
+    load_model()
+    update_store()
+    open_indexes()
+    warm_up()
     print("\n--- Application Ready ---")
 
+def search_batch(queries):
+    """Runs a batch of SearchQuery, returns (product records, categories, scores, query features) of the top-k hits of each"""
+    references = [query.reference_state for query in queries]
+    misses = [i for i, reference in enumerate(references) if reference is None]
+    with torch.no_grad():
+        if misses:
+            images = torch.stack([queries[i].image for i in misses]).to(device)
+            for i, row in zip(misses, model.encode_reference(images).unbind()):
+                references[i] = row
+                reference_cache.put(queries[i].reference_key, row)
+        modification_state = model.encode_modification([query.text for query in queries])
+        query_features = model.fuse(ReferenceState.stack(references), modification_state)
+        query_features = (query_features / query_features.norm(dim=-1, keepdim=True)).float().cpu().numpy()
+    hits = search_shards(query_features, [query.category for query in queries], [query.k for query in queries])
+    return [query_hits + (features,) for query_hits, features in zip(hits, query_features)]
+
+def search_shards(query_features, categories, ks, exact=False):
+    """Searches the category shards, returns (product records, categories, scores) of the top-k hits of each query"""
+    # the category of a query is a predicate over the shards, ALL_CATEGORIES matches every shard
+    shard_names = np.array(list(category_indexes))
+    shards = [category_indexes[name] for name in shard_names]
+    categories = np.array(categories)
+    mask = (categories[:, None] == shard_names[None]) | (categories == ALL_CATEGORIES)[:, None]
+    search_fn = (lambda shard, queries, k: shard.exact_search(queries, k)) if exact else None
+    top_scores, top_shards, top_ids = shard_search.search(shards, query_features, max(ks), mask, search_fn)
+    # rows are never renumbered within a CategoryIndex, the hits can be gathered after the search
+    with metrics.stage('gather'):
+        hits = np.zeros(top_ids.shape, dtype=PRODUCT_DTYPE)
+        for s in np.unique(top_shards[top_shards >= 0]):
+            in_shard = top_shards == s
+            hits[in_shard] = shards[s].gather(top_ids[in_shard])
+    results = []
+    for i, k in enumerate(ks):
+        found = top_shards[i, :k] >= 0
+        results.append((hits[i, :k][found], shard_names[top_shards[i, :k][found]], top_scores[i, :k][found]))
+    return results
+
+def get_category_status():
+    """Returns all potential categories and whether they are available."""
+    status = [{'name': cat, 'available': cat in category_indexes} for cat in CATALOG_CATEGORIES]
+    return status + [{'name': ALL_CATEGORIES, 'available': bool(category_indexes)}]
+
+def get_initial_product_list(category):
+    shard_names = list(category_indexes) if category == ALL_CATEGORIES else [category]
+    if not shard_names or any(name not in category_indexes for name in shard_names): raise SearchRequestError('Invalid category')
+    shards = [category_indexes[name] for name in shard_names]
+    live_rows = []
+    for shard in shards:
+        with shard.lock: live_rows.append(np.flatnonzero(~shard.index.deleted))
+    offsets = np.cumsum([0] + [len(rows) for rows in live_rows])
+    picks = torch.randperm(int(offsets[-1]))[:NUM_INITIAL_PRODUCTS].numpy()
+    pick_shards = np.searchsorted(offsets, picks, side='right') - 1
+    records = np.zeros(len(picks), dtype=PRODUCT_DTYPE)
+    for s in np.unique(pick_shards):
+        in_shard = pick_shards == s
+        records[in_shard] = shards[s].gather(live_rows[s][picks[in_shard] - offsets[s]])
+    return render_products(records, np.array(shard_names)[pick_shards])
+
+def parse_search_request(data):
+    """Returns (image_url, mod_text, category) of a /visual-search payload"""
+    data = data or {}
+    if not isinstance(data, dict): raise SearchRequestError('Request body should be a JSON object')
+    image_url, mod_text, category = data.get('image_path'), data.get('text'), data.get('category')
+    if not all([image_url, mod_text, category]): raise SearchRequestError('Missing data')
+    if category not in category_indexes and not (category == ALL_CATEGORIES and category_indexes): raise SearchRequestError('Category not available')
+    return image_url, mod_text, category
+
+def parse_upload_request(body, content_type):
+    """Returns (image bytes, mod_text, category, k) of a multipart/form-data /visual-search-upload body"""
+    mimetype, options = parse_options_header(content_type)
+    if mimetype != 'multipart/form-data': raise SearchRequestError('Expected a multipart/form-data upload')
+    # file parts are parsed into memory rather than spooled to temporary files, the body is already size-capped
+    parser = FormDataParser(stream_factory=lambda *args, **kwargs: io.BytesIO(), max_content_length=UPLOAD_MAX_BYTES, silent=False)
+    try: _, form, files = parser.parse(io.BytesIO(body), mimetype, len(body), options)
+    except RequestEntityTooLarge: raise UploadTooLargeError('Upload too large')
+    except ValueError: raise SearchRequestError('Invalid multipart body')
+    if 'image' not in files: raise SearchRequestError('Missing data')
+    _, mod_text, category = parse_search_request({'image_path': 'upload', 'text': form.get('text'), 'category': form.get('category')})
+    return files['image'].stream.getvalue(), mod_text, category, parse_page_size(form.get('k'))
+
+def read_upload(stream):
+    """Reads a request body into memory, refusing it as soon as it exceeds UPLOAD_MAX_BYTES"""
+    body = io.BytesIO()
+    for chunk in iter(lambda: stream.read(64 * 1024), b''):
+        if body.tell() + len(chunk) > UPLOAD_MAX_BYTES: raise UploadTooLargeError('Upload too large')
+        body.write(chunk)
+    return body.getvalue()
+
+def decode_upload(data):
+    """Decodes an uploaded image, JPEGs directly at the smallest scale that still covers the model input"""
+    try:
+        with Image.open(io.BytesIO(data), formats=UPLOAD_FORMATS) as image:
+            # only the header has been read so far, oversized images are refused before being decoded
+            if image.width * image.height > UPLOAD_MAX_PIXELS: raise UploadTooLargeError('Image too large')
+            image.draft('RGB', (image_size, image_size))
+            return image.convert('RGB')
+    except SearchRequestError: raise
+    except Image.DecompressionBombError: raise UploadTooLargeError('Image too large')
+    except (OSError, SyntaxError, ValueError): raise SearchRequestError('Invalid image')
+
+def path_reference(image_url):
+    """(reference_key, load_image) of a catalog image"""
+    reference_image_path = os.path.join(PRODUCT_IMAGE_DIR, os.path.basename(image_url))
+    return (reference_image_path, model_key), lambda: Image.open(reference_image_path).convert("RGB")
+
+def upload_reference(data):
+    """(reference_key, load_image) of an uploaded image, keyed on its content so that re-uploads skip the image encoder"""
+    return ('upload', hashlib.blake2b(data, digest_size=16).hexdigest(), model_key), lambda: decode_upload(data)
+
+def prepare_search_query(reference, mod_text, category, k=SEARCH_TOP_K):
+    """Looks the reference up in the cache, decodes and preprocesses it on a miss"""
+    reference_key, load_image = reference
+    reference_state = reference_cache.get(reference_key)
+    image = None
+    if reference_state is None:
+        with metrics.stage('image_load'): image = load_image()
+        with metrics.stage('preprocess'): image = preprocess(image)
+    return SearchQuery(reference_key, reference_state, image, mod_text, category, k)
+
+def result_token(reference, mod_text, category):
+    """Result cache key of a query, also the cursor of its result pages. It hashes the generation and revision of every
+    index the query searches, so that cached results of a category are never served to a new search once its catalog
+    has changed, while the pages of an earlier search stay consistent with its first page"""
+    text_key = model.text_cache_key(mod_text) if model is not None else mod_text
+    shard_names = list(category_indexes) if category == ALL_CATEGORIES else [category]
+    versions = tuple((name, category_indexes[name].generation, category_indexes[name].revision) for name in shard_names if name in category_indexes)
+    return hashlib.blake2b(repr((reference[0], text_key, category, versions)).encode(), digest_size=16).hexdigest()
+
+def parse_page_size(k):
+    """Number of results of a page, SEARCH_TOP_K when not given"""
+    if k is None: return SEARCH_TOP_K
+    try: k = int(k)
+    except (TypeError, ValueError): k = 0
+    if not 0 < k <= SEARCH_CANDIDATES: raise SearchRequestError(f'k should be an integer in [1, {SEARCH_CANDIDATES}]')
+    return k
+
+def parse_cursor(cursor):
+    """Returns (result token, offset) of a next_cursor"""
+    token, _, offset = (cursor or '').partition('.')
+    if len(token) != 32 or not offset.isdigit(): raise SearchRequestError('Invalid cursor')
+    return token, int(offset)
+
+def first_page_candidates(hits, category, k):
+    """SearchCandidates of the k best hits of a new search, with its query features while a deeper ranking can find more"""
+    records, categories, _, query = hits
+    more = k < SEARCH_CANDIDATES and len(records) == k
+    return SearchCandidates(records, categories, query if more else None, category)
+
+def deepen_search(token, candidates):
+    """Ranks the SEARCH_CANDIDATES best products of a search whose first page only was ranked and caches them. The
+    products already served stay first and in their order, so that the next pages continue the first one"""
+    records, categories, _ = search_shards(candidates.query[None], [candidates.category], [SEARCH_CANDIDATES])[0]
+    served = set(zip(candidates.categories.tolist(), candidates.records['file'].tolist()))
+    new = np.array([hit not in served for hit in zip(categories.tolist(), records['file'].tolist())], dtype=bool)
+    candidates = SearchCandidates(np.concatenate([candidates.records, records[new]]),
+                                  np.concatenate([candidates.categories, categories[new]]), None, candidates.category)
+    result_cache.put(token, candidates)
+    return candidates
+
+def serialize_search_page(token, candidates, offset, k):
+    """JSON body of a result page: candidates offset:offset + k and the cursor of the next page, null after the last"""
+    records, categories = candidates.records, candidates.categories
+    end = offset + k
+    next_cursor = f'{token}.{end}' if end < len(records) or candidates.query is not None else None
+    with metrics.stage('serialize'):
+        return json.dumps({'results': render_products(records[offset:end], categories[offset:end]), 'next_cursor': next_cursor}).encode()
+
+def run_cached_search(reference, mod_text, category, k=SEARCH_TOP_K):
+    """Blocking search: the k best products of a query are ranked by the batched model call and kept in the result
+    cache, which serves repeated queries and the next pages. Returns the JSON body of the first page"""
+    token = result_token(reference, mod_text, category)
+    candidates = result_cache.get(token)
+    if candidates is None:
+        candidates = first_page_candidates(search_batcher.submit(prepare_search_query(reference, mod_text, category, k)).result(), category, k)
+        result_cache.put(token, candidates)
+    elif candidates.query is not None and len(candidates.records) < k:
+        candidates = deepen_search(token, candidates)
+    return serialize_search_page(token, candidates, 0, k)
+
+def run_search_page(cursor, k=None):
+    """JSON body of the result page a next_cursor points to, a slice of the cached candidates, which the first next
+    page deepens to the SEARCH_CANDIDATES best products"""
+    token, offset = parse_cursor(cursor)
+    k = parse_page_size(k)
+    candidates = result_cache.get(token)
+    if candidates is None: raise CursorExpiredError('Search results expired, please search again')
+    if candidates.query is not None: candidates = deepen_search(token, candidates)
+    return serialize_search_page(token, candidates, offset, k)
+
+def run_visual_search(data):
+    image_url, mod_text, category = parse_search_request(data)
+    return run_cached_search(path_reference(image_url), mod_text, category, parse_page_size(data.get('k')))
+
+def run_upload_search(body, content_type):
+    data, mod_text, category, k = parse_upload_request(body, content_type)
+    return run_cached_search(upload_reference(data), mod_text, category, k)
+
+def get_service_stats():
+    return {
+        'pid': os.getpid(),
+        'indexes': {cat: {'generation': entry.generation, 'revision': entry.revision, 'items': len(entry.index),
+                          'tombstones': entry.index.num_deleted} for cat, entry in category_indexes.items()},
+        'batching': search_batcher.stats() if search_batcher else {},
+        'result_cache': result_cache.stats(),
+        'reference_cache': reference_cache.stats(),
+        'text_cache': model.text_cache.stats() if model is not None and model.text_cache is not None else {},
+        'thumbnail_cache': thumbnails.cache.stats(),
+    }
+
+def collect_service_metrics():
+    """/metrics samples read on scrape: cache hit rates, search queue depth and index sizes"""
+    caches = {'result': result_cache, 'reference': reference_cache, 'thumbnail': thumbnails.cache}
+    if model is not None and model.text_cache is not None: caches['text'] = model.text_cache
+    for name, cache in caches.items():
+        stats = cache.stats()
+        yield 'cache_hits_total', 'counter', 'Cache lookups that found the entry', {'cache': name}, stats['hits']
+        yield 'cache_misses_total', 'counter', 'Cache lookups that missed the entry', {'cache': name}, stats['misses']
+        yield 'cache_hit_ratio', 'gauge', 'Fraction of cache lookups that found the entry', {'cache': name}, stats['hit_rate']
+        yield 'cache_bytes', 'gauge', 'Bytes held by the cache', {'cache': name}, stats['bytes']
+    if search_batcher is not None:
+        yield 'search_queue_depth', 'gauge', 'Searches waiting for the next model call', {}, search_batcher.queue_depth
+    for category, entry in category_indexes.items():
+        yield 'index_items', 'gauge', 'Live products in the category index', {'category': category}, len(entry.index)
+        yield 'index_tombstones', 'gauge', 'Removed products still stored in the category index', {'category': category}, entry.index.num_deleted
+        yield 'index_generation', 'gauge', 'Embedding store generation served for the category', {'category': category}, entry.generation
+
+metrics.add_collector(collect_service_metrics)
+
+def parse_batch_job(line):
+    """Returns (image_url, mod_text, category, k) of an NDJSON job {id, image_path, text, category, k}"""
+    try: data = json.loads(line)
+    except ValueError: raise SearchRequestError('Invalid JSON')
+    if not isinstance(data, dict): raise SearchRequestError('Invalid job')
+    image_url, mod_text, category = parse_search_request(data)
+    k = data.get('k', SEARCH_TOP_K)
+    if not isinstance(k, int) or not 0 < k <= BATCH_JOB_MAX_K: raise SearchRequestError(f'k should be an integer in [1, {BATCH_JOB_MAX_K}]')
+    return image_url, mod_text, category, k
+
+def batch_job_id(line):
+    try: return json.loads(line).get('id')
+    except (ValueError, AttributeError): return None
+
+def load_reference(image_url):
+    """Decoded and preprocessed reference image, or the exception raised while loading it"""
+    try:
+        with metrics.stage('image_load'): image = Image.open(os.path.join(PRODUCT_IMAGE_DIR, os.path.basename(image_url))).convert("RGB")
+        with metrics.stage('preprocess'): return preprocess(image)
+    except Exception as e: return e
+
+def run_batch_chunk(lines):
+    """Runs a chunk of NDJSON job lines through combine_features and the exact search, returns one output per line"""
+    outputs, jobs = [{'id': batch_job_id(line)} for line in lines], []
+    for output, line in zip(outputs, lines):
+        try: jobs.append((output,) + parse_batch_job(line))
+        except SearchRequestError as e: output['error'] = str(e)
+    # references are decoded concurrently, PIL releases the GIL while decoding
+    decoded = []
+    for job, image in zip(jobs, decode_pool.map(load_reference, [job[1] for job in jobs])):
+        if isinstance(image, Exception): job[0]['error'] = f'Could not load the reference image: {image}'
+        else: decoded.append((job, image))
+    if not decoded: return outputs
+    with torch.no_grad():
+        images = torch.stack([image for _, image in decoded]).to(device)
+        query_features = model.combine_features(images, [job[2] for job, _ in decoded])
+        query_features = (query_features / query_features.norm(dim=-1, keepdim=True)).float().cpu().numpy()
+    hits = search_shards(query_features, [job[3] for job, _ in decoded], [job[4] for job, _ in decoded], exact=True)
+    for (job, _), (records, categories, scores) in zip(decoded, hits):
+        job[0]['results'] = render_products(records, categories, scores)
+    return outputs
+
+def run_batch_job(lines, chunk_size=BATCH_JOB_CHUNK):
+    """Streams the NDJSON output lines of an iterable of NDJSON job lines, one chunk at a time so memory stays bounded"""
+    chunk = []
+    for line in lines:
+        if isinstance(line, bytes): line = line.decode('utf-8', errors='replace')
+        if line.strip(): chunk.append(line)
+        if len(chunk) == chunk_size:
+            yield ''.join(json.dumps(output) + '\n' for output in run_batch_chunk(chunk))
+            chunk = []
+    if chunk: yield ''.join(json.dumps(output) + '\n' for output in run_batch_chunk(chunk))
+
+def check_admin_token(token):
+    if not ADMIN_TOKEN or not token or not hmac.compare_digest(token, ADMIN_TOKEN): raise AdminAuthError('Forbidden')
+
+def parse_admin_category(data):
+    if not isinstance(data, dict) or data.get('category') not in CATALOG_CATEGORIES: raise SearchRequestError('Invalid category')
+    return data['category']
+
+def parse_admin_request(data):
+    """Returns the category and the image paths of an admin payload {category, images: [file names]}"""
+    category, images = parse_admin_category(data), data.get('images')
+    if not isinstance(images, list) or not all(isinstance(name, str) for name in images): raise SearchRequestError('images should be a list of file names')
+    paths = [safe_join(PRODUCT_IMAGE_DIR, name) for name in images]
+    if None in paths: raise SearchRequestError('Invalid image name')
+    return category, paths
+
+def maybe_compact(category, snapshot):
+    if snapshot is None: return snapshot
+    if snapshot.deleted.sum() > COMPACT_DELETED_RATIO * len(snapshot.deleted) or len(snapshot.segments) > COMPACT_MAX_SEGMENTS:
+        snapshot = store.compact(category)
+    return snapshot
+
+def catalog_update_result(category, snapshot):
+    refresh_index(category)
+    if snapshot is None: return {'category': category, 'items': 0}
+    return {'category': category, 'items': len(snapshot), 'generation': snapshot.generation, 'revision': snapshot.revision}
+
+def add_products(category, paths):
+    """Encodes and appends images to a live category, searches see them once the call returns"""
+    snapshot = store.append(category, paths, lambda new_paths: encode_gallery_images(new_paths, desc=f"Adding to {category}"))
+    thumbnails.generate(paths)
+    return catalog_update_result(category, maybe_compact(category, snapshot))
+
+def remove_products(category, paths):
+    """Tombstones images of a live category, searches stop returning them once the call returns"""
+    return catalog_update_result(category, maybe_compact(category, store.remove(category, paths)))
+
+def compact_category(category):
+    return catalog_update_result(category, store.compact(category))
+
 @app.route('/')
 def home(): return render_template_string(HTML_TEMPLATE)
 
 @app.route('/get-categories')
 def get_categories():
-    """Returns all potential categories and whether they are available."""
-    category_status = []
-    for cat in CATALOG_CATEGORIES:
-        category_status.append({'name': cat, 'available': cat in index_features})
-    return jsonify({'categories': category_status})
+    return jsonify({'categories': get_category_status()})
 
 @app.route('/get-initial-products')
 def get_initial_products():
     category = request.args.get('category', default=CATALOG_CATEGORIES[0], type=str)
-    if category not in index_paths: return jsonify({'error': 'Invalid category'}), 400
-    num_products = 50; paths_for_category = index_paths[category]
-    if not paths_for_category: return jsonify({'products': []})
-    random_indices = torch.randperm(len(paths_for_category))[:num_products]
-    products = [generate_product_details(paths_for_category[i]) for i in random_indices]
-    return jsonify({'products': products})
+    try: return jsonify({'products': get_initial_product_list(category)})
+    except SearchRequestError as e: return jsonify({'error': str(e)}), 400
 
 @app.route('/visual-search', methods=['POST'])
 def visual_search():
-    data = request.get_json()
-    image_url, mod_text, category = data.get('image_path'), data.get('text'), data.get('category')
-    if not all([image_url, mod_text, category]): return jsonify({'error': 'Missing data'}), 400
-    if category not in index_features: return jsonify({'error': 'Category not available'}), 400
+    with metrics.stage('request'):
+        try:
+            return Response(run_visual_search(request.get_json()), mimetype='application/json')
+        except SearchRequestError as e:
+            return jsonify({'error': str(e)}), 400
+        except Exception as e:
+            print(f"Error during search: {e}")
+            return jsonify({'error': 'Failed to process request.'}), 500
+
+@app.route('/visual-search-page')
+def visual_search_page():
+    """Next page of a search: ?cursor=<next_cursor of the previous page>&k=<page size>"""
     try:
-        image_filename = os.path.basename(image_url)
-        reference_image_path = os.path.join(FASHION_IQ_BASE_PATH, 'Fashion-IQ', 'fashion-iq', 'images', image_filename)
-        image = Image.open(reference_image_path).convert("RGB")
-        preprocessed_image = preprocess(image).unsqueeze(0).to(device)
-        with torch.no_grad():
-            query_feature = model.combine_features(preprocessed_image, [mod_text])
-            query_feature /= query_feature.norm(dim=-1, keepdim=True)
-        current_index_features = index_features[category]; current_index_paths = index_paths[category]
-        normalized_index = current_index_features / current_index_features.norm(dim=-1, keepdim=True)
-        similarities = (query_feature.to(torch.float32) @ normalized_index.to(torch.float32).T).squeeze(0)
-        top_k_indices = torch.topk(similarities, k=20).indices
-        results = [generate_product_details(current_index_paths[i]) for i in top_k_indices]
-        return jsonify({'results': results})
-    except Exception as e:
-        print(f"Error during search: {e}")
-        return jsonify({'error': 'Failed to process request.'}), 500
+        return Response(run_search_page(request.args.get('cursor'), request.args.get('k')), mimetype='application/json')
+    except CursorExpiredError as e:
+        return jsonify({'error': str(e)}), 410
+    except SearchRequestError as e:
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/visual-search-upload', methods=['POST'])
+def visual_search_upload():
+    """Search from the customer's own photo: multipart/form-data with an `image` file and `text` and `category` fields"""
+    with metrics.stage('request'):
+        try:
+            if (request.content_length or 0) > UPLOAD_MAX_BYTES: raise UploadTooLargeError('Upload too large')
+            return Response(run_upload_search(read_upload(request.stream), request.content_type), mimetype='application/json')
+        except UploadTooLargeError as e:
+            return jsonify({'error': str(e)}), 413
+        except SearchRequestError as e:
+            return jsonify({'error': str(e)}), 400
+        except Exception as e:
+            print(f"Error during search: {e}")
+            return jsonify({'error': 'Failed to process request.'}), 500
+
+@app.route('/healthz')
+def healthz():
+    """Liveness probe: the process is up and serving"""
+    return jsonify({'status': 'ok'})
+
+@app.route('/readyz')
+def readyz():
+    """Readiness probe: 200 once the indexes are open and warmed up, 503 before, with the status of every category"""
+    ready, report = get_readiness()
+    return jsonify(report), 200 if ready else 503
+
+@app.route('/stats')
+def service_stats():
+    """Batch-size and queue-delay distributions of the search scheduler and cache hit rates."""
+    return jsonify(get_service_stats())
+
+@app.route('/metrics')
+def service_metrics():
+    """Prometheus text exposition of the stage latencies, cache hit rates, queue depth and index sizes"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/batch-search', methods=['POST'])
+def batch_search():
+    """NDJSON in, NDJSON out: one {id, image_path, text, category, k} job per line, results streamed as they complete"""
+    return Response(stream_with_context(run_batch_job(request.stream)), mimetype='application/x-ndjson')
+
+@app.route('/admin/products', methods=['POST', 'DELETE'])
+def admin_products():
+    """Adds (POST) or removes (DELETE) catalog images: {"category": ..., "images": [file names in PRODUCT_IMAGE_DIR]}"""
+    try:
+        check_admin_token(request.headers.get('X-Admin-Token'))
+        category, paths = parse_admin_request(request.get_json(silent=True))
+        update = add_products if request.method == 'POST' else remove_products
+        return jsonify(update(category, paths))
+    except AdminAuthError as e:
+        return jsonify({'error': str(e)}), 403
+    except SearchRequestError as e:
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/admin/compact', methods=['POST'])
+def admin_compact():
+    try:
+        check_admin_token(request.headers.get('X-Admin-Token'))
+        return jsonify(compact_category(parse_admin_category(request.get_json(silent=True))))
+    except AdminAuthError as e:
+        return jsonify({'error': str(e)}), 403
+    except SearchRequestError as e:
+        return jsonify({'error': str(e)}), 400
 
 @app.route('/products/<path:filename>')
 def serve_product_image(filename):
-    image_dir = os.path.join(FASHION_IQ_BASE_PATH, 'Fashion-IQ', 'fashion-iq', 'images')
-    return send_from_directory(image_dir, filename)
+    return send_from_directory(PRODUCT_IMAGE_DIR, filename)
+
+@app.route('/thumbs/<path:filename>')
+def serve_thumbnail(filename):
+    if safe_join(PRODUCT_IMAGE_DIR, filename) is None: return jsonify({'error': 'Not found'}), 404
+    status, body, headers = thumbnails.respond(filename, request.headers.get('Accept'), request.headers.get('If-None-Match'))
+    return Response(body, status=status, headers=headers)
 
 if __name__ == '__main__':
     if os.name == 'nt': torch.multiprocessing.freeze_support()
@@ -0,0 +1,318 @@
+"""
+Production serving mode of the visual search app on an asyncio (ASGI) stack:
+
+    uvicorn ecommerce_asgi:app --host 0.0.0.0 --port 5000
+
+The event loop only parses requests and streams files. Reference decoding and preprocessing run on a dedicated
+inference executor and the model calls on the micro-batcher thread, so product images and catalog browsing are never
+queued behind inference. The model and the index are loaded and warmed up in the background at startup, search
+and catalog routes wait (up to STARTUP_WAIT_S) until they are ready. /healthz answers as soon as the process serves,
+/readyz only once the warm-up is over, which is when a load balancer should start routing traffic to the process.
+"""
+import asyncio
+import contextlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from starlette.applications import Starlette
+from starlette.responses import FileResponse, HTMLResponse, JSONResponse, Response
+from starlette.requests import Request
+from starlette.routing import Route
+from werkzeug.utils import safe_join
+
+import ecommerce_app as core
+
+INFERENCE_THREADS = 8
+STARTUP_WAIT_S = 30.0
+# Encode new catalog images at startup, disabled in pre-fork workers where the master owns the store
+UPDATE_STORE_AT_STARTUP = True
+
+inference_executor = ThreadPoolExecutor(INFERENCE_THREADS, thread_name_prefix='inference')
+
+
+class ServiceUnavailable(Exception):
+    pass
+
+
+async def wait_until_ready(request):
+    ready = request.app.state.ready
+    if not ready.is_set():
+        try:
+            await asyncio.wait_for(ready.wait(), STARTUP_WAIT_S)
+        except asyncio.TimeoutError:
+            raise ServiceUnavailable()
+
+
+async def home(request):
+    return HTMLResponse(core.HTML_TEMPLATE)
+
+
+async def get_categories(request):
+    await wait_until_ready(request)
+    return JSONResponse({'categories': core.get_category_status()})
+
+
+async def get_initial_products(request):
+    await wait_until_ready(request)
+    category = request.query_params.get('category', core.CATALOG_CATEGORIES[0])
+    try:
+        return JSONResponse({'products': core.get_initial_product_list(category)})
+    except core.SearchRequestError as e:
+        return JSONResponse({'error': str(e)}, status_code=400)
+
+
+async def cached_search(reference, mod_text, category, k):
+    """First result page of a query, sliced from the cached candidates or from those of the batched model call"""
+    token = core.result_token(reference, mod_text, category)
+    candidates = core.result_cache.get(token)
+    if candidates is None:
+        # decoding and preprocessing run on the inference executor, the model call on the micro-batcher thread
+        query = await asyncio.get_running_loop().run_in_executor(
+            inference_executor, core.prepare_search_query, reference, mod_text, category, k)
+        candidates = core.first_page_candidates(await asyncio.wrap_future(core.search_batcher.submit(query)), category, k)
+        core.result_cache.put(token, candidates)
+    elif candidates.query is not None and len(candidates.records) < k:
+        candidates = await asyncio.get_running_loop().run_in_executor(inference_executor, core.deepen_search, token, candidates)
+    return core.serialize_search_page(token, candidates, 0, k)
+
+
+async def visual_search(request):
+    with core.metrics.stage('request'):
+        return await run_visual_search(request)
+
+
+async def run_visual_search(request):
+    await wait_until_ready(request)
+    try:
+        data = await request.json()
+        image_url, mod_text, category = core.parse_search_request(data)
+        k = core.parse_page_size(data.get('k'))
+    except core.SearchRequestError as e:
+        return JSONResponse({'error': str(e)}, status_code=400)
+    except ValueError:
+        return JSONResponse({'error': 'Missing data'}, status_code=400)
+    try:
+        return Response(await cached_search(core.path_reference(image_url), mod_text, category, k), media_type='application/json')
+    except Exception as e:
+        print(f"Error during search: {e}")
+        return JSONResponse({'error': 'Failed to process request.'}, status_code=500)
+
+
+async def visual_search_page(request):
+    await wait_until_ready(request)
+    try:
+        # the first next page runs the deep index search
+        body = await asyncio.get_running_loop().run_in_executor(
+            inference_executor, core.run_search_page, request.query_params.get('cursor'), request.query_params.get('k'))
+    except core.CursorExpiredError as e:
+        return JSONResponse({'error': str(e)}, status_code=410)
+    except core.SearchRequestError as e:
+        return JSONResponse({'error': str(e)}, status_code=400)
+    return Response(body, media_type='application/json')
+
+
+async def visual_search_upload(request):
+    with core.metrics.stage('request'):
+        return await run_upload_search(request)
+
+
+async def read_upload(request):
+    if int(request.headers.get('Content-Length') or 0) > core.UPLOAD_MAX_BYTES:
+        raise core.UploadTooLargeError('Upload too large')
+    body = bytearray()
+    async for chunk in request.stream():
+        if len(body) + len(chunk) > core.UPLOAD_MAX_BYTES:
+            raise core.UploadTooLargeError('Upload too large')
+        body += chunk
+    return bytes(body)
+
+
+async def run_upload_search(request):
+    await wait_until_ready(request)
+    try:
+        body = await read_upload(request)
+        content_type = request.headers.get('Content-Type')
+        # multipart parsing and hashing stay off the event loop
+        data, mod_text, category, k = await asyncio.get_running_loop().run_in_executor(
+            inference_executor, core.parse_upload_request, body, content_type)
+        reference = await asyncio.get_running_loop().run_in_executor(inference_executor, core.upload_reference, data)
+        return Response(await cached_search(reference, mod_text, category, k), media_type='application/json')
+    except core.UploadTooLargeError as e:
+        return JSONResponse({'error': str(e)}, status_code=413)
+    except core.SearchRequestError as e:
+        return JSONResponse({'error': str(e)}, status_code=400)
+    except Exception as e:
+        print(f"Error during search: {e}")
+        return JSONResponse({'error': 'Failed to process request.'}, status_code=500)
+
+
+class BatchSearch:
+    """
+    POST /batch-search as a raw ASGI endpoint: the NDJSON jobs are read and answered chunk by chunk, so neither the
+    jobs nor the results are held in full. StreamingResponse cannot be used as it listens for the disconnect on the
+    same receive channel the request body is still being read from.
+    """
+
+    async def __call__(self, scope, receive, send):
+        request = Request(scope, receive)
+        await wait_until_ready(request)
+        headers = [(b'content-type', b'application/x-ndjson')]
+        await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+        async for results in self.stream_results(request):
+            await send({'type': 'http.response.body', 'body': results.encode(), 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def stream_results(self, request):
+        lines, pending = [], b''
+        async for data in request.stream():
+            *complete, pending = (pending + data).split(b'\n')
+            lines.extend(line.decode('utf-8', errors='replace') for line in complete if line.strip())
+            while len(lines) >= core.BATCH_JOB_CHUNK:
+                yield await self.run_chunk(lines[:core.BATCH_JOB_CHUNK])
+                lines = lines[core.BATCH_JOB_CHUNK:]
+        if pending.strip():
+            lines.append(pending.decode('utf-8', errors='replace'))
+        if lines:
+            yield await self.run_chunk(lines)
+
+    async def run_chunk(self, lines):
+        outputs = await asyncio.get_running_loop().run_in_executor(inference_executor, core.run_batch_chunk, lines)
+        return ''.join(json.dumps(output) + '\n' for output in outputs)
+
+
+async def admin_products(request):
+    await wait_until_ready(request)
+    try:
+        core.check_admin_token(request.headers.get('X-Admin-Token'))
+        try:
+            data = await request.json()
+        except ValueError:
+            data = None
+        category, paths = core.parse_admin_request(data)
+    except core.AdminAuthError as e:
+        return JSONResponse({'error': str(e)}, status_code=403)
+    except core.SearchRequestError as e:
+        return JSONResponse({'error': str(e)}, status_code=400)
+    update = core.add_products if request.method == 'POST' else core.remove_products
+    result = await asyncio.get_running_loop().run_in_executor(inference_executor, update, category, paths)
+    return JSONResponse(result)
+
+
+async def admin_compact(request):
+    await wait_until_ready(request)
+    try:
+        core.check_admin_token(request.headers.get('X-Admin-Token'))
+        try:
+            data = await request.json()
+        except ValueError:
+            data = None
+        category = core.parse_admin_category(data)
+    except core.AdminAuthError as e:
+        return JSONResponse({'error': str(e)}, status_code=403)
+    except core.SearchRequestError as e:
+        return JSONResponse({'error': str(e)}, status_code=400)
+    result = await asyncio.get_running_loop().run_in_executor(inference_executor, core.compact_category, category)
+    return JSONResponse(result)
+
+
+async def healthz(request):
+    # live while the model and the indexes load, a failed load needs a restart
+    if request.app.state.load_failed:
+        return JSONResponse({'status': 'failed'}, status_code=500)
+    return JSONResponse({'status': 'ok'})
+
+
+async def readyz(request):
+    ready, report = core.get_readiness()
+    return JSONResponse(report, status_code=200 if ready and request.app.state.ready.is_set() else 503)
+
+
+async def service_stats(request):
+    return JSONResponse(core.get_service_stats())
+
+
+async def service_metrics(request):
+    return Response(core.metrics.render(), media_type='text/plain; version=0.0.4')
+
+
+async def serve_product_image(request):
+    path = safe_join(core.PRODUCT_IMAGE_DIR, request.path_params['filename'])
+    if path is None or not os.path.isfile(path):
+        return JSONResponse({'error': 'Not found'}, status_code=404)
+    return FileResponse(path)
+
+
+def load_model_and_index():
+    # the model is already loaded when the worker was forked from a master that loaded it
+    if core.model is None:
+        core.load_model()
+    if UPDATE_STORE_AT_STARTUP:
+        core.update_store()
+    core.open_indexes()
+    core.warm_up()
+
+
+async def serve_thumbnail(request):
+    filename = request.path_params['filename']
+    if safe_join(core.PRODUCT_IMAGE_DIR, filename) is None:
+        return JSONResponse({'error': 'Not found'}, status_code=404)
+    # disk reads and on-demand resizing stay off the event loop
+    status, body, headers = await asyncio.get_running_loop().run_in_executor(
+        None, core.thumbnails.respond, filename, request.headers.get('Accept'), request.headers.get('If-None-Match'))
+    return Response(body, status_code=status, headers=headers)
+
+
+async def service_unavailable(request, exc):
+    return JSONResponse({'error': 'Search index is still loading.'}, status_code=503, headers={'Retry-After': '5'})
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    app.state.ready = asyncio.Event()
+    app.state.load_failed = False
+    loop = asyncio.get_running_loop()
+
+    async def load():
+        try:
+            await loop.run_in_executor(None, load_model_and_index)
+        except Exception as e:
+            print(f"Failed to load the model and index: {e}")
+            app.state.load_failed = True
+            raise
+        app.state.ready.set()
+
+    loading = asyncio.ensure_future(load())
+    yield
+    loading.cancel()
+    if core.search_batcher is not None:
+        core.search_batcher.close()
+    core.shard_search.close()
+    inference_executor.shutdown(wait=False)
+
+
+app = Starlette(
+    routes=[
+        Route('/', home),
+        Route('/get-categories', get_categories),
+        Route('/get-initial-products', get_initial_products),
+        Route('/visual-search', visual_search, methods=['POST']),
+        Route('/visual-search-page', visual_search_page),
+        Route('/visual-search-upload', visual_search_upload, methods=['POST']),
+        Route('/healthz', healthz),
+        Route('/readyz', readyz),
+        Route('/stats', service_stats),
+        Route('/metrics', service_metrics),
+        Route('/batch-search', BatchSearch(), methods=['POST']),
+        Route('/admin/products', admin_products, methods=['POST', 'DELETE']),
+        Route('/admin/compact', admin_compact, methods=['POST']),
+        Route('/products/{filename:path}', serve_product_image),
+        Route('/thumbs/{filename:path}', serve_thumbnail),
+    ],
+    exception_handlers={ServiceUnavailable: service_unavailable},
+    lifespan=lifespan,
+)
+
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host='0.0.0.0', port=5000)
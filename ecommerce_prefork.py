@@ -0,0 +1,59 @@
+"""
+Multi-process serving mode of the visual search app:
+
+    python ecommerce_prefork.py --workers 4 --port 5000
+
+The gallery embeddings and paths of every worker are memory mapped from the same embedding store files, so the page
+cache holds a single copy of the gallery whatever the number of workers. On CPU the master also loads the model
+before forking and the workers share its weights copy-on-write. CUDA contexts do not survive a fork, so on GPU each
+worker loads its own model and the store is updated by a separate indexer process.
+
+Sending SIGHUP to the master re-indexes the catalog without restarting the workers: the new store generation is
+published atomically and every worker swaps to it within INDEX_RELOAD_INTERVAL_S.
+"""
+import argparse
+import multiprocessing
+import os
+import torch
+
+import ecommerce_app as core
+import ecommerce_asgi
+from search.prefork import PreforkServer
+
+
+def run_indexer():
+    core.load_model()
+    core.update_store()
+
+
+def reindex():
+    if core.model is not None:
+        core.update_store()
+        return
+    indexer = multiprocessing.get_context('spawn').Process(target=run_indexer, name='indexer')
+    indexer.start()
+    indexer.join()
+    if indexer.exitcode != 0:
+        raise RuntimeError(f"indexer exited with status {indexer.exitcode}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the visual search app with pre-forked workers')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+
+    if not torch.cuda.is_available():
+        core.load_model()
+    reindex()
+    # the workers only map the store, the master (or the indexer) owns updates
+    ecommerce_asgi.UPDATE_STORE_AT_STARTUP = False
+    torch_threads = max(1, (os.cpu_count() or 1) // args.workers)
+
+    PreforkServer('ecommerce_asgi:app', host=args.host, port=args.port, workers=args.workers,
+                  worker_init=lambda: torch.set_num_threads(torch_threads), on_reload=reindex).serve()
+
+
+if __name__ == '__main__':
+    main()
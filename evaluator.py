@@ -0,0 +1,252 @@
+"""
+Evaluation of a trained checkpoint without any training state: only the model, the validation datasets and their
+index features are loaded, the FashionIQ or CIRR metrics are computed without wandb and the wall time of every phase
+is reported.
+
+    python evaluator.py --checkpoint epoch_10_laion_combined.pth --dataset fiq
+"""
+import argparse
+import contextlib
+import json
+import time
+from statistics import mean
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+from config import Config
+from data.cirr_dataset import CIRRDataset
+from data.fiq_dataset import FashionIQDataset
+from feature_cache import FeatureCache
+from utils import get_model, get_preprocess, extract_index_features, collate_fn, index_rows, names_to_ids, \
+    StreamingTopK, rank_group_members, recall_at_ks
+
+FIQ_DRESS_TYPES = ('dress', 'toptee', 'shirt')
+
+
+def compute_fiq_metrics(model, relative_val_loader, val_index_names, val_index_features, device, memory_budget):
+    """
+    :param model: TransAgg in eval mode
+    :param relative_val_loader: DataLoader of a FashionIQ 'relative' val dataset
+    :param val_index_names: names of the index images, in row order
+    :param val_index_features: (num_index, d) features of the index images
+    :param device: device of the model
+    :param memory_budget: bytes of one block of query x index scores, see StreamingTopK
+    :return: (Recall@10, Recall@50) in percent
+    """
+    target_names = []
+    scorer = StreamingTopK(val_index_features, 50, memory_budget)
+
+    for batch_reference_names, batch_target_names, captions, reference_images in tqdm(relative_val_loader):
+
+        flattened_captions: list = np.array(captions).T.flatten().tolist()
+        input_captions = [
+            f"{flattened_captions[i].strip('.?, ').capitalize()} and {flattened_captions[i + 1].strip('.?, ')}" for
+            i in range(0, len(flattened_captions), 2)]
+        with torch.no_grad():
+            reference_images = reference_images.to(device)
+            batch_predicted_features = model.combine_features(reference_images, input_captions)
+            scorer.add(batch_predicted_features / batch_predicted_features.norm(dim=-1, keepdim=True))
+
+        target_names.extend(batch_target_names)
+
+    return compute_results(scorer.topk_ids(), val_index_names, target_names)
+
+
+def compute_cirr_metrics(model, relative_val_loader, val_index_names, val_index_features, device, memory_budget):
+    """
+    :param model: TransAgg in eval mode
+    :param relative_val_loader: DataLoader of the CIRR 'relative' val dataset
+    :param val_index_names: names of the index images, in row order
+    :param val_index_features: (num_index, d) features of the index images
+    :param device: device of the model
+    :param memory_budget: bytes of one block of query x index scores, see StreamingTopK
+    :return: group Recall@1/2/3 and Recall@1/5/10/50 in percent
+    """
+    target_names = []
+    reference_names = []
+    group_top_ids = []
+    rows = index_rows(val_index_names)
+    scorer = StreamingTopK(val_index_features, 50, memory_budget)
+    for batch_reference_names, batch_target_names, captions, batch_group_members, reference_images in tqdm(relative_val_loader):
+        batch_group_members = np.array(batch_group_members).T.tolist()
+        reference_ids = names_to_ids(rows, batch_reference_names)
+        group_ids = names_to_ids(rows, np.ravel(batch_group_members).tolist()).view(len(batch_reference_names), -1)
+        with torch.no_grad():
+            reference_images = reference_images.to(device)
+            batch_predicted_features = model.combine_features(reference_images, captions)
+            batch_predicted_features = batch_predicted_features / batch_predicted_features.norm(dim=-1, keepdim=True)
+            # the reference image is never a valid answer, it is excluded from the neighbours and from the group
+            scorer.add(batch_predicted_features, exclude_ids=reference_ids)
+            member_distances = scorer.distances(batch_predicted_features, group_ids)
+            group_top_ids.append(rank_group_members(member_distances, group_ids, exclude_ids=reference_ids))
+
+        target_names.extend(batch_target_names)
+        reference_names.extend(batch_reference_names)
+
+    return compute_results(scorer.topk_ids(), val_index_names, target_names, reference_names, torch.cat(group_top_ids))
+
+
+def compute_results(top_ids, val_index_names, target_names, reference_names=None, group_top_ids=None):
+    """
+    :param top_ids: (num_queries, >= 50) index rows of the nearest neighbours of each query, best first
+    :param val_index_names: names of the index images, in row order
+    :param target_names: target image name of each query
+    :param reference_names: reference image name of each query (CIRR), excluded from top_ids and group_top_ids
+    :param group_top_ids: (num_queries, group_size) index rows of the group members of each query ranked by
+     distance, -1 padded (CIRR)
+    """
+    # names are compared as index rows, the rankings only hold the top max(K) neighbours and the group members
+    rows = index_rows(val_index_names)
+    target_ids = names_to_ids(rows, target_names)
+
+    if reference_names is None:
+        recall_at10, recall_at50 = recall_at_ks(top_ids, target_ids, (10, 50))
+
+        return recall_at10, recall_at50
+
+    reference_ids = names_to_ids(rows, reference_names)
+    assert torch.all(target_ids >= 0) and torch.all(target_ids != reference_ids)
+    assert torch.equal(torch.sum(group_top_ids == target_ids[:, None], dim=-1).int(), torch.ones(len(target_names)).int())
+
+    # Compute the metrics
+    recall_at1, recall_at5, recall_at10, recall_at50 = recall_at_ks(top_ids, target_ids, (1, 5, 10, 50))
+    group_recall_at1, group_recall_at2, group_recall_at3 = recall_at_ks(group_top_ids, target_ids, (1, 2, 3))
+
+    return group_recall_at1, group_recall_at2, group_recall_at3, recall_at1, recall_at5, recall_at10, recall_at50
+
+
+class Evaluator:
+    """
+    FashionIQ and CIRR validation of a model, building only what the metrics need: no optimizer, scheduler, criterion,
+    training dataset or wandb run. Every phase (model loading, dataset loading, index encoding, query scoring) is timed
+    into `timings`.
+    """
+
+    def __init__(self, cfg, model, preprocess, num_workers: int = 8):
+        """
+        :param cfg: Config of the model
+        :param model: TransAgg, put in eval mode
+        :param preprocess: image preprocess pipeline of the model
+        :param num_workers: DataLoader workers of the index and query passes
+        """
+        self.cfg = cfg
+        self.model = model.eval()
+        self.preprocess = preprocess
+        self.device = cfg.device
+        self.num_workers = num_workers
+        self.feature_cache = FeatureCache(cfg.feature_cache_dir) if cfg.feature_cache_dir else None
+        self.timings = {}
+
+    @classmethod
+    def from_checkpoint(cls, cfg, checkpoint_path: str, **kwargs):
+        """
+        :param cfg: Config of the model
+        :param checkpoint_path: trained TransAgg weights
+        :return: Evaluator of the checkpoint, its model loading time recorded under 'load_model'
+        """
+        start = time.perf_counter()
+        model = get_model(cfg)
+        model.load_state_dict(torch.load(checkpoint_path, map_location=cfg.device), strict=False)
+        model.pretrained_model.eval().float()
+        if cfg.model_name.startswith('blip'):
+            input_dim = 384
+        elif cfg.model_name.startswith('clip'):
+            input_dim = model.pretrained_model.visual.input_resolution
+        preprocess = get_preprocess(cfg, model, input_dim)
+        evaluator = cls(cfg, model, preprocess, **kwargs)
+        evaluator.timings['load_model'] = time.perf_counter() - start
+        return evaluator
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        yield
+        self.timings[name] = self.timings.get(name, 0.0) + time.perf_counter() - start
+        print(f"[{name}] {self.timings[name]:.1f}s")
+
+    def index_features(self, classic_val_dataset, name: str):
+        """
+        :return: (features, names) of the index images of a 'classic' val dataset, from the feature cache when the
+            same image encoder weights already encoded it
+        """
+        with self.phase(f'{name}_index'):
+            val_index_features, val_index_names, _ = extract_index_features(classic_val_dataset, self.model,
+                                                                            return_local=False,
+                                                                            feature_cache=self.feature_cache)
+        return val_index_features, val_index_names
+
+    def query_loader(self, relative_val_dataset):
+        return DataLoader(dataset=relative_val_dataset, batch_size=32, num_workers=self.num_workers, pin_memory=True,
+                          collate_fn=collate_fn)
+
+    def eval_fiq(self, dress_types=FIQ_DRESS_TYPES) -> dict:
+        """
+        :param dress_types: FashionIQ categories evaluated
+        :return: Recall@10 and Recall@50 of every category and their averages, in percent
+        """
+        results = {}
+        for dress_type in dress_types:
+            with self.phase(f'{dress_type}_datasets'):
+                relative_val_dataset = FashionIQDataset('val', [dress_type], 'relative', self.preprocess)
+                classic_val_dataset = FashionIQDataset('val', [dress_type], 'classic', self.preprocess)
+            val_index_features, val_index_names = self.index_features(classic_val_dataset, dress_type)
+            with self.phase(f'{dress_type}_queries'):
+                recall_at10, recall_at50 = compute_fiq_metrics(self.model, self.query_loader(relative_val_dataset),
+                                                               val_index_names, val_index_features, self.device,
+                                                               self.cfg.eval_memory_budget)
+            results[f'{dress_type}_recall_at10'] = recall_at10
+            results[f'{dress_type}_recall_at50'] = recall_at50
+        results['average_recall_at10'] = mean(results[f'{dress_type}_recall_at10'] for dress_type in dress_types)
+        results['average_recall_at50'] = mean(results[f'{dress_type}_recall_at50'] for dress_type in dress_types)
+        results['average_recall'] = (results['average_recall_at10'] + results['average_recall_at50']) / 2
+        return results
+
+    def eval_cirr(self) -> dict:
+        """
+        :return: group Recall@1/2/3 and Recall@1/5/10/50 on the CIRR val split, in percent
+        """
+        with self.phase('cirr_datasets'):
+            relative_val_dataset = CIRRDataset('val', 'relative', self.preprocess)
+            classic_val_dataset = CIRRDataset('val', 'classic', self.preprocess)
+        val_index_features, val_index_names = self.index_features(classic_val_dataset, 'cirr')
+        with self.phase('cirr_queries'):
+            results = compute_cirr_metrics(self.model, self.query_loader(relative_val_dataset), val_index_names,
+                                           val_index_features, self.device, self.cfg.eval_memory_budget)
+        names = ['group_recall_at1', 'group_recall_at2', 'group_recall_at3', 'recall_at1', 'recall_at5',
+                 'recall_at10', 'recall_at50']
+        results_dict = dict(zip(names, results))
+        results_dict['mean(R@5+R_s@1)'] = (results_dict['group_recall_at1'] + results_dict['recall_at5']) / 2
+        results_dict['arithmetic_mean'] = mean(results)
+        return results_dict
+
+
+def main():
+    cfg = Config()
+    parser = argparse.ArgumentParser(description='Evaluate a TransAgg checkpoint on FashionIQ or CIRR')
+    parser.add_argument('--checkpoint', default=cfg.eval_load_path, help='trained TransAgg weights')
+    parser.add_argument('--dataset', default=cfg.dataset, choices=['fiq', 'cirr'])
+    parser.add_argument('--dress-types', nargs='+', default=list(FIQ_DRESS_TYPES), help='FashionIQ categories')
+    parser.add_argument('--num-workers', type=int, default=8, help='DataLoader workers')
+    parser.add_argument('--no-feature-cache', action='store_true', help='always encode the index images')
+    parser.add_argument('-o', '--output', help='also write the results and timings to this JSON file')
+    args = parser.parse_args()
+    if args.no_feature_cache:
+        cfg.feature_cache_dir = None
+
+    evaluator = Evaluator.from_checkpoint(cfg, args.checkpoint, num_workers=args.num_workers)
+    with evaluator.phase('total_eval'):
+        results = evaluator.eval_fiq(args.dress_types) if args.dataset == 'fiq' else evaluator.eval_cirr()
+
+    for name, value in results.items():
+        print(f'{name}: {value:.2f}')
+    print('Wall time per phase (s):')
+    for name, seconds in evaluator.timings.items():
+        print(f'  {name}: {seconds:.1f}')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'results': results, 'timings': evaluator.timings}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
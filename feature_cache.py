@@ -0,0 +1,151 @@
+import os
+import json
+import shutil
+import hashlib
+import inspect
+import numpy as np
+import torch
+from torchvision.transforms import Compose
+
+from search.embedding_store import stat_files
+
+CACHE_VERSION = 1
+MANIFEST_FILE = 'manifest.json'
+
+
+def image_encoder_fingerprint(model) -> str:
+    """
+    Content hash of the weights the gallery features depend on, the image encoder of the backbone only: the text
+    encoder and the TransAgg layers can be trained without invalidating the cached features
+    :param model: TransAgg
+    :return: hex digest
+    """
+    pretrained_model = model.pretrained_model
+    if hasattr(pretrained_model, 'visual_encoder'):
+        modules = {'visual_encoder': pretrained_model.visual_encoder, 'vision_proj': pretrained_model.vision_proj}
+    else:
+        modules = {'visual': pretrained_model.visual}
+    digest = hashlib.blake2b(digest_size=16)
+    for prefix, module in modules.items():
+        for name, tensor in module.state_dict().items():
+            digest.update(f'{prefix}.{name}:{tensor.dtype}:{tuple(tensor.shape)}'.encode())
+            digest.update(tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+    return digest.hexdigest()
+
+
+def preprocess_config(preprocess) -> list:
+    """
+    Describe a preprocess pipeline by value: torchvision transforms by their repr, functions by their qualified name
+    and other callables by their class name and attributes, never by their address in memory
+    :param preprocess: function which preprocesses the image, usually a torchvision Compose
+    :return: json serializable description of every transform
+    """
+    transforms = preprocess.transforms if isinstance(preprocess, Compose) else [preprocess]
+    config = []
+    for transform in transforms:
+        if inspect.isfunction(transform):
+            config.append(f'{transform.__module__}.{transform.__qualname__}')
+        elif type(transform).__repr__ is object.__repr__:
+            attributes = ', '.join(f'{key}={value!r}' for key, value in sorted(vars(transform).items()))
+            config.append(f'{type(transform).__qualname__}({attributes})')
+        else:
+            config.append(repr(transform))
+    return config
+
+
+def dataset_config(dataset) -> dict:
+    """
+    :param dataset: FashionIQDataset or CIRRDataset in 'classic' mode
+    :return: json serializable description of the split, its image list is summarized by a hash
+    """
+    names_digest = hashlib.sha256(json.dumps(dataset.image_names).encode()).hexdigest()
+    return {
+        'dataset': type(dataset).__name__,
+        'split': dataset.split,
+        'dress_types': getattr(dataset, 'dress_types', None),
+        'num_images': len(dataset.image_names),
+        'image_names': names_digest,
+    }
+
+
+class FeatureCache:
+    """
+    Content-addressed on-disk cache of the global index features of a validation gallery. An entry is keyed by the
+    hash of the image encoder weights, the preprocess pipeline and the dataset split, and holds the features as a .npy
+    file loaded memory-mapped, the image names and the (mtime, size) of every image file. An entry is only used if
+    its manifest matches the full key and no image was modified since it was written, otherwise the gallery is
+    encoded again and the entry replaced.
+    """
+
+    def __init__(self, root: str):
+        """
+        :param root: directory of the cache entries
+        """
+        self.root = root
+
+    def key(self, model, dataset) -> dict:
+        """
+        :return: json serializable description of everything the index features of dataset depend on
+        """
+        return {
+            'version': CACHE_VERSION,
+            'model_feature_dim': model.feature_dim,
+            'image_encoder': image_encoder_fingerprint(model),
+            'preprocess': preprocess_config(dataset.preprocess),
+            'dataset': dataset_config(dataset),
+        }
+
+    def entry_dir(self, key: dict) -> str:
+        return os.path.join(self.root, hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16])
+
+    def load(self, key: dict, dataset):
+        """
+        :param key: key of the entry, see key
+        :param dataset: dataset the entry was written for, its image files are checked against the entry
+        :return: (features, names), features a memory-mapped (num_rows, feature_dim) array and names the image of each
+            row as saved, or None when there is no valid entry
+        """
+        entry_dir = self.entry_dir(key)
+        try:
+            with open(os.path.join(entry_dir, MANIFEST_FILE)) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if manifest['key'] != key:
+            print(f'Feature cache entry {entry_dir} was written for a different key, ignoring it')
+            return None
+        stats = np.load(os.path.join(entry_dir, 'stats.npy'))
+        if not np.array_equal(stats, stat_files([dataset.image_path(name) for name in dataset.image_names])):
+            print(f'Images of feature cache entry {entry_dir} were modified since it was written, ignoring it')
+            return None
+        features = np.load(os.path.join(entry_dir, 'features.npy'), mmap_mode='c')
+        with open(os.path.join(entry_dir, 'names.json')) as f:
+            names = json.load(f)
+        # the key pins the image list of the split, names are the rows the extraction kept: images which failed to
+        # decode are missing from them and stay valid as long as stats.npy matches
+        if len(features) != len(names) or not set(names) <= set(dataset.image_names):
+            print(f'Feature cache entry {entry_dir} is inconsistent, ignoring it')
+            return None
+        return features, names
+
+    def save(self, key: dict, dataset, features: np.ndarray, names: list):
+        """
+        Write an entry atomically: a reader sees either no entry or a complete one, the manifest is written last
+        :param key: key of the entry, see key
+        :param dataset: dataset whose index features are cached
+        :param features: (num_images, feature_dim) index features
+        :param names: image name of every row of features
+        """
+        entry_dir = self.entry_dir(key)
+        tmp_dir = f'{entry_dir}.tmp-{os.getpid()}'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        np.save(os.path.join(tmp_dir, 'features.npy'), features)
+        np.save(os.path.join(tmp_dir, 'stats.npy'),
+                stat_files([dataset.image_path(name) for name in dataset.image_names]))
+        with open(os.path.join(tmp_dir, 'names.json'), 'w') as f:
+            json.dump(list(names), f)
+        with open(os.path.join(tmp_dir, MANIFEST_FILE), 'w') as f:
+            json.dump({'key': key}, f, indent=2)
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        os.replace(tmp_dir, entry_dir)
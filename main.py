@@ -12,6 +12,7 @@ from trainer import Trainer
 from config import Config
 import datetime
 from utils import get_model, set_grad, get_preprocess, get_laion_cirr_dataset, get_laion_fiq_dataset, extract_index_features, collate_fn, get_optimizer
+from feature_cache import FeatureCache
 
 def setup_seed(seed):
 	torch.manual_seed(seed)
@@ -47,7 +48,9 @@ def main(cfg):
                                        num_workers=multiprocessing.cpu_count(), pin_memory=True, collate_fn=collate_fn,
                                        drop_last=True, shuffle=True)
 
-    # When fine-tuning only the text encoder we can precompute the index features since they do not change over the epochs
+    # When fine-tuning only the text encoder we can precompute the index features since they do not change over the epochs,
+    # nor across runs sharing the same image encoder weights, preprocess pipeline and val split
+    feature_cache = FeatureCache(cfg.feature_cache_dir) if cfg.feature_cache_dir else None
     kwargs = {}
     if cfg.dataset == 'fiq':
         kwargs['val_index_features'] = []
@@ -55,11 +58,11 @@ def main(cfg):
         kwargs['val_total_index_features'] = []
         kwargs['idx_to_dress_mapping'] = idx_to_dress_mapping
     if cfg.dataset == 'cirr' and (cfg.encoder == 'text' or cfg.encoder == 'neither'):
-        val_index_features, val_index_names, val_total_index_features = extract_index_features(classic_val_dataset, model, return_local=False)
+        val_index_features, val_index_names, val_total_index_features = extract_index_features(classic_val_dataset, model, return_local=False, feature_cache=feature_cache)
         kwargs['val_index_features'], kwargs['val_index_names'], kwargs['val_total_index_features'] = val_index_features, val_index_names, val_total_index_features
     elif cfg.dataset == 'fiq' and (cfg.encoder == 'text' or cfg.encoder == 'neither'):
         for classic_val_dataset_ in classic_val_dataset:
-            val_index_features, val_index_names, _ = extract_index_features(classic_val_dataset_, model, return_local=False)
+            val_index_features, val_index_names, _ = extract_index_features(classic_val_dataset_, model, return_local=False, feature_cache=feature_cache)
             kwargs['val_index_features'].append(val_index_features)
             kwargs['val_index_names'].append(val_index_names)
             kwargs['val_total_index_features'].append(_) 
@@ -0,0 +1,164 @@
+import time
+import bisect
+import threading
+
+# upper bounds (seconds) of the stage latency histogram buckets, +Inf is implicit
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Histogram:
+    """
+    Thread-safe cumulative histogram with fixed buckets, as exposed by Prometheus
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # the last bucket counts the observations above every bound
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[bucket] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        """
+        :return: (cumulative counts per bucket including +Inf, sum, count)
+        """
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        cumulative, running = [], 0
+        for bucket_count in counts:
+            running += bucket_count
+            cumulative.append(running)
+        return cumulative, total, count
+
+
+class _StageTimer:
+    __slots__ = ('histogram', 'sync_fn', 'start')
+
+    def __init__(self, histogram, sync_fn):
+        self.histogram = histogram
+        self.sync_fn = sync_fn
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.sync_fn is not None:
+            self.sync_fn()
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return None
+
+
+NULL_TIMER = _NullTimer()
+
+
+class StageMetrics:
+    """
+    Per-stage latency histograms plus values collected on scrape (cache hit rates, queue depth, index sizes), rendered
+    in the Prometheus text exposition format. Code is instrumented with `with metrics.stage('name'):`; a disabled
+    instance hands out a shared no-op timer, so instrumentation then costs one method call per stage.
+    """
+
+    def __init__(self, namespace: str = 'app', enabled: bool = True, buckets=DEFAULT_BUCKETS, sync_fn: callable = None):
+        """
+        :param namespace: prefix of the metric names
+        :param enabled: whether stages are timed
+        :param buckets: upper bounds in seconds of the stage histogram buckets
+        :param sync_fn: called before the stages timed with sync=True are stopped, e.g. torch.cuda.synchronize so that
+            asynchronous GPU work is counted in the stage that launched it rather than in the next one waiting for it
+        """
+        self.namespace = namespace
+        self.enabled = enabled
+        self.buckets = tuple(buckets)
+        self.sync_fn = sync_fn
+        self._histograms = {}  # stage name -> Histogram
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _histogram(self, name):
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(name, Histogram(self.buckets))
+        return histogram
+
+    def stage(self, name: str, sync: bool = False):
+        """
+        :param name: stage label of the observation
+        :param sync: whether the stage launches asynchronous device work that sync_fn waits for
+        :return: context manager timing its body into the stage histogram
+        """
+        if not self.enabled:
+            return NULL_TIMER
+        return _StageTimer(self._histogram(name), self.sync_fn if sync else None)
+
+    def observe(self, name: str, seconds: float):
+        if self.enabled:
+            self._histogram(name).observe(seconds)
+
+    def add_collector(self, collect_fn: callable):
+        """
+        :param collect_fn: called on every scrape, returns an iterable of (name, type, help, labels, value) samples
+            with type 'gauge' or 'counter', name without the namespace and labels a dict
+        """
+        self._collectors.append(collect_fn)
+
+    def render(self) -> str:
+        """
+        :return: every metric in the Prometheus text exposition format (version 0.0.4)
+        """
+        lines = []
+        stage_metric = f'{self.namespace}_stage_seconds'
+        if self._histograms:
+            lines += [f'# HELP {stage_metric} Latency of the request processing stages',
+                      f'# TYPE {stage_metric} histogram']
+        for name, histogram in sorted(self._histograms.items()):
+            cumulative, total, count = histogram.snapshot()
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), cumulative):
+                labels = _format_labels({'stage': name, 'le': _format_value(bound)})
+                lines.append(f'{stage_metric}_bucket{labels} {bucket_count}')
+            labels = _format_labels({'stage': name})
+            lines += [f'{stage_metric}_sum{labels} {_format_value(total)}', f'{stage_metric}_count{labels} {count}']
+
+        # the samples of a metric have to be contiguous, whichever collectors and in whichever order they came from
+        families = {}  # name -> (type, help, sample lines)
+        for collect_fn in self._collectors:
+            for name, metric_type, description, labels, value in collect_fn():
+                name = f'{self.namespace}_{name}'
+                family = families.setdefault(name, (metric_type, description, []))
+                family[2].append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+        for name, (metric_type, description, samples) in families.items():
+            lines += [f'# HELP {name} {description}', f'# TYPE {name} {metric_type}'] + samples
+        return '\n'.join(lines) + '\n'
+
+
+DISABLED = StageMetrics(enabled=False)
+
+
+def _format_value(value) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + '}'
@@ -1,8 +1,43 @@
 import torch 
 import torch.nn as nn
+from dataclasses import dataclass, fields
 from model.clip import clip 
+from model.clip.simple_tokenizer import basic_clean, whitespace_clean
 import torch.nn.functional as F
 from model.BLIP.models.blip_retrieval import blip_retrieval
+from cache import LRUCache
+import metrics
+
+
+class BatchState:
+    """
+    Batch of per-sample tensors produced by one stage of TransAgg.combine_features. Rows can be split off with
+    unbind and batched again with stack, so that either side of a query can be cached or precomputed.
+    """
+
+    def __len__(self):
+        return self.features.size(0)
+
+    def unbind(self):
+        return [type(self)(*(getattr(self, f.name)[i].clone() for f in fields(self))) for i in range(len(self))]
+
+    @classmethod
+    def stack(cls, rows):
+        return cls(*(torch.stack([getattr(row, f.name) for row in rows]) for f in fields(cls)))
+
+
+@dataclass
+class ReferenceState(BatchState):
+    features: torch.Tensor  # (batch_size, feature_dim) global image features
+    local_features: torch.Tensor  # (batch_size, num_patches + 1, feature_dim) image tokens
+
+
+@dataclass
+class ModificationState(BatchState):
+    features: torch.Tensor  # (batch_size, feature_dim) global text features
+    local_features: torch.Tensor  # (batch_size, num_tokens, feature_dim) text tokens
+    padding_mask: torch.Tensor  # (batch_size, num_tokens) True on padding tokens
+    pool_index: torch.Tensor  # (batch_size,) token pooled as the multimodal text representation
 
 
 class TransAgg(nn.Module):
@@ -27,7 +62,39 @@ class TransAgg(nn.Module):
         self.weighted_layer = nn.Linear(self.feature_dim, 3)
         self.output_layer = nn.Linear((self.feature_dim + self.feature_dim) * 4, self.feature_dim)
         self.sep_token = nn.Parameter(torch.randn(1, 1, self.feature_dim))
+        self.text_cache = None
+        self.metrics = metrics.DISABLED
+
+    def enable_text_cache(self, max_bytes):
+        """
+        Cache the ModificationState of each caption (keyed on its normalized text) when the model is in eval mode.
+        The cache is bypassed in train mode and cleared whenever the weights may have changed.
+        :param max_bytes: capacity of the cache, 0 disables it
+        """
+        self.text_cache = LRUCache(max_bytes) if max_bytes else None
 
+    def enable_metrics(self, stage_metrics):
+        """
+        Time the image_encode, tokenize, text_encode and fusion stages of combine_features
+        :param stage_metrics: metrics.StageMetrics the stage latencies are recorded in
+        """
+        self.metrics = stage_metrics
+
+    def train(self, mode=True):
+        if mode and self.text_cache is not None:
+            self.text_cache.clear()
+        return super().train(mode)
+
+    def load_state_dict(self, state_dict, *args, **kwargs):
+        if self.text_cache is not None:
+            self.text_cache.clear()
+        return super().load_state_dict(state_dict, *args, **kwargs)
+
+    def text_cache_key(self, text):
+        # the normalization applied by the tokenizer, so that captions tokenized identically share an entry
+        if self.model_name.startswith('clip'):
+            return whitespace_clean(basic_clean(text)).lower()
+        return whitespace_clean(text).lower()
 
     def forward(self, texts, reference_images, target_images):
         img_text_rep = self.combine_features(reference_images, texts)
@@ -37,18 +104,69 @@ class TransAgg(nn.Module):
         return logits 
     
     def combine_features(self, reference_images, texts):
-        reference_image_features, reference_total_image_features = self.pretrained_model.encode_image(reference_images, return_local=True)
-        batch_size = reference_image_features.size(0)
-        reference_total_image_features = reference_total_image_features.float()
-        if self.model_name.startswith('blip'):
-            tokenized_texts = self.pretrained_model.tokenizer(texts, padding='max_length', truncation=True, max_length=35,
-                                                              return_tensors='pt').to(self.device)
-            mask = (tokenized_texts.attention_mask == 0)
-        elif self.model_name.startswith('clip'):
-            tokenized_texts = clip.tokenize(texts, truncate=True).to(reference_image_features.device)
-            mask = (tokenized_texts == 0)
+        return self.fuse(self.encode_reference(reference_images), self.encode_modification(texts))
+
+    def encode_reference(self, reference_images):
+        """
+        Image stage of combine_features, independent of the modification text
+        :param reference_images: preprocessed reference images
+        :return: ReferenceState
+        """
+        with self.metrics.stage('image_encode', sync=True):
+            reference_image_features, reference_total_image_features = self.pretrained_model.encode_image(reference_images, return_local=True)
+        return ReferenceState(reference_image_features, reference_total_image_features.float())
 
-        text_features, total_text_features = self.pretrained_model.encode_text(tokenized_texts)
+    def encode_modification(self, texts):
+        """
+        Text stage of combine_features, independent of the reference image
+        :param texts: list of relative captions
+        :return: ModificationState
+        """
+        if self.text_cache is None or self.training:
+            return self._encode_modification(texts)
+        keys = [self.text_cache_key(text) for text in texts]
+        rows = [self.text_cache.get(key) for key in keys]
+        missing = {key: text for key, text, row in zip(keys, texts, rows) if row is None}
+        if missing:
+            encoded = dict(zip(missing, self._encode_modification(list(missing.values())).unbind()))
+            for key, row in encoded.items():
+                self.text_cache.put(key, row)
+            rows = [encoded[key] if row is None else row for key, row in zip(keys, rows)]
+        return ModificationState.stack(rows)
+
+    def _encode_modification(self, texts):
+        device = self.sep_token.device
+        with self.metrics.stage('tokenize', sync=True):
+            if self.model_name.startswith('blip'):
+                tokenized_texts = self.pretrained_model.tokenizer(texts, padding='max_length', truncation=True, max_length=35,
+                                                                  return_tensors='pt').to(device)
+                mask = (tokenized_texts.attention_mask == 0)
+                pool_index = torch.zeros(len(texts), dtype=torch.long, device=device)
+            elif self.model_name.startswith('clip'):
+                tokenized_texts = clip.tokenize(texts, truncate=True).to(device)
+                mask = (tokenized_texts == 0)
+                pool_index = tokenized_texts.argmax(dim=-1)
+
+        with self.metrics.stage('text_encode', sync=True):
+            text_features, total_text_features = self.pretrained_model.encode_text(tokenized_texts)
+        return ModificationState(text_features, total_text_features, mask, pool_index)
+
+    def fuse(self, reference_state, modification_state):
+        """
+        Fusion stage of combine_features
+        :param reference_state: ReferenceState of the batch, see encode_reference
+        :param modification_state: ModificationState of the batch, see encode_modification
+        :return: normalized query representations
+        """
+        with self.metrics.stage('fusion', sync=True):
+            return self._fuse(reference_state, modification_state)
+
+    def _fuse(self, reference_state, modification_state):
+        reference_image_features = reference_state.features
+        reference_total_image_features = reference_state.local_features
+        text_features = modification_state.features
+        total_text_features = modification_state.local_features
+        batch_size = reference_image_features.size(0)
 
         num_patches = reference_total_image_features.size(1)
         sep_token = self.sep_token.repeat(batch_size, 1, 1)
@@ -56,16 +174,14 @@ class TransAgg(nn.Module):
         combine_features = torch.cat((total_text_features, sep_token, reference_total_image_features), dim=1)
 
         image_mask = torch.zeros(batch_size, num_patches + 1).to(reference_image_features.device)
-        mask = torch.cat((mask, image_mask), dim=1)
+        mask = torch.cat((modification_state.padding_mask, image_mask), dim=1)
         
         img_text_rep = self.fusion(combine_features, src_key_padding_mask=mask) 
         
-        if self.model_name.startswith('blip'):
-            multimodal_img_rep = img_text_rep[:, 36, :] 
-            multimodal_text_rep = img_text_rep[:, 0, :]
-        elif self.model_name.startswith('clip'):
-            multimodal_img_rep = img_text_rep[:, 78, :]
-            multimodal_text_rep = img_text_rep[torch.arange(batch_size), tokenized_texts.argmax(dim=-1), :]
+        # the first image token follows the text tokens and the separator, the text is pooled on its [CLS] (blip)
+        # or end of text (clip) token
+        multimodal_img_rep = img_text_rep[:, total_text_features.size(1) + 1, :]
+        multimodal_text_rep = img_text_rep[torch.arange(batch_size), modification_state.pool_index, :]
 
         concate = torch.cat((multimodal_img_rep, multimodal_text_rep), dim=-1)
         f_U = self.output_layer(self.dropout(F.relu(self.combiner_layer(concate))))
@@ -75,4 +191,4 @@ class TransAgg(nn.Module):
         
         query_rep = F.normalize(query_rep, dim=-1)
 
-        return query_rep 
\ No newline at end of file
+        return query_rep 
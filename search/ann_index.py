@@ -0,0 +1,483 @@
+import time
+import heapq
+import math
+import numpy as np
+
+from search.quantization import QUANTIZERS
+from search.row_blocks import RowBlocks
+
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+
+def _topk(scores: np.ndarray, k: int):
+    """
+    :param scores: (q, n) similarity matrix
+    :param k: number of results, clipped to n
+    :return: (scores, ids) of the k best columns of each row, sorted by decreasing score
+    """
+    k = min(k, scores.shape[1])
+    ids = np.argpartition(-scores, k - 1, axis=1)[:, :k] if k < scores.shape[1] else np.tile(np.arange(k), (len(scores), 1))
+    top_scores = np.take_along_axis(scores, ids, axis=1)
+    order = np.argsort(-top_scores, axis=1)
+    return np.take_along_axis(top_scores, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+
+def chunked_topk(queries: np.ndarray, features, k: int, chunk_size: int = 65536, deleted: np.ndarray = None):
+    """
+    Exact top-k over a gallery scored chunk by chunk and merged into a running top-k, so memory stays bounded by
+    (q, chunk_size + k) scores whatever the size of the gallery
+    :param queries: (q, d) L2-normalized query embeddings
+    :param features: (n, d) array or RowBlocks of L2-normalized gallery embeddings, e.g. memory-mapped
+    :param k: number of neighbours
+    :param chunk_size: number of gallery rows scored at once
+    :param deleted: optional bool (n,) mask of rows to skip
+    :return: (scores, ids) of shape (q, min(k, n)) sorted by decreasing similarity, ids -1 for missing results
+    """
+    features = features if isinstance(features, RowBlocks) else RowBlocks([features])
+    return _streaming_topk(lambda start, stop: queries @ features.rows(start, stop).T, len(queries), len(features), k,
+                           chunk_size, deleted)
+
+
+def _streaming_topk(score_fn: callable, num_queries: int, num_rows: int, k: int, chunk_size: int, deleted=None):
+    """
+    :param score_fn: function (start, stop) -> (q, stop - start) scores of the rows start:stop
+    :return: (scores, ids) of shape (q, min(k, num_rows)), see chunked_topk
+    """
+    k = min(k, num_rows)
+    best_scores = np.full((num_queries, 0), -np.inf, dtype=np.float32)
+    best_ids = np.full((num_queries, 0), -1, dtype=np.int64)
+    for start in range(0, num_rows, chunk_size):
+        stop = min(start + chunk_size, num_rows)
+        scores = score_fn(start, stop)
+        if deleted is not None:
+            scores[:, deleted[start:stop]] = -np.inf
+        scores = np.concatenate((best_scores, scores), axis=1)
+        ids = np.concatenate((best_ids, np.broadcast_to(np.arange(start, stop), (num_queries, stop - start))), axis=1)
+        best_scores, positions = _topk(scores, k)
+        best_ids = np.take_along_axis(ids, positions, axis=1)
+    best_ids[np.isneginf(best_scores)] = -1
+    return best_scores, best_ids
+
+
+def spherical_kmeans(features: np.ndarray, num_clusters: int, num_iters: int = 20, seed: int = 0) -> np.ndarray:
+    """
+    K-means on the unit sphere (cosine similarity) used to train the coarse quantizer
+    :param features: (n, d) L2-normalized vectors
+    :param num_clusters: number of centroids
+    :param num_iters: number of Lloyd iterations
+    :param seed: seed of the centroid initialization
+    :return: (num_clusters, d) L2-normalized centroids
+    """
+    rng = np.random.default_rng(seed)
+    centroids = features[rng.choice(len(features), num_clusters, replace=False)].copy()
+    for _ in range(num_iters):
+        assignment = np.argmax(features @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, features)
+        empty = ~np.bincount(assignment, minlength=num_clusters).astype(bool)
+        sums[empty] = features[rng.choice(len(features), int(empty.sum()))]
+        centroids = sums / np.linalg.norm(sums, axis=1, keepdims=True)
+    return centroids
+
+
+class Tombstones:
+    """
+    Mixin giving an index incremental updates: `add` appends rows with the next ids and `remove` tombstones ids,
+    which are skipped by searches until the index is rebuilt. Subclasses insert new rows into their own structure
+    in `_add`.
+    """
+
+    def _init_rows(self, num_rows: int):
+        self.deleted = np.zeros(num_rows, dtype=bool)
+        self.num_deleted = 0
+
+    def __len__(self):
+        return len(self.deleted) - self.num_deleted
+
+    def add(self, features: np.ndarray) -> np.ndarray:
+        """
+        :param features: (m, d) L2-normalized embeddings
+        :return: ids given to the new rows
+        """
+        features = np.asarray(features, dtype=np.float32)
+        ids = np.arange(len(self.deleted), len(self.deleted) + len(features))
+        self.deleted = np.concatenate((self.deleted, np.zeros(len(features), dtype=bool)))
+        self._add(features, ids)
+        return ids
+
+    def _add(self, features, ids):
+        raise NotImplementedError
+
+    def remove(self, ids):
+        """
+        :param ids: ids of the rows to drop from the search results
+        """
+        self.deleted[ids] = True
+        self.num_deleted = int(self.deleted.sum())
+
+
+class BruteForceIndex(Tombstones):
+    """
+    Exact inner product search, the reference the approximate indexes are measured against
+    """
+
+    def __init__(self, features: np.ndarray):
+        """
+        :param features: (n, d) L2-normalized gallery embeddings
+        """
+        self.features = RowBlocks([features])
+        self._init_rows(len(features))
+
+    def _add(self, features, ids):
+        self.features.append(features)
+
+    def search(self, queries: np.ndarray, k: int):
+        """
+        :param queries: (q, d) L2-normalized query embeddings
+        :param k: number of neighbours to return
+        :return: (scores, ids), both of shape (q, min(k, n)), sorted by decreasing similarity. Approximate indexes
+            share this interface and pad missing neighbours with id -1
+        """
+        scores = self.features.dot(queries)
+        if not self.num_deleted:
+            return _topk(scores, k)
+        scores[:, self.deleted] = -np.inf
+        scores, ids = _topk(scores, min(k, len(self)))
+        ids[np.isneginf(scores)] = -1
+        return scores, ids
+
+
+class IVFFlatIndex(Tombstones):
+    """
+    Inverted file index: the gallery is partitioned by a spherical k-means coarse quantizer and a query only scans
+    the `nprobe` partitions whose centroid is the most similar. nprobe is the recall/latency knob, nprobe == nlist is
+    exact search. When these partitions hold fewer than k live rows, the next most similar ones are scanned as well,
+    so a query always gets min(k, live rows) results.
+    """
+
+    def __init__(self, features: np.ndarray, nlist: int = None, nprobe: int = 8, num_iters: int = 20):
+        """
+        :param features: (n, d) L2-normalized gallery embeddings
+        :param nlist: number of partitions, defaults to 4 * sqrt(n)
+        :param nprobe: number of partitions scanned per query
+        :param num_iters: k-means iterations used to train the partitions
+        """
+        self.features = RowBlocks([features])
+        self._init_rows(len(features))
+        self.nlist = min(nlist or int(4 * math.sqrt(len(features))), len(features))
+        self.nprobe = nprobe
+        self.centroids = spherical_kmeans(features, self.nlist, num_iters)
+        assignment = np.argmax(features @ self.centroids.T, axis=1)
+        # lists[p] holds the ids of partition p, new rows are appended to the partition of their nearest centroid
+        ids = np.argsort(assignment, kind='stable')
+        self.lists = np.split(ids, np.cumsum(np.bincount(assignment, minlength=self.nlist))[:-1])
+
+    def _add(self, features, ids):
+        self.features.append(features)
+        assignment = np.argmax(features @ self.centroids.T, axis=1)
+        for p in np.unique(assignment):
+            self.lists[p] = np.concatenate((self.lists[p], ids[assignment == p]))
+
+    def _probe(self, partition_order, k):
+        """
+        :return: live rows of at least nprobe partitions taken in partition_order, and of as many more as needed to
+            hold k rows
+        """
+        partitions, num_candidates = [], 0
+        for p in partition_order:
+            if len(partitions) >= self.nprobe and num_candidates >= k:
+                break
+            partition = self.lists[p]
+            if self.num_deleted:
+                partition = partition[~self.deleted[partition]]
+            partitions.append(partition)
+            num_candidates += len(partition)
+        return np.concatenate(partitions)
+
+    def search(self, queries: np.ndarray, k: int):
+        partition_orders = np.argsort(-(queries @ self.centroids.T), axis=1)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+        for i, (query, partition_order) in enumerate(zip(queries, partition_orders)):
+            candidates = self._probe(partition_order, k)
+            if not len(candidates):
+                continue
+            query_scores, query_ids = _topk((self.features[candidates] @ query)[None], k)
+            scores[i, :query_ids.shape[1]] = query_scores[0]
+            ids[i, :query_ids.shape[1]] = candidates[query_ids[0]]
+        return scores, ids
+
+
+class HNSWIndex(Tombstones):
+    """
+    Hierarchical navigable small world graph (Malkov & Yashunin). `ef_search` is the size of the candidate list
+    explored at query time and is the recall/latency knob.
+    """
+
+    def __init__(self, features: np.ndarray, M: int = 16, ef_construction: int = 100, ef_search: int = 64, seed: int = 0):
+        """
+        :param features: (n, d) L2-normalized gallery embeddings
+        :param M: number of links per node on the upper layers, 2 * M on the bottom layer
+        :param ef_construction: size of the candidate list used while inserting
+        :param ef_search: size of the candidate list used while searching
+        :param seed: seed of the level generator
+        """
+        self.features = RowBlocks([features])
+        self._init_rows(len(features))
+        self.M = M
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.rng = np.random.default_rng(seed)
+        self.level_multiplier = 1 / math.log(M)
+        self.graph = []  # graph[level][node] -> list of neighbour ids
+        self.entry_point = None
+        self.max_level = -1
+        for node in range(len(features)):
+            self._insert(node)
+
+    def _add(self, features, ids):
+        # tombstoned nodes stay in the graph as routing points
+        self.features.append(features)
+        for node in ids.tolist():
+            self._insert(node)
+
+    def _search_layer(self, query, entry_points, ef, level):
+        visited = set(entry_points)
+        entry_scores = self.features[entry_points] @ query
+        candidates = [(-s, n) for s, n in zip(entry_scores.tolist(), entry_points)]  # max-heap on similarity
+        heapq.heapify(candidates)
+        results = [(s, n) for s, n in zip(entry_scores.tolist(), entry_points)]  # min-heap on similarity
+        heapq.heapify(results)
+        while len(results) > ef:
+            heapq.heappop(results)
+        layer = self.graph[level]
+        while candidates:
+            neg_score, node = heapq.heappop(candidates)
+            if -neg_score < results[0][0] and len(results) >= ef:
+                break
+            neighbours = [n for n in layer[node] if n not in visited]
+            if not neighbours:
+                continue
+            visited.update(neighbours)
+            for score, neighbour in zip((self.features[neighbours] @ query).tolist(), neighbours):
+                if len(results) < ef or score > results[0][0]:
+                    heapq.heappush(candidates, (-score, neighbour))
+                    heapq.heappush(results, (score, neighbour))
+                    if len(results) > ef:
+                        heapq.heappop(results)
+        return sorted(results, reverse=True)
+
+    def _insert(self, node):
+        level = int(-math.log(1.0 - self.rng.random()) * self.level_multiplier)
+        while len(self.graph) <= level:
+            self.graph.append({})
+        for l in range(level + 1):
+            self.graph[l][node] = []
+        if self.entry_point is None:
+            self.entry_point, self.max_level = node, level
+            return
+
+        query = self.features[node]
+        entry_points = [self.entry_point]
+        for l in range(self.max_level, level, -1):
+            entry_points = [self._search_layer(query, entry_points, 1, l)[0][1]]
+        for l in range(min(level, self.max_level), -1, -1):
+            found = self._search_layer(query, entry_points, self.ef_construction, l)
+            max_links = 2 * self.M if l == 0 else self.M
+            neighbours = [n for _, n in found[:self.M]]
+            self.graph[l][node] = neighbours
+            for neighbour in neighbours:
+                links = self.graph[l][neighbour]
+                links.append(node)
+                if len(links) > max_links:
+                    link_scores = self.features[links] @ self.features[neighbour]
+                    self.graph[l][neighbour] = [links[i] for i in np.argsort(-link_scores)[:max_links]]
+            entry_points = [n for _, n in found]
+        if level > self.max_level:
+            self.entry_point, self.max_level = node, level
+
+    def search(self, queries: np.ndarray, k: int):
+        k = min(k, len(self))
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+        for i, query in enumerate(queries):
+            entry_points = [self.entry_point]
+            for l in range(self.max_level, 0, -1):
+                entry_points = [self._search_layer(query, entry_points, 1, l)[0][1]]
+            found = self._search_layer(query, entry_points, max(self.ef_search, k + self.num_deleted), 0)
+            if self.num_deleted:
+                found = [(s, n) for s, n in found if not self.deleted[n]]
+            found = found[:k]
+            scores[i, :len(found)] = [s for s, _ in found]
+            ids[i, :len(found)] = [n for _, n in found]
+        return scores, ids
+
+
+class QuantizedIndex(Tombstones):
+    """
+    Exhaustive search over compressed codes ('sq8': 1 byte per dimension, 'pq': 1 byte per subspace, see
+    search.quantization) with asymmetric distance computation: the float queries are scored against the codes
+    directly, in chunks, without decoding the gallery. The `rerank` best candidates of each query can be re-scored
+    exactly against the float features; only those rows are then read, so memory-mapped store features are otherwise
+    never paged in and the resident gallery is the codes.
+    """
+
+    def __init__(self, features: np.ndarray, quantizer: str = 'sq8', rerank: int = 0, chunk_size: int = 16384,
+                 **quantizer_params):
+        """
+        :param features: (n, d) L2-normalized gallery embeddings
+        :param quantizer: one of search.quantization.QUANTIZERS
+        :param rerank: number of candidates re-scored exactly against the float features, 0 disables the re-rank
+        :param chunk_size: number of codes scored at once
+        :param quantizer_params: quantizer specific parameters (num_subspaces, num_centroids... for pq)
+        """
+        if quantizer not in QUANTIZERS:
+            raise ValueError(f"quantizer should be in {list(QUANTIZERS)}")
+        self.quantizer = QUANTIZERS[quantizer](features, **quantizer_params)
+        self.codes = RowBlocks([self.quantizer.encode(features)])
+        self.features = RowBlocks([features]) if rerank else None
+        self.rerank = rerank
+        self.chunk_size = chunk_size
+        self._init_rows(len(features))
+
+    @property
+    def code_size(self) -> int:
+        return self.quantizer.code_size
+
+    def _add(self, features, ids):
+        self.codes.append(self.quantizer.encode(features))
+        if self.features is not None:
+            self.features.append(features)
+
+    def search(self, queries: np.ndarray, k: int):
+        state = self.quantizer.lookup(queries)
+        scores, ids = _streaming_topk(lambda start, stop: self.quantizer.scores(state, self.codes.rows(start, stop)),
+                                      len(queries), len(self.codes), max(k, self.rerank), self.chunk_size,
+                                      self.deleted if self.num_deleted else None)
+        if not self.rerank:
+            return scores, ids
+        found = ids >= 0
+        exact = np.full(ids.shape, -np.inf, dtype=np.float32)
+        exact[found] = np.einsum('nd,nd->n', self.features[ids[found]], np.repeat(queries, found.sum(axis=1), axis=0))
+        scores, order = _topk(exact, min(k, len(self.codes)))
+        ids = np.take_along_axis(ids, order, axis=1)
+        ids[np.isneginf(scores)] = -1
+        return scores, ids
+
+
+class FaissIndex(Tombstones):
+    """
+    Same interface backed by faiss, `kind` is 'ivf' or 'hnsw' and the knobs keep their meaning. As in IVFFlatIndex,
+    nprobe is raised for the searches whose k is more than nprobe partitions hold, HNSW already explores
+    max(ef_search, k) candidates
+    """
+
+    def __init__(self, features: np.ndarray, kind: str = 'hnsw', nlist: int = None, nprobe: int = 8, M: int = 16,
+                 ef_construction: int = 100, ef_search: int = 64):
+        if faiss is None:
+            raise ImportError("faiss is not installed, use one of the numpy backends")
+        features = np.ascontiguousarray(features, dtype=np.float32)
+        self._init_rows(len(features))
+        dim = features.shape[1]
+        self.kind = kind
+        self.nprobe = nprobe
+        if kind == 'ivf':
+            nlist = min(nlist or int(4 * math.sqrt(len(features))), len(features))
+            self.index = faiss.IndexIVFFlat(faiss.IndexFlatIP(dim), dim, nlist, faiss.METRIC_INNER_PRODUCT)
+            self.index.train(features)
+            self.index.nprobe = nprobe
+        elif kind == 'hnsw':
+            self.index = faiss.IndexHNSWFlat(dim, M, faiss.METRIC_INNER_PRODUCT)
+            self.index.hnsw.efConstruction = ef_construction
+            self.index.hnsw.efSearch = ef_search
+        else:
+            raise ValueError("kind should be in ['ivf', 'hnsw']")
+        self.index.add(features)
+
+    def _add(self, features, ids):
+        self.index.add(np.ascontiguousarray(features))
+
+    def search(self, queries: np.ndarray, k: int):
+        k = min(k, len(self))
+        # over-fetch by the number of tombstones, then keep the k best live rows
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        fetch = min(k + self.num_deleted, self.index.ntotal)
+        if self.kind == 'ivf':
+            # enough partitions of average size to hold fetch rows, doubled while some results are still missing
+            self.index.nprobe = min(max(self.nprobe, math.ceil(2 * fetch * self.index.nlist / self.index.ntotal)), self.index.nlist)
+        scores, ids = self.index.search(queries, fetch)
+        while self.kind == 'ivf' and (ids[:, -1] < 0).any() and self.index.nprobe < self.index.nlist:
+            self.index.nprobe = min(2 * self.index.nprobe, self.index.nlist)
+            scores, ids = self.index.search(queries, fetch)
+        if not self.num_deleted:
+            return scores, ids
+        live = ids >= 0
+        live[live] = ~self.deleted[ids[live]]
+        order = np.argsort(~live, axis=1, kind='stable')[:, :k]
+        scores, ids, live = (np.take_along_axis(a, order, axis=1) for a in (scores, ids, live))
+        scores[~live], ids[~live] = -np.inf, -1
+        return scores, ids
+
+
+INDEX_BACKENDS = {
+    'brute_force': BruteForceIndex,
+    'ivf': IVFFlatIndex,
+    'hnsw': HNSWIndex,
+    'sq8': lambda features, **params: QuantizedIndex(features, quantizer='sq8', **params),
+    'pq': lambda features, **params: QuantizedIndex(features, quantizer='pq', **params),
+    'faiss_ivf': lambda features, **params: FaissIndex(features, kind='ivf', **params),
+    'faiss_hnsw': lambda features, **params: FaissIndex(features, kind='hnsw', **params),
+}
+
+
+def build_index(backend: str, features: np.ndarray, **params):
+    """
+    :param backend: one of INDEX_BACKENDS
+    :param features: (n, d) L2-normalized gallery embeddings
+    :param params: backend specific parameters (nlist/nprobe for ivf, M/ef_construction/ef_search for hnsw,
+        rerank for sq8, rerank/num_subspaces for pq)
+    :return: an index exposing search(queries, k) -> (scores, ids), add(features) -> ids and remove(ids)
+    """
+    if backend not in INDEX_BACKENDS:
+        raise ValueError(f"backend should be in {list(INDEX_BACKENDS)}")
+    return INDEX_BACKENDS[backend](np.asarray(features, dtype=np.float32), **params)
+
+
+def measure_recall(index, exact_index, queries: np.ndarray, k: int) -> float:
+    """
+    Recall@k of an approximate index: the fraction of the exact k nearest neighbours it returns
+    :param index: index under test
+    :param exact_index: reference index, usually a BruteForceIndex over the same features
+    :param queries: (q, d) L2-normalized queries
+    :param k: number of neighbours
+    :return: recall in [0, 1]
+    """
+    _, ids = index.search(queries, k)
+    _, exact_ids = exact_index.search(queries, k)
+    hits = sum(len(np.intersect1d(found, expected)) for found, expected in zip(ids, exact_ids))
+    return hits / exact_ids.size
+
+
+def recall_report(features: np.ndarray, queries: np.ndarray, k: int, configs: dict) -> dict:
+    """
+    Recall@k loss of approximate or compressed indexes against the exact float search over the same features
+    :param features: (n, d) L2-normalized gallery embeddings
+    :param queries: (q, d) L2-normalized queries
+    :param k: number of neighbours
+    :param configs: {name: (backend, params)} of the indexes to compare, e.g. {'pq+rerank': ('pq', {'rerank': 100})}
+    :return: {name: {'recall': recall@k, 'bytes_per_vector': gallery memory per row, 'search_ms': latency per query}}
+    """
+    exact_index = BruteForceIndex(np.asarray(features, dtype=np.float32))
+    report = {}
+    for name, (backend, params) in configs.items():
+        index = build_index(backend, features, **params)
+        start = time.perf_counter()
+        index.search(queries, k)
+        search_ms = (time.perf_counter() - start) * 1000 / len(queries)
+        report[name] = {'recall': measure_recall(index, exact_index, queries, k),
+                        'bytes_per_vector': getattr(index, 'code_size', 4 * features.shape[1]),
+                        'search_ms': search_ms}
+    return report
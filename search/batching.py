@@ -0,0 +1,138 @@
+import time
+import queue
+import threading
+from collections import Counter, deque
+from concurrent.futures import Future
+import numpy as np
+
+
+class MicroBatcher:
+    """
+    Coalesce concurrent requests into batches. Callers submit single items and get a Future back, a worker thread
+    waits until `max_batch_size` items are queued or the oldest one has waited `max_wait_ms`, runs `process_fn` once on
+    the whole batch and fans the results back out to the futures. When process_fn raises, the batch is split in halves
+    that are processed again, so the exception only reaches the futures of the items it fails on.
+    """
+
+    def __init__(self, process_fn: callable, max_batch_size: int = 16, max_wait_ms: float = 5.0, window: int = 10000,
+                 name: str = 'micro-batcher'):
+        """
+        :param process_fn: function mapping a list of items to a list of results of the same length
+        :param max_batch_size: largest batch handed to process_fn
+        :param max_wait_ms: longest time the first item of a batch waits for company
+        :param window: number of recent batches/requests the latency statistics are computed on
+        :param name: name of the worker thread
+        """
+        self.process_fn = process_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._batch_sizes = Counter()
+        self._queue_delays = deque(maxlen=window)
+        self._batch_latencies = deque(maxlen=window)
+        self._closed = False
+        self._worker = threading.Thread(target=self._run, name=name, daemon=True)
+        self._worker.start()
+
+    def submit(self, item) -> Future:
+        """
+        :param item: one request, as expected by process_fn
+        :return: Future resolved with the result of the item
+        """
+        if self._closed:
+            raise RuntimeError("the batcher is closed")
+        future = Future()
+        self._queue.put((item, future, time.perf_counter()))
+        return future
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def close(self):
+        self._closed = True
+        self._queue.put(None)
+        self._worker.join()
+
+    def _collect(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = first[2] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                entry = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if entry is None:
+                self._queue.put(None)
+                break
+            batch.append(entry)
+        return batch
+
+    def _process(self, batch):
+        try:
+            results = self.process_fn([item for item, _, _ in batch])
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+                return
+            # bisect the failed batch, so that only the futures of the items process_fn fails on get the exception
+            middle = len(batch) // 2
+            self._process(batch[:middle])
+            self._process(batch[middle:])
+            return
+        results = list(results)
+        if len(results) != len(batch):
+            # results cannot be matched to items, fail the batch rather than leaving futures pending forever
+            error = RuntimeError(f"process_fn returned {len(results)} results for {len(batch)} items")
+            for _, future, _ in batch:
+                future.set_exception(error)
+            return
+        for (_, future, _), result in zip(batch, results):
+            future.set_result(result)
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            start = time.perf_counter()
+            self._process(batch)
+            with self._lock:
+                self._batch_sizes[len(batch)] += 1
+                self._queue_delays.extend(start - enqueued for _, _, enqueued in batch)
+                self._batch_latencies.append(time.perf_counter() - start)
+
+    def stats(self) -> dict:
+        """
+        :return: batch-size histogram and queue-delay / batch-latency percentiles (milliseconds)
+        """
+        with self._lock:
+            batch_sizes = dict(sorted(self._batch_sizes.items()))
+            queue_delays = np.array(self._queue_delays) * 1000
+            batch_latencies = np.array(self._batch_latencies) * 1000
+
+        def summary(values):
+            if not len(values):
+                return {}
+            p50, p90, p99 = np.percentile(values, [50, 90, 99])
+            return {'mean': float(values.mean()), 'p50': float(p50), 'p90': float(p90), 'p99': float(p99),
+                    'max': float(values.max())}
+
+        num_batches = sum(batch_sizes.values())
+        num_requests = sum(size * count for size, count in batch_sizes.items())
+        return {
+            'max_batch_size': self.max_batch_size,
+            'max_wait_ms': self.max_wait * 1000,
+            'queue_depth': self.queue_depth,
+            'batches': num_batches,
+            'requests': num_requests,
+            'mean_batch_size': num_requests / num_batches if num_batches else 0.0,
+            'batch_size_histogram': batch_sizes,
+            'queue_delay_ms': summary(queue_delays),
+            'batch_latency_ms': summary(batch_latencies),
+        }
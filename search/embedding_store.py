@@ -0,0 +1,468 @@
+import os
+import json
+import shutil
+import hashlib
+import threading
+import contextlib
+from collections import namedtuple
+import numpy as np
+
+from search.row_blocks import RowBlocks
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+STORE_VERSION = 1
+CURRENT_FILE = 'CURRENT'
+LOCK_FILE = 'LOCK'
+OVERRIDES_FILE = 'overrides.json'
+
+# aligned memory-mapped arrays of one segment of a generation, metadata is None when the store has no metadata_fn
+Segment = namedtuple('Segment', ['features', 'paths', 'stats', 'metadata'])
+
+
+class FingerprintMismatch(ValueError):
+    """
+    Raised when a store on disk was built by a different model, checkpoint or preprocess pipeline
+    """
+
+
+def file_fingerprint(path: str, chunk_size: int = 1 << 20) -> str:
+    """
+    Cheap content fingerprint of a (large) file: its size plus the sha256 of its first and last chunk
+    :param path: path of the file to fingerprint
+    :param chunk_size: number of bytes read from the head and from the tail of the file
+    :return: hex digest
+    """
+    size = os.path.getsize(path)
+    digest = hashlib.sha256(str(size).encode())
+    with open(path, 'rb') as f:
+        digest.update(f.read(chunk_size))
+        if size > chunk_size:
+            f.seek(max(size - chunk_size, chunk_size))
+            digest.update(f.read(chunk_size))
+    return digest.hexdigest()
+
+
+def model_fingerprint(cfg, checkpoint_path: str, input_dim: int) -> dict:
+    """
+    Describe everything the gallery embeddings depend on
+    :param cfg: the Config used to build the model and the preprocess pipeline
+    :param checkpoint_path: path of the trained TransAgg weights
+    :param input_dim: preprocessing output dimension
+    :return: json serializable fingerprint
+    """
+    return {
+        'model_name': cfg.model_name,
+        'checkpoint': file_fingerprint(checkpoint_path),
+        'preprocess': {'transform': cfg.transform, 'target_ratio': cfg.target_ratio, 'input_dim': input_dim},
+    }
+
+
+def fingerprint_id(fingerprint: dict) -> str:
+    """
+    :param fingerprint: fingerprint returned by model_fingerprint
+    :return: short stable identifier of the fingerprint, usable as a cache key
+    """
+    return hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def stat_files(paths) -> np.ndarray:
+    """
+    Stat a list of files with one scan per directory rather than one lookup per path: missing files cost nothing and
+    on Windows the scan already holds the stat results. Catalog images mostly share a handful of directories.
+    :param paths: image paths
+    :return: int64 array of shape (len(paths), 2) holding (mtime_ns, size), -1 for missing files
+    """
+    stats = np.full((len(paths), 2), -1, dtype=np.int64)
+    by_directory = {}
+    for i, path in enumerate(paths):
+        directory, name = os.path.split(path)
+        by_directory.setdefault(directory, {}).setdefault(name, []).append(i)
+    for directory, names in by_directory.items():
+        try:
+            with os.scandir(directory or '.') as entries:
+                for entry in entries:
+                    rows = names.get(entry.name)
+                    if rows is None:
+                        continue
+                    try:
+                        st = entry.stat()
+                    except OSError:
+                        continue
+                    stats[rows] = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            continue
+    return stats
+
+
+class StoreSnapshot:
+    """
+    One revision of a generation of a category in the store. The rows are split in memory-mapped segments: the
+    first one is written with the generation, the next ones by `append`. Row ids run across the segments in order
+    and features, paths and stats are RowBlocks over them:
+        - features: float32 (N, D), L2-normalized gallery embeddings
+        - paths: str (N,), image paths
+        - stats: int64 (N, 2), (mtime_ns, size) of each image when it was encoded
+        - metadata: structured (N,), per row records built by the store's metadata_fn, None without one
+        - deleted: bool (N,), rows tombstoned by `remove` until the next compaction
+    """
+
+    def __init__(self, generation: int, segments: list, deleted: np.ndarray, revision: int = 0):
+        self.generation = generation
+        self.revision = revision
+        self.segments = segments
+        self.features = RowBlocks([segment.features for segment in segments])
+        self.paths = RowBlocks([segment.paths for segment in segments])
+        self.stats = RowBlocks([segment.stats for segment in segments])
+        self.metadata = None
+        if segments[0].metadata is not None:
+            self.metadata = RowBlocks([segment.metadata for segment in segments])
+        self.deleted = deleted
+
+    def __len__(self):
+        return len(self.deleted) - int(self.deleted.sum())
+
+    def live_rows(self) -> np.ndarray:
+        return np.flatnonzero(~self.deleted)
+
+
+class EmbeddingStore:
+    """
+    Versioned on-disk store of gallery embeddings, one sub directory per category:
+        <root>/<category>/CURRENT                      name of the live generation
+        <root>/<category>/gen-<n>/manifest.json        format version, fingerprint, shape
+        <root>/<category>/gen-<n>/{features,paths,stats,metadata}.npy
+        <root>/<category>/gen-<n>/segment-<r>/         rows appended by revision r
+        <root>/<category>/gen-<n>/tombstones-<r>.npy    ids of the rows removed up to revision r
+        <root>/<category>/overrides.json               images added or removed on top of the catalog list
+    A new generation is written next to the live one and published by atomically replacing CURRENT, a new revision
+    by atomically replacing its manifest, so readers never observe a half written store. Writers of a category are
+    serialized by a lock file.
+    """
+
+    def __init__(self, root: str, fingerprint: dict, metadata_fn: callable = None):
+        """
+        :param root: directory holding the store
+        :param fingerprint: fingerprint of the model producing the embeddings, see model_fingerprint
+        :param metadata_fn: optional function mapping the paths of a segment to a structured array of per row
+            metadata, computed once when the segment is written and memory-mapped with the embeddings
+        """
+        self.root = root
+        self.fingerprint = json.loads(json.dumps(fingerprint))
+        self.metadata_fn = metadata_fn
+        self._thread_lock = threading.Lock()
+
+    def _category_dir(self, category):
+        return os.path.join(self.root, category)
+
+    @contextlib.contextmanager
+    def _locked(self, category):
+        category_dir = self._category_dir(category)
+        os.makedirs(category_dir, exist_ok=True)
+        if fcntl is None:
+            with self._thread_lock:
+                yield
+            return
+        with open(os.path.join(category_dir, LOCK_FILE), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _current_generation(self, category):
+        try:
+            with open(os.path.join(self._category_dir(category), CURRENT_FILE)) as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def generation(self, category: str):
+        """
+        :param category: catalog category
+        :return: number of the live generation of the category, None if nothing was stored yet
+        """
+        current = self._current_generation(category)
+        return None if current is None else int(current[len('gen-'):])
+
+    def head(self, category: str):
+        """
+        :param category: catalog category
+        :return: (generation, revision) of the live store of the category, None if nothing was stored yet
+        """
+        generation = self._current_generation(category)
+        if generation is None:
+            return None
+        with open(os.path.join(self._category_dir(category), generation, 'manifest.json')) as f:
+            manifest = json.load(f)
+        return manifest['generation'], manifest.get('revision', 0)
+
+    def _load_segment(self, segment_dir):
+        paths = np.load(os.path.join(segment_dir, 'paths.npy'), mmap_mode='r')
+        metadata = None
+        if self.metadata_fn is not None:
+            metadata_file = os.path.join(segment_dir, 'metadata.npy')
+            if os.path.exists(metadata_file):
+                metadata = np.load(metadata_file, mmap_mode='r')
+                if metadata.dtype != self.metadata_fn(paths[:0]).dtype:  # written by an older metadata_fn
+                    metadata = self.metadata_fn(paths)
+            else:  # segment written without a metadata_fn
+                metadata = self.metadata_fn(paths)
+        return Segment(
+            # copy-on-write so that torch.from_numpy can wrap the mapping without copying it
+            np.load(os.path.join(segment_dir, 'features.npy'), mmap_mode='c'),
+            paths,
+            np.load(os.path.join(segment_dir, 'stats.npy'), mmap_mode='r'),
+            metadata,
+        )
+
+    def _save_segment(self, segment_dir, features, paths, stats):
+        os.makedirs(segment_dir)
+        np.save(os.path.join(segment_dir, 'features.npy'), features)
+        np.save(os.path.join(segment_dir, 'paths.npy'), paths)
+        np.save(os.path.join(segment_dir, 'stats.npy'), stats)
+        if self.metadata_fn is not None:
+            np.save(os.path.join(segment_dir, 'metadata.npy'), self.metadata_fn(paths))
+
+    @staticmethod
+    def _save_json(path, value):
+        with open(path + '.tmp', 'w') as f:
+            json.dump(value, f, indent=2)
+        os.replace(path + '.tmp', path)
+
+    def load(self, category: str):
+        """
+        :param category: catalog category
+        :return: the live StoreSnapshot of the category, None if nothing was stored yet
+        :raise FingerprintMismatch: if the store was built by a different model, checkpoint or preprocess
+        """
+        generation = self._current_generation(category)
+        if generation is None:
+            return None
+        generation_dir = os.path.join(self._category_dir(category), generation)
+        with open(os.path.join(generation_dir, 'manifest.json')) as f:
+            manifest = json.load(f)
+        if manifest.get('version') != STORE_VERSION:
+            raise FingerprintMismatch(f"store format {manifest.get('version')} != {STORE_VERSION}")
+        if manifest['fingerprint'] != self.fingerprint:
+            raise FingerprintMismatch(f"store for '{category}' was built with {manifest['fingerprint']}")
+        segments = [self._load_segment(generation_dir)]
+        segments += [self._load_segment(os.path.join(generation_dir, name)) for name in manifest.get('segments', [])]
+        deleted = np.zeros(sum(len(segment.paths) for segment in segments), dtype=bool)
+        if manifest.get('tombstones'):
+            deleted[np.load(os.path.join(generation_dir, manifest['tombstones']))] = True
+        return StoreSnapshot(manifest['generation'], segments, deleted, manifest.get('revision', 0))
+
+    def overrides(self, category: str) -> dict:
+        """
+        :param category: catalog category
+        :return: {'added': [...], 'removed': [...]} images appended or removed on top of the catalog list
+        """
+        try:
+            with open(os.path.join(self._category_dir(category), OVERRIDES_FILE)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'added': [], 'removed': []}
+
+    def _record_overrides(self, category, added=(), removed=()):
+        overrides = self.overrides(category)
+        added_set, removed_set = set(added), set(removed)
+        added = [p for p in overrides['added'] if p not in removed_set] + list(added)
+        removed = [p for p in overrides['removed'] if p not in added_set] + list(removed)
+        overrides['added'], overrides['removed'] = list(dict.fromkeys(added)), list(dict.fromkeys(removed))
+        self._save_json(os.path.join(self._category_dir(category), OVERRIDES_FILE), overrides)
+
+    @staticmethod
+    def _encode(paths, encode_fn):
+        features, ok = encode_fn(paths)
+        features = np.asarray(features, dtype=np.float32)
+        features /= np.linalg.norm(features, axis=-1, keepdims=True)
+        return features, np.asarray(ok, dtype=bool)
+
+    def _live_rows_by_path(self, snapshot):
+        live = snapshot.live_rows()
+        return dict(zip(np.asarray(snapshot.paths[live]).tolist(), live.tolist()))
+
+    def update(self, category: str, paths: list, encode_fn: callable):
+        """
+        Bring the store of a category in line with a list of images, encoding only new or modified files. The
+        result is a new compacted generation, or the live snapshot when it already holds exactly these images.
+        :param category: catalog category
+        :param paths: image paths the category should contain, in order
+        :param encode_fn: function mapping a list of paths to (features, ok) where ok is a boolean mask over the
+            paths and features a float array with one row per True entry of ok
+        :return: the live StoreSnapshot after the update, None if none of the images could be encoded
+        """
+        with self._locked(category):
+            try:
+                snapshot = self.load(category)
+            except FingerprintMismatch as e:
+                print(f"Discarding embedding store for '{category}': {e}")
+                snapshot = None
+
+            stats = stat_files(paths)
+            rows = np.full(len(paths), -1, dtype=np.int64)
+            if snapshot is not None:
+                stored = self._live_rows_by_path(snapshot)
+                for i, path in enumerate(paths):
+                    j = stored.get(path)
+                    if j is not None and (snapshot.stats[j] == stats[i]).all():
+                        rows[i] = j
+
+            to_encode = np.flatnonzero((rows < 0) & (stats[:, 0] >= 0))
+            print(f"'{category}': {int((rows >= 0).sum())} cached embeddings, {len(to_encode)} images to encode")
+            keep = rows >= 0
+            if len(to_encode):
+                new_features, ok = self._encode([paths[i] for i in to_encode], encode_fn)
+                keep[to_encode[ok]] = True
+            if not keep.any():
+                return None
+            # missing and undecodable images are never stored: when every image that could be embedded is already
+            # stored, in order, the live snapshot is the result and no generation is written
+            if snapshot is not None and not (keep & (rows < 0)).any() and np.array_equal(rows[keep], snapshot.live_rows()):
+                return snapshot
+
+            feature_dim = snapshot.features.shape[1] if snapshot is not None else new_features.shape[1]
+            features = np.empty((int(keep.sum()), feature_dim), dtype=np.float32)
+            reused = rows[keep] >= 0
+            if reused.any():
+                features[reused] = snapshot.features[rows[keep][reused]]
+            if (~reused).any():
+                features[~reused] = new_features
+            kept_paths = np.array([path for path, k in zip(paths, keep) if k], dtype=str)
+            return self._write(category, features, kept_paths, stats[keep])
+
+    def append(self, category: str, paths: list, encode_fn: callable):
+        """
+        Add images to a category as a new segment of the live generation. Images already stored and unchanged are
+        skipped, modified ones are re-encoded and their previous row tombstoned.
+        :param category: catalog category
+        :param paths: image paths to add
+        :param encode_fn: see update
+        :return: the live StoreSnapshot after the append, None if the category is empty and none of the images
+            could be encoded
+        """
+        paths = list(dict.fromkeys(paths))
+        with self._locked(category):
+            self._record_overrides(category, added=paths)
+            snapshot = self.load(category)
+            if snapshot is None:
+                stats = stat_files(paths)
+                valid = np.flatnonzero(stats[:, 0] >= 0)
+                if not len(valid):
+                    return None
+                features, ok = self._encode([paths[i] for i in valid], encode_fn)
+                if not ok.any():
+                    return None
+                kept_paths = np.array([paths[i] for i in valid[ok]], dtype=str)
+                return self._write(category, features, kept_paths, stats[valid[ok]])
+
+            stats = stat_files(paths)
+            stored = self._live_rows_by_path(snapshot)
+            to_encode, replaced = [], []
+            for i, path in enumerate(paths):
+                j = stored.get(path)
+                if stats[i, 0] < 0 or (j is not None and (snapshot.stats[j] == stats[i]).all()):
+                    continue
+                to_encode.append(i)
+                replaced.append(-1 if j is None else j)
+            print(f"'{category}': appending {len(to_encode)} images")
+            if not to_encode:
+                return snapshot
+            features, ok = self._encode([paths[i] for i in to_encode], encode_fn)
+            to_encode, replaced = np.array(to_encode)[ok], np.array(replaced)[ok]
+            if not len(to_encode):
+                return snapshot
+            return self._write_revision(category, snapshot, features,
+                                        np.array([paths[i] for i in to_encode], dtype=str), stats[to_encode],
+                                        replaced[replaced >= 0])
+
+    def remove(self, category: str, paths: list):
+        """
+        Tombstone images of a category, they are dropped for good by the next compaction
+        :param category: catalog category
+        :param paths: image paths to remove
+        :return: the live StoreSnapshot after the removal, None if nothing was stored yet
+        """
+        with self._locked(category):
+            self._record_overrides(category, removed=paths)
+            snapshot = self.load(category)
+            if snapshot is None:
+                return None
+            stored = self._live_rows_by_path(snapshot)
+            rows = np.array([stored[path] for path in dict.fromkeys(paths) if path in stored], dtype=np.int64)
+            print(f"'{category}': removing {len(rows)} images")
+            if not len(rows):
+                return snapshot
+            return self._write_revision(category, snapshot, None, None, None, rows)
+
+    def compact(self, category: str):
+        """
+        Rewrite a category as a new single segment generation without its tombstoned rows
+        :param category: catalog category
+        :return: the live StoreSnapshot after the compaction, None if nothing was stored yet
+        """
+        with self._locked(category):
+            snapshot = self.load(category)
+            if snapshot is None or (len(snapshot.segments) == 1 and not snapshot.deleted.any()):
+                return snapshot
+            live = snapshot.live_rows()
+            print(f"'{category}': compacting {len(snapshot.deleted)} rows into {len(live)}")
+            return self._write(category, snapshot.features[live], snapshot.paths[live], snapshot.stats[live])
+
+    def _write_revision(self, category, snapshot, features, paths, stats, removed_rows):
+        generation_dir = os.path.join(self._category_dir(category), f'gen-{snapshot.generation:06d}')
+        manifest_path = os.path.join(generation_dir, 'manifest.json')
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        revision = manifest.get('revision', 0) + 1
+        manifest['revision'] = revision
+        if features is not None:
+            name = f'segment-{revision:06d}'
+            self._save_segment(os.path.join(generation_dir, name), features, paths, stats)
+            manifest['segments'] = manifest.get('segments', []) + [name]
+        previous_tombstones = manifest.get('tombstones')
+        if len(removed_rows):
+            name = f'tombstones-{revision:06d}.npy'
+            np.save(os.path.join(generation_dir, name),
+                    np.union1d(np.flatnonzero(snapshot.deleted), removed_rows).astype(np.int64))
+            manifest['tombstones'] = name
+        manifest['count'] = len(snapshot) + (0 if paths is None else len(paths)) - len(removed_rows)
+        self._save_json(manifest_path, manifest)
+        # the previous tombstones are kept for readers that read the manifest before it was replaced
+        for entry in os.listdir(generation_dir):
+            if entry.startswith('tombstones-') and entry not in (manifest.get('tombstones'), previous_tombstones):
+                os.remove(os.path.join(generation_dir, entry))
+        return self.load(category)
+
+    def _write(self, category, features, paths, stats):
+        category_dir = self._category_dir(category)
+        current = self.generation(category)
+        generation = 0 if current is None else current + 1
+        name = f'gen-{generation:06d}'
+        generation_dir = os.path.join(category_dir, name)
+        shutil.rmtree(generation_dir, ignore_errors=True)
+        self._save_segment(generation_dir, features, paths, stats)
+        manifest = {'version': STORE_VERSION, 'generation': generation, 'fingerprint': self.fingerprint,
+                    'count': len(paths), 'feature_dim': features.shape[1], 'revision': 0}
+        with open(os.path.join(generation_dir, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+        current_file = os.path.join(category_dir, CURRENT_FILE)
+        with open(current_file + '.tmp', 'w') as f:
+            f.write(name)
+        os.replace(current_file + '.tmp', current_file)
+        self._remove_stale_generations(category_dir, generation)
+        return self.load(category)
+
+    @staticmethod
+    def _remove_stale_generations(category_dir, generation):
+        # the previous generation is kept for readers that opened it before CURRENT was replaced
+        keep = {f'gen-{generation:06d}', f'gen-{generation - 1:06d}'}
+        for entry in os.listdir(category_dir):
+            if entry.startswith('gen-') and entry not in keep:
+                # still memory-mapped by another process on Windows, retried on the next write
+                shutil.rmtree(os.path.join(category_dir, entry), ignore_errors=True)
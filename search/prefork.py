@@ -0,0 +1,112 @@
+import os
+import time
+import signal
+import socket
+
+
+class PreforkServer:
+    """
+    Pre-fork process manager for an ASGI app: the master binds the listening socket, optionally loads shared state,
+    then forks `workers` uvicorn servers that accept on the inherited socket. Anything the master loaded before
+    forking (model weights, memory-mapped arrays) is shared copy-on-write by the workers. Crashed workers are
+    restarted, SIGTERM/SIGINT stop the workers gracefully and SIGHUP calls `on_reload` in the master.
+    POSIX only, os.fork is not available on Windows.
+    """
+
+    def __init__(self, app: str, host: str = '0.0.0.0', port: int = 5000, workers: int = 4, backlog: int = 2048,
+                 worker_init: callable = None, on_reload: callable = None, **uvicorn_kwargs):
+        """
+        :param app: import string of the ASGI app, "module:attribute"
+        :param host: address to bind
+        :param port: port to bind
+        :param workers: number of worker processes
+        :param backlog: listen backlog of the shared socket
+        :param worker_init: called in every worker right after the fork
+        :param on_reload: called in the master on SIGHUP
+        :param uvicorn_kwargs: extra uvicorn.Config arguments
+        """
+        self.app = app
+        self.host = host
+        self.port = port
+        self.num_workers = workers
+        self.backlog = backlog
+        self.worker_init = worker_init
+        self.on_reload = on_reload
+        self.uvicorn_kwargs = uvicorn_kwargs
+        self.workers = {}  # pid -> worker number
+        self._stopping = False
+        self._reload_requested = False
+
+    def _bind(self):
+        family = socket.AF_INET6 if ':' in self.host else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(self.backlog)
+        sock.set_inheritable(True)
+        return sock
+
+    def _spawn(self, sock, number):
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = number
+            return
+        # worker: uvicorn installs its own SIGTERM/SIGINT handlers
+        for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(sig, signal.SIG_DFL)
+        status = 1
+        try:
+            import uvicorn
+            if self.worker_init is not None:
+                self.worker_init()
+            config = uvicorn.Config(self.app, **self.uvicorn_kwargs)
+            uvicorn.Server(config).run(sockets=[sock])
+            status = 0
+        finally:
+            os._exit(status)
+
+    def _stop(self, signum, frame):
+        self._stopping = True
+
+    def _request_reload(self, signum, frame):
+        self._reload_requested = True
+
+    def serve(self):
+        if not hasattr(os, 'fork'):
+            raise RuntimeError("pre-fork workers need os.fork, run `uvicorn ecommerce_asgi:app` on this platform")
+        sock = self._bind()
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGHUP, self._request_reload)
+        print(f"Listening on {self.host}:{self.port} with {self.num_workers} workers (master pid {os.getpid()})")
+        for number in range(self.num_workers):
+            self._spawn(sock, number)
+
+        while not self._stopping:
+            if self._reload_requested:
+                self._reload_requested = False
+                if self.on_reload is not None:
+                    try:
+                        self.on_reload()
+                    except Exception as e:
+                        print(f"Reload failed: {e}")
+            self._reap(respawn_on=sock)
+            time.sleep(0.5)
+
+        for pid in self.workers:
+            os.kill(pid, signal.SIGTERM)
+        while self.workers:
+            pid, _ = os.waitpid(-1, 0)
+            self.workers.pop(pid, None)
+        sock.close()
+
+    def _reap(self, respawn_on):
+        while self.workers:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                return
+            number = self.workers.pop(pid, None)
+            if number is None:
+                continue
+            print(f"Worker {number} (pid {pid}) exited with status {status}, restarting it")
+            self._spawn(respawn_on, number)
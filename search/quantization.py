@@ -0,0 +1,159 @@
+import numpy as np
+
+
+def kmeans(features: np.ndarray, num_clusters: int, num_iters: int = 20, seed: int = 0) -> np.ndarray:
+    """
+    Euclidean k-means used to train the product quantizer codebooks
+    :param features: (n, d) vectors
+    :param num_clusters: number of centroids, at most n
+    :param num_iters: number of Lloyd iterations
+    :param seed: seed of the centroid initialization
+    :return: (num_clusters, d) centroids
+    """
+    rng = np.random.default_rng(seed)
+    centroids = features[rng.choice(len(features), num_clusters, replace=False)].copy()
+    for _ in range(num_iters):
+        # argmin ||x - c||^2 == argmax x.c - ||c||^2 / 2
+        assignment = np.argmax(features @ centroids.T - 0.5 * (centroids ** 2).sum(axis=1), axis=1)
+        counts = np.bincount(assignment, minlength=num_clusters)
+        sums = np.stack([np.bincount(assignment, weights=features[:, j], minlength=num_clusters)
+                         for j in range(features.shape[1])], axis=1)
+        empty = counts == 0
+        sums[empty], counts[empty] = features[rng.choice(len(features), int(empty.sum()))], 1
+        centroids = (sums / counts[:, None]).astype(features.dtype)
+    return centroids
+
+
+class ScalarQuantizer:
+    """
+    8-bit scalar quantization: every dimension is mapped linearly from its [min, max] range over the training vectors
+    to 0..255, 1 byte per dimension (4x smaller than float32). Rows added later are clipped to the trained range.
+    """
+
+    def __init__(self, features: np.ndarray):
+        """
+        :param features: (n, d) training vectors
+        """
+        self.vmin = features.min(axis=0).astype(np.float32)
+        self.scale = (np.maximum(features.max(axis=0) - self.vmin, 1e-12) / 255).astype(np.float32)
+        self.code_size = features.shape[1]
+
+    def encode(self, features: np.ndarray) -> np.ndarray:
+        """
+        :param features: (n, d) vectors
+        :return: (n, d) uint8 codes
+        """
+        return np.clip(np.rint((features - self.vmin) / self.scale), 0, 255).astype(np.uint8)
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        return self.vmin + codes * self.scale
+
+    def lookup(self, queries: np.ndarray):
+        """
+        Query side of the asymmetric distance: q.decode(c) = q.vmin + (q * scale).c
+        :param queries: (q, d) float queries
+        :return: state passed to scores
+        """
+        return queries @ self.vmin, (queries * self.scale).astype(np.float32)
+
+    def scores(self, state, codes: np.ndarray, chunk_size: int = 2048) -> np.ndarray:
+        """
+        :param state: lookup(queries)
+        :param codes: (n, d) codes
+        :param chunk_size: number of codes converted to float32 at once, so the transient float copy stays at
+            chunk_size rows instead of 4x the whole block of codes
+        :return: (q, n) inner products of the float queries with the decoded rows
+        """
+        bias, weights = state
+        scores = np.empty((len(weights), len(codes)), dtype=np.float32)
+        for start in range(0, len(codes), chunk_size):
+            chunk = codes[start:start + chunk_size]
+            np.matmul(weights, chunk.T.astype(np.float32), out=scores[:, start:start + len(chunk)])
+        scores += bias[:, None]
+        return scores
+
+
+class ProductQuantizer:
+    """
+    Product quantization (Jegou et al.): the vectors are split into `num_subspaces` contiguous sub-vectors, each
+    replaced by the id of its nearest centroid in a per-subspace codebook of up to 256 entries, 1 byte per subspace.
+    Queries are scored with asymmetric distance computation, the float query against the reconstructed rows: a
+    (num_subspaces, 256) table of the inner products of the query with every centroid is summed over the codes of a
+    row, or for large query batches, where the table lookups cost more than reconstructing the rows, a chunk of rows
+    is decoded once and scored with a matrix product.
+    """
+
+    def __init__(self, features: np.ndarray, num_subspaces: int = 16, num_centroids: int = 256, num_iters: int = 20,
+                 max_train: int = 32768, seed: int = 0):
+        """
+        :param features: (n, d) training vectors, d divisible by num_subspaces
+        :param num_subspaces: number of sub-vectors, the code size in bytes
+        :param num_centroids: codebook size, at most 256
+        :param num_iters: k-means iterations per codebook
+        :param max_train: codebooks are trained on a random sample of at most this many vectors
+        :param seed: seed of the sample and of the k-means initializations
+        """
+        dim = features.shape[1]
+        if dim % num_subspaces:
+            raise ValueError(f"the dimension {dim} is not divisible by num_subspaces={num_subspaces}")
+        if not 0 < num_centroids <= 256:
+            raise ValueError("num_centroids should be in [1, 256]")
+        self.num_subspaces = num_subspaces
+        self.subspace_dim = dim // num_subspaces
+        self.code_size = num_subspaces
+        rng = np.random.default_rng(seed)
+        sample = np.sort(rng.choice(len(features), min(len(features), max_train), replace=False))
+        train = np.asarray(features[sample], dtype=np.float32).reshape(len(sample), num_subspaces, self.subspace_dim)
+        num_centroids = min(num_centroids, len(sample))
+        # (num_subspaces, num_centroids, subspace_dim)
+        self.codebooks = np.stack([kmeans(np.ascontiguousarray(train[:, m]), num_centroids, num_iters, seed + m)
+                                   for m in range(num_subspaces)])
+
+    def encode(self, features: np.ndarray, chunk_size: int = 65536) -> np.ndarray:
+        """
+        :param features: (n, d) vectors
+        :param chunk_size: number of rows encoded at once
+        :return: (n, num_subspaces) uint8 codes
+        """
+        codes = np.empty((len(features), self.num_subspaces), dtype=np.uint8)
+        half_norms = 0.5 * (self.codebooks ** 2).sum(axis=2)
+        for start in range(0, len(features), chunk_size):
+            chunk = np.asarray(features[start:start + chunk_size], dtype=np.float32)
+            chunk = chunk.reshape(len(chunk), self.num_subspaces, self.subspace_dim)
+            for m in range(self.num_subspaces):
+                closeness = chunk[:, m] @ self.codebooks[m].T - half_norms[m]
+                codes[start:start + len(chunk), m] = np.argmax(closeness, axis=1)
+        return codes
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        return self.codebooks[np.arange(self.num_subspaces), codes].reshape(len(codes), -1)
+
+    def lookup(self, queries: np.ndarray):
+        """
+        :param queries: (q, d) float queries
+        :return: state passed to scores, the queries and the (num_subspaces, q, num_centroids) inner products of their
+            sub-vectors with the centroids
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        if len(queries) >= self.subspace_dim:
+            return queries, None
+        tables = np.einsum('qmd,mkd->mqk', queries.reshape(len(queries), self.num_subspaces, -1), self.codebooks)
+        return queries, tables
+
+    def scores(self, state, codes: np.ndarray) -> np.ndarray:
+        """
+        :param state: lookup(queries)
+        :param codes: (n, num_subspaces) codes
+        :return: (q, n) inner products of the float queries with the decoded rows
+        """
+        queries, tables = state
+        # a lookup per query, row and subspace against a decode per row and dimension plus a BLAS product
+        if tables is None:
+            return queries @ self.decode(codes).T
+        scores = tables[0][:, codes[:, 0]]
+        for m in range(1, self.num_subspaces):
+            scores += tables[m][:, codes[:, m]]
+        return scores
+
+
+QUANTIZERS = {'sq8': ScalarQuantizer, 'pq': ProductQuantizer}
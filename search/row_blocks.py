@@ -0,0 +1,65 @@
+import numpy as np
+
+
+class RowBlocks:
+    """
+    Several arrays seen as one along their first axis, without copying them. The first block is usually a
+    memory-mapped store generation shared between processes and the next ones rows appended to it since.
+    """
+
+    def __init__(self, blocks=()):
+        """
+        :param blocks: arrays sharing their trailing dimensions
+        """
+        self.blocks = []
+        self.offsets = [0]  # block b owns the rows offsets[b]:offsets[b + 1]
+        for block in blocks:
+            self.append(block)
+
+    def append(self, block):
+        self.blocks.append(block)
+        self.offsets.append(self.offsets[-1] + len(block))
+
+    def __len__(self):
+        return self.offsets[-1]
+
+    @property
+    def shape(self):
+        return (len(self),) + self.blocks[0].shape[1:]
+
+    def __getitem__(self, ids):
+        """
+        :param ids: a row id or an integer array/list of row ids
+        :return: the row, or an array of the rows
+        """
+        if len(self.blocks) == 1:
+            return self.blocks[0][ids]
+        if isinstance(ids, (int, np.integer)):
+            block = int(np.searchsorted(self.offsets, ids, side='right')) - 1
+            return self.blocks[block][ids - self.offsets[block]]
+        ids = np.asarray(ids, dtype=np.int64)
+        block_ids = np.searchsorted(self.offsets, ids, side='right') - 1
+        dtype = np.result_type(*(block.dtype for block in self.blocks))
+        rows = np.empty((len(ids),) + self.blocks[0].shape[1:], dtype=dtype)
+        for block in np.unique(block_ids):
+            in_block = block_ids == block
+            rows[in_block] = self.blocks[block][ids[in_block] - self.offsets[block]]
+        return rows
+
+    def rows(self, start: int, stop: int) -> np.ndarray:
+        """
+        :return: rows start:stop, a view when they lie in a single block
+        """
+        first = int(np.searchsorted(self.offsets, start, side='right')) - 1
+        if stop <= self.offsets[first + 1]:
+            return self.blocks[first][start - self.offsets[first]:stop - self.offsets[first]]
+        return self[np.arange(start, stop)]
+
+    def dot(self, queries: np.ndarray) -> np.ndarray:
+        """
+        :param queries: (q, d) array
+        :return: (q, n) inner products of the queries with every row
+        """
+        if len(self.blocks) == 1:
+            return queries @ self.blocks[0].T
+        return np.concatenate([queries @ block.T for block in self.blocks], axis=1)
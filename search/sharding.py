@@ -0,0 +1,77 @@
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+import metrics
+from search.ann_index import _topk
+
+
+def merge_topk(scores: np.ndarray, ids: np.ndarray, k: int):
+    """
+    k-way merge of per-shard results. Rather than popping a heap per query, the (q, num_shards, k_s) candidates of
+    the whole batch are reduced by one argpartition, so the Python overhead does not grow with the number of shards
+    :param scores: (q, num_shards, k_s) per-shard scores sorted by decreasing similarity, -inf for missing results
+    :param ids: (q, num_shards, k_s) per-shard row ids, -1 for missing results
+    :param k: number of results to keep
+    :return: (scores, shards, ids) of shape (q, min(k, num_shards * k_s)), shards and ids are -1 for missing results
+    """
+    num_queries, num_shards, shard_k = scores.shape
+    top_scores, positions = _topk(scores.reshape(num_queries, -1), k)
+    shards = positions // shard_k
+    top_ids = np.take_along_axis(ids.reshape(num_queries, -1), positions, axis=1)
+    missing = top_ids < 0
+    shards[missing] = -1
+    return top_scores, shards, top_ids
+
+
+class ShardedSearch:
+    """
+    Fan a batch of queries out to several indexes (shards) in parallel and merge their top-k. Which shards a query
+    searches is a predicate, a boolean (q, num_shards) mask, so filters like a category are resolved by selecting
+    shards rather than by dedicated code paths. numpy releases the GIL in the scoring, the shards run concurrently.
+    """
+
+    def __init__(self, max_workers: int = 8, stage_metrics: metrics.StageMetrics = metrics.DISABLED):
+        """
+        :param max_workers: number of shards searched concurrently
+        :param stage_metrics: records the similarity stage (the shard searches, which interleave scoring and candidate
+            selection in the ANN backends) and the topk stage (the merge across shards)
+        """
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix='shard-search')
+        self.metrics = stage_metrics
+
+    def search(self, shards: list, queries: np.ndarray, k: int, mask: np.ndarray = None, search_fn: callable = None):
+        """
+        :param shards: objects exposing search(queries, k) -> (scores, ids)
+        :param queries: (q, d) L2-normalized query embeddings
+        :param k: number of results per query
+        :param mask: optional bool (q, len(shards)), whether query i searches shard s, all shards by default
+        :param search_fn: optional function (shard, queries, k) -> (scores, ids) used instead of shard.search
+        :return: (scores, shards, ids) of shape (q, k), sorted by decreasing similarity, ids are rows of the shard
+            and both are -1 for missing results
+        """
+        if not shards:
+            raise ValueError("at least one shard is needed")
+        if mask is None:
+            mask = np.ones((len(queries), len(shards)), dtype=bool)
+        if search_fn is None:
+            search_fn = lambda shard, shard_queries, shard_k: shard.search(shard_queries, shard_k)
+        scores = np.full((len(queries), len(shards), k), -np.inf, dtype=np.float32)
+        ids = np.full((len(queries), len(shards), k), -1, dtype=np.int64)
+
+        def search_shard(s):
+            rows = np.flatnonzero(mask[:, s])
+            if len(rows):
+                shard_scores, shard_ids = search_fn(shards[s], queries[rows], k)
+                scores[rows, s, :shard_ids.shape[1]] = shard_scores
+                ids[rows, s, :shard_ids.shape[1]] = shard_ids
+
+        with self.metrics.stage('similarity'):
+            if len(shards) == 1:
+                search_shard(0)
+            else:
+                list(self.executor.map(search_shard, range(len(shards))))
+        with self.metrics.stage('topk'):
+            return merge_topk(scores, ids, k)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
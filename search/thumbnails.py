@@ -0,0 +1,148 @@
+import os
+import hashlib
+import tempfile
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, features
+
+from cache import LRUCache
+from search.embedding_store import stat_files
+
+CONTENT_TYPES = {'webp': 'image/webp', 'jpeg': 'image/jpeg'}
+
+# encoded thumbnail held by the in-process cache, etag is a quoted strong validator of body
+Thumbnail = namedtuple('Thumbnail', ['body', 'etag', 'content_type'])
+
+
+class ThumbnailStore:
+    """
+    Resized WebP/JPEG variants of the product images, generated at indexing time (or on first request) under
+        <root>/<size>/<image name without extension>.{webp,jpeg}
+    and served with strong ETags, Cache-Control and conditional GET. The most requested thumbnails are kept encoded
+    in an LRU cache so that a page load reads neither the disk nor the full-size originals.
+    """
+
+    def __init__(self, root: str, source_dir: str, size: int = 320, quality: int = 80, max_age: int = 86400,
+                 cache_bytes: int = 64 * 1024 ** 2):
+        """
+        :param root: directory holding the thumbnails
+        :param source_dir: directory of the original images, thumbnails are named after their path relative to it
+        :param size: largest side of a thumbnail in pixels
+        :param quality: WebP/JPEG encoder quality
+        :param max_age: Cache-Control max-age of the responses in seconds
+        :param cache_bytes: capacity of the in-process cache of encoded thumbnails
+        """
+        self.root = root
+        self.source_dir = source_dir
+        self.size = size
+        self.quality = quality
+        self.max_age = max_age
+        self.formats = ['webp', 'jpeg'] if features.check('webp') else ['jpeg']
+        self.cache = LRUCache(cache_bytes, size_fn=lambda thumbnail: len(thumbnail.body))
+
+    def thumbnail_path(self, name: str, fmt: str) -> str:
+        return os.path.join(self.root, str(self.size), os.path.splitext(name)[0] + '.' + fmt)
+
+    def _is_fresh(self, name, source_path):
+        try:
+            source_mtime = os.stat(source_path).st_mtime_ns
+            return all(os.stat(self.thumbnail_path(name, fmt)).st_mtime_ns >= source_mtime for fmt in self.formats)
+        except FileNotFoundError:
+            return False
+
+    def _make(self, name, check_fresh=True):
+        source_path = os.path.join(self.source_dir, name)
+        if check_fresh and self._is_fresh(name, source_path):
+            return False
+        with Image.open(source_path) as image:
+            # let the JPEG decoder downscale by up to 8x instead of decoding the full resolution
+            image.draft('RGB', (self.size, self.size))
+            image = image.convert('RGB')
+            image.thumbnail((self.size, self.size), Image.LANCZOS)
+        for fmt in self.formats:
+            path = self.thumbnail_path(name, fmt)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # written aside under a name unique to this writer and renamed, so that concurrent readers never see a
+            # partial file and concurrent writers of the same thumbnail never interleave
+            fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    image.save(f, format=fmt.upper(), quality=self.quality)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        return True
+
+    def generate(self, source_paths: list, source_stats=None, num_workers: int = 8) -> int:
+        """
+        Create the missing or outdated thumbnails of a list of images. Sources and thumbnails are stat'ed with one
+        directory scan each, missing sources are skipped
+        :param source_paths: paths of original images inside source_dir
+        :param source_stats: optional (len(source_paths), 2) (mtime_ns, size) of the sources, e.g. the stats kept by
+            the embedding store, stat'ed here otherwise
+        :param num_workers: number of images resized concurrently
+        :return: number of images whose thumbnails were (re)generated
+        """
+        names = [os.path.relpath(str(path), self.source_dir) for path in source_paths]
+        source_mtimes = (stat_files([str(path) for path in source_paths]) if source_stats is None else source_stats)[:, 0]
+        thumbnail_mtimes = [stat_files([self.thumbnail_path(name, fmt) for name in names])[:, 0] for fmt in self.formats]
+        stale = [name for i, name in enumerate(names)
+                 if source_mtimes[i] >= 0 and any(mtimes[i] < source_mtimes[i] for mtimes in thumbnail_mtimes)]
+
+        def make(name):
+            try:
+                return self._make(name, check_fresh=False)
+            except OSError as e:
+                print(f"Warning: could not create the thumbnail of {name}: {e}")
+                return False
+
+        with ThreadPoolExecutor(num_workers) as executor:
+            return sum(executor.map(make, stale))
+
+    def get(self, name: str, fmt: str):
+        """
+        :param name: image path relative to source_dir
+        :param fmt: one of self.formats
+        :return: the Thumbnail, created on demand, None if the original image does not exist
+        """
+        path = self.thumbnail_path(name, fmt)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            try:
+                self._make(name)
+                st = os.stat(path)
+            except OSError:
+                return None
+        key = (path, st.st_mtime_ns, st.st_size)
+        thumbnail = self.cache.get(key)
+        if thumbnail is None:
+            with open(path, 'rb') as f:
+                body = f.read()
+            etag = '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+            thumbnail = Thumbnail(body, etag, CONTENT_TYPES[fmt])
+            self.cache.put(key, thumbnail)
+        return thumbnail
+
+    def respond(self, name: str, accept: str = None, if_none_match: str = None):
+        """
+        Framework independent response to a thumbnail request
+        :param name: image path relative to source_dir
+        :param accept: Accept header of the request, WebP is served to clients announcing it
+        :param if_none_match: If-None-Match header of the request
+        :return: (status, body, headers)
+        """
+        fmt = 'webp' if 'webp' in self.formats and accept and 'image/webp' in accept else 'jpeg'
+        thumbnail = self.get(name, fmt)
+        if thumbnail is None:
+            return 404, b'', {}
+        headers = {'ETag': thumbnail.etag, 'Cache-Control': f'public, max-age={self.max_age}', 'Vary': 'Accept'}
+        if if_none_match:
+            # weak comparison, as required for If-None-Match
+            candidates = {tag.strip()[2:] if tag.strip().startswith('W/') else tag.strip()
+                          for tag in if_none_match.split(',')}
+            if '*' in candidates or thumbnail.etag in candidates:
+                return 304, b'', headers
+        headers['Content-Type'] = thumbnail.content_type
+        return 200, thumbnail.body, headers
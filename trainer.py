@@ -1,10 +1,10 @@
 from tqdm import tqdm 
 import torch 
 from torch.utils.data import DataLoader 
-import numpy as np 
 from statistics import mean
 import wandb 
 from utils import set_train_bar_description, update_train_running_results, extract_index_features, collate_fn
+from evaluator import compute_fiq_metrics, compute_cirr_metrics
 
 
 class Trainer():
@@ -25,6 +25,7 @@ class Trainer():
         self.classic_val_dataset = classic_val_dataset
         self.relative_val_dataset = relative_val_dataset
         self.validation_frequency = cfg.validation_frequency
+        self.eval_memory_budget = cfg.eval_memory_budget
         self.save_path = cfg.save_path 
         if self.use_amp:
             self.scaler = torch.cuda.amp.GradScaler()
@@ -175,100 +176,13 @@ class Trainer():
 
     def compute_fiq_val_metrics(self, val_index_names, val_index_features, val_total_index_features, index):
         relative_val_loader = self.get_val_dataloader(index)
-        target_names = []
-        predicted_features = []
-
-        for batch_reference_names, batch_target_names, captions, reference_images in tqdm(relative_val_loader):
-
-            flattened_captions: list = np.array(captions).T.flatten().tolist()
-            input_captions = [
-                f"{flattened_captions[i].strip('.?, ').capitalize()} and {flattened_captions[i + 1].strip('.?, ')}" for
-                i in range(0, len(flattened_captions), 2)]
-            with torch.no_grad():
-                reference_images = reference_images.to(self.device)
-                batch_predicted_features = self.model.combine_features(reference_images, input_captions)
-                predicted_features.append(batch_predicted_features / batch_predicted_features.norm(dim=-1, keepdim=True))
-            
-            target_names.extend(batch_target_names)
-        predicted_features = torch.cat(predicted_features, dim=0)
-        val_index_features = val_index_features / val_index_features.norm(dim=-1, keepdim=True)
-
-        distances = 1 - predicted_features @ val_index_features.T
-        results = self.compute_results(distances, val_index_names, target_names)
-        
-        return results 
-            
+        return compute_fiq_metrics(self.model, relative_val_loader, val_index_names, val_index_features, self.device,
+                                   self.eval_memory_budget)
 
     def compute_cirr_val_metrics(self, val_index_names, val_index_features):
-
         relative_val_loader = self.get_val_dataloader()
-        
-        target_names = []
-        group_members = []
-        reference_names = []
-        predicted_features = []
-        for batch_reference_names, batch_target_names, captions, batch_group_members, reference_images in tqdm(relative_val_loader):
-            batch_group_members = np.array(batch_group_members).T.tolist()
-            with torch.no_grad():
-                reference_images = reference_images.to(self.device)
-                batch_predicted_features = self.model.combine_features(reference_images, captions)
-                predicted_features.append(batch_predicted_features / batch_predicted_features.norm(dim=-1, keepdim=True))
-
-            target_names.extend(batch_target_names)
-            group_members.extend(batch_group_members)
-            reference_names.extend(batch_reference_names)
-        
-        predicted_features = torch.cat(predicted_features, dim=0)
-
-        val_index_features = val_index_features / val_index_features.norm(dim=-1, keepdim=True)
-
-        distances = 1 - predicted_features @ val_index_features.T
-
-        results = self.compute_results(distances, val_index_names, target_names, reference_names, group_members)
-        
-        return results 
-    
-    def compute_results(self, distances, val_index_names,  target_names, reference_names=None, group_members=None):
-        sorted_indices = torch.argsort(distances, dim=-1).cpu()
-        sorted_index_names = np.array(val_index_names)[sorted_indices]
-
-        if reference_names == None:
-            labels = torch.tensor(
-                sorted_index_names == np.repeat(np.array(target_names), len(val_index_names)).reshape(len(target_names), -1))
-
-            recall_at10 = (torch.sum(labels[:, :10]) / len(labels)).item() * 100
-            recall_at50 = (torch.sum(labels[:, :50]) / len(labels)).item() * 100
-
-            return recall_at10, recall_at50
-
-        elif reference_names != None:
-            reference_mask = torch.tensor(
-                sorted_index_names != np.repeat(np.array(reference_names), len(val_index_names)).reshape(len(target_names), -1))
-            sorted_index_names = sorted_index_names[reference_mask].reshape(sorted_index_names.shape[0],
-                                                                            sorted_index_names.shape[1] - 1)
-
-            labels = torch.tensor(
-                sorted_index_names == np.repeat(np.array(target_names), len(val_index_names) - 1).reshape(len(target_names), -1))
-
-            group_members = np.array(group_members)
-        
-            group_mask = (sorted_index_names[..., None] == group_members[:, None, :]).sum(-1).astype(bool)
-            group_labels = labels[group_mask].reshape(labels.shape[0], -1)
-
-            assert torch.equal(torch.sum(labels, dim=-1).int(), torch.ones(len(target_names)).int())
-            assert torch.equal(torch.sum(group_labels, dim=-1).int(), torch.ones(len(target_names)).int())
-
-            # Compute the metrics
-            recall_at1 = (torch.sum(labels[:, :1]) / len(labels)).item() * 100
-            recall_at5 = (torch.sum(labels[:, :5]) / len(labels)).item() * 100
-            recall_at10 = (torch.sum(labels[:, :10]) / len(labels)).item() * 100
-            recall_at50 = (torch.sum(labels[:, :50]) / len(labels)).item() * 100
-            group_recall_at1 = (torch.sum(group_labels[:, :1]) / len(group_labels)).item() * 100
-            group_recall_at2 = (torch.sum(group_labels[:, :2]) / len(group_labels)).item() * 100
-            group_recall_at3 = (torch.sum(group_labels[:, :3]) / len(group_labels)).item() * 100
-
-            return group_recall_at1, group_recall_at2, group_recall_at3, recall_at1, recall_at5, recall_at10, recall_at50
-
+        return compute_cirr_metrics(self.model, relative_val_loader, val_index_names, val_index_features, self.device,
+                                    self.eval_memory_budget)
 
     def save_checkpoint(self, path):
         torch.save(self.model.state_dict(), path)
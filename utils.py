@@ -1,4 +1,5 @@
 import torch 
+import torch.nn.functional as F
 from torch.utils.data import DataLoader 
 from tqdm import tqdm 
 import random 
@@ -14,6 +15,7 @@ from data.laion_dataset_combined import LaionDataset_Combined
 def get_model(cfg):
     model = TransAgg(cfg)
     model = model.to(cfg.device)
+    model.enable_text_cache(cfg.text_cache_bytes)
     return model
 
 def set_grad(cfg, model):
@@ -100,7 +102,24 @@ def collate_fn(batch: list):
     return torch.utils.data.dataloader.default_collate(batch)
 
 
-def extract_index_features(dataset, model, return_local=True):
+def extract_index_features(dataset, model, return_local=True, feature_cache=None):
+    """
+    :param dataset: dataset in 'classic' mode
+    :param model: TransAgg
+    :param return_local: whether the local (token) features of the images are returned as well
+    :param feature_cache: optional FeatureCache, the global features of a frozen image encoder are loaded from it
+     instead of encoding the gallery, or written to it after encoding. Not used with return_local
+    :return: (index_features, index_names, index_total_features), index_total_features None unless return_local
+    """
+    use_cache = feature_cache is not None and not return_local
+    if use_cache:
+        cache_key = feature_cache.key(model, dataset)
+        cached = feature_cache.load(cache_key, dataset)
+        if cached is not None:
+            features, index_names = cached
+            print(f'Loaded {len(index_names)} index features from {feature_cache.entry_dir(cache_key)}')
+            return torch.from_numpy(features).to(model.device, non_blocking=True), index_names, None
+
     feature_dim = model.feature_dim 
     classic_val_loader = DataLoader(dataset=dataset, batch_size=32, num_workers=8,
                                     pin_memory=True, collate_fn=collate_fn)
@@ -120,9 +139,126 @@ def extract_index_features(dataset, model, return_local=True):
             index_total_features = torch.cat(index_total_features, dim=0).to(model.device, non_blocking=True)
     else:
         index_total_features = None 
+    if use_cache:
+        feature_cache.save(cache_key, dataset, index_features.cpu().numpy(), index_names)
     return index_features, index_names, index_total_features
 
 
+def index_rows(index_names: list) -> dict:
+    """
+    :param index_names: names of the index images, in row order
+    :return: name -> index row mapping, used to compare retrieved results as integers
+    """
+    return {name: i for i, name in enumerate(index_names)}
+
+
+def names_to_ids(rows: dict, names: list) -> torch.Tensor:
+    """
+    :param rows: name -> index row mapping, see index_rows
+    :param names: names to look up
+    :return: int64 tensor of the index rows of names, -1 for names missing from the index
+    """
+    return torch.tensor([rows.get(name, -1) for name in names], dtype=torch.long)
+
+
+class StreamingTopK:
+    """
+    Running top-k of queries against index features that never forms the queries x index score matrix: each block
+    of queries is scored against blocks of index rows sized so that one block of scores stays within memory_budget
+    bytes, and the top-k of every block is merged into the running top-k of its queries. Queries are added batch by
+    batch while the next ones are being encoded, so scoring overlaps with the feature extraction.
+    """
+
+    def __init__(self, index_features: torch.Tensor, k: int, memory_budget: int = 512 * 1024 ** 2,
+                 max_query_block: int = 1024):
+        """
+        :param index_features: (num_index, d) index features, normalized here. They may be kept on the CPU for large
+         galleries, their blocks are then copied to the device of the queries
+        :param k: number of neighbours kept per query
+        :param memory_budget: size in bytes of one block of float32 scores
+        :param max_query_block: largest number of queries scored at once
+        """
+        self.index_features = F.normalize(index_features.float(), dim=-1)
+        self.k = min(k, len(index_features))
+        self.memory_budget = memory_budget
+        self.max_query_block = max_query_block
+        self._top_ids = []
+
+    def add(self, queries: torch.Tensor, exclude_ids: torch.Tensor = None):
+        """
+        :param queries: (num_queries, d) normalized query features
+        :param exclude_ids: optional (num_queries,) index row removed from the neighbours of each query, e.g. the CIRR
+         reference image, by masking its score
+        """
+        num_index = len(self.index_features)
+        for start in range(0, len(queries), self.max_query_block):
+            block = queries[start:start + self.max_query_block].float()
+            index_block = max(self.k, self.memory_budget // (4 * len(block)))
+            excluded = exclude_ids[start:start + len(block)].to(block.device) if exclude_ids is not None else None
+            top_scores = top_ids = None
+            for index_start in range(0, num_index, index_block):
+                index_features = self.index_features[index_start:index_start + index_block].to(block.device, non_blocking=True)
+                scores = block @ index_features.T
+                if excluded is not None:
+                    rows = torch.nonzero((excluded >= index_start) & (excluded < index_start + len(index_features))).squeeze(1)
+                    scores[rows, excluded[rows] - index_start] = -float('inf')
+                block_scores, block_ids = torch.topk(scores, min(self.k, len(index_features)), dim=-1)
+                block_ids += index_start
+                if top_scores is not None:
+                    block_scores, order = torch.topk(torch.cat((top_scores, block_scores), dim=-1), self.k, dim=-1)
+                    block_ids = torch.cat((top_ids, block_ids), dim=-1).gather(1, order)
+                top_scores, top_ids = block_scores, block_ids
+            # only an excluded row can score -inf, it is never a neighbour
+            self._top_ids.append(top_ids.masked_fill(top_scores == -float('inf'), -1).cpu())
+
+    def distances(self, queries: torch.Tensor, ids: torch.Tensor) -> torch.Tensor:
+        """
+        :param queries: (num_queries, d) normalized query features
+        :param ids: (num_queries, m) index rows, rows of -1 get an arbitrary distance
+        :return: (num_queries, m) distances (1 - cosine similarity) of each query to its index rows
+        """
+        rows = self.index_features[ids.clamp(min=0).to(self.index_features.device)].to(queries.device)
+        return 1 - torch.einsum('qd,qmd->qm', queries.float(), rows)
+
+    def topk_ids(self) -> torch.Tensor:
+        """
+        :return: (num_queries, k) index rows of the nearest neighbours of every query added, best first, -1 for the
+         missing ones
+        """
+        return torch.cat(self._top_ids) if self._top_ids else torch.empty((0, self.k), dtype=torch.long)
+
+
+def rank_group_members(member_distances: torch.Tensor, group_ids: torch.Tensor, exclude_ids: torch.Tensor = None) -> torch.Tensor:
+    """
+    Rank the members of each query's group (the CIRR subset setting) from their few distances, rather than by
+    filtering the fully ranked index
+    :param member_distances: (num_queries, group_size) distances of each query to its group members
+    :param group_ids: (num_queries, group_size) index rows of the group members, -1 for members missing from the index
+    :param exclude_ids: optional (num_queries,) index row removed from each group, e.g. the CIRR reference image
+    :return: (num_queries, group_size) member rows sorted by increasing distance, padded at the end with -1 for the
+     excluded, missing and repeated members
+    """
+    group_ids = group_ids.to(member_distances.device)
+    invalid = group_ids < 0
+    if exclude_ids is not None:
+        invalid |= group_ids == exclude_ids.to(member_distances.device)[:, None]
+    # a member listed twice only counts once
+    invalid |= torch.tril(group_ids[:, :, None] == group_ids[:, None, :], diagonal=-1).any(dim=-1)
+    order = torch.sort(member_distances.masked_fill(invalid, float('inf')), dim=-1, stable=True).indices
+    return group_ids.masked_fill(invalid, -1).gather(1, order).cpu()
+
+
+def recall_at_ks(top_ids: torch.Tensor, target_ids: torch.Tensor, ks) -> list:
+    """
+    :param top_ids: (num_queries, >= max(ks)) index rows retrieved for each query, best first
+    :param target_ids: (num_queries,) index row of the target of each query
+    :param ks: cut-offs
+    :return: Recall@k in percent for every k of ks
+    """
+    hits = top_ids == target_ids.to(top_ids.device)[:, None]
+    return [(torch.sum(hits[:, :k]) / len(hits)).item() * 100 for k in ks]
+
+
 def get_optimizer(model, cfg):
     pretrained_params = list(map(id, model.pretrained_model.parameters()))
     optimizer_grouped_parameters = [